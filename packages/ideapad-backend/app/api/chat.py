@@ -1,31 +1,64 @@
-from fastapi import APIRouter, HTTPException
-from pathlib import Path
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    WebSocket,
+    WebSocketDisconnect,
+    WebSocketException,
+    status,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import AsyncIterator, Callable, Optional
+import anyio
+import asyncio
 import json
-from app.types import ModelConfig
+import sys
+import time
+import uuid
 
-from app.models.model_runner import ModelRunner
+from app.config import get_config
+from app.models.catalog import get_catalog, resolve_model_path
+from app.models.preloader import model_preloader
 from app.schemas import (
+    StartConversationRequest,
     StartConversationResponse,
     ContinueConversationRequest,
     ContinueConversationResponse,
     EndConversationRequest,
     EndConversationResponse,
     ChangeModelRequest,
+    ChangeModelResponse,
+    ChangeAdaptersRequest,
+    BatchRequest,
+    CancelBatchRequest,
+    CancelBatchResponse,
+)
+from app.exceptions import (
+    ModelLoadError,
+    InvalidPromptError,
+    ModelInferenceError,
+    InferenceQueueFullError,
+    ConversationNotFoundError,
+    SessionCapacityError,
+    BatchNotFoundError,
+    to_http_exception,
 )
-from app.exceptions import ModelLoadError, ModelInferenceError, to_http_exception
 from app.types import ModelErrorDetailEnum
-from app.api.session_manager import add_runner, pop_runner_or_404
+from app.api.session_manager import (
+    session_store,
+    add_runner,
+    lease_runner_or_404,
+    restore_runner,
+    delete_stored_conversation,
+)
 
-# Load config
-CONFIG_PATH = Path(__file__).resolve().parents[2] / "model_config.json"
-with open(CONFIG_PATH) as f:
-    raw = json.load(f)
-    config = ModelConfig.model_validate(raw)  # now a ModelConfig instance
+# The model stack (and llama_cpp with it) is imported on first use, not at
+# import time, so the server starts accepting requests immediately
 
 router = APIRouter()
 
-# In-memory session store: conversation_id -> ModelRunner
-_sessions: dict[str, ModelRunner] = {}
+# Batches still streaming results, by batch ID, so they can be cancelled
+_batches: dict = {}
 
 
 @router.get("/health")
@@ -33,83 +66,504 @@ async def health_check():
     return {"status": "ok"}
 
 
+@router.get("/health/live")
+async def liveness():
+    """
+    The process is up and serving HTTP.
+    """
+    return {"status": "ok"}
+
+
+@router.get("/health/ready")
+async def readiness():
+    """
+    Whether the configured model is loaded and warmed up, with load progress.
+    Returns 503 until it is.
+    """
+    status = model_preloader.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@router.get("/queue_stats")
+async def queue_stats():
+    """
+    Report queue depth and wait times for every loaded model.
+    """
+    from app.models.model_registry import model_registry
+
+    return {"models": model_registry.loaded_models()}
+
+
+@router.post("/tune")
+async def tune_model():
+    """
+    Benchmark llama.cpp settings for the configured model on this machine and
+    save the fastest profile; it is applied the next time the model loads.
+    Takes a while and competes with live inference for CPU.
+    """
+    from app.models.autotune import tune
+
+    try:
+        return await run_in_threadpool(tune, get_config())
+    except Exception as e:
+        raise to_http_exception(
+            ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+        ) from e
+
+
+@router.get("/sessions")
+async def session_stats():
+    """
+    Report open conversations, their estimated memory and eviction counters.
+    """
+    return session_store.stats()
+
+
 @router.get("/model_info")
-async def model_info() -> dict[str, str]:
+async def model_info() -> dict:
     """
-    Get information about the model.
-    Returns the model path and other relevant details.
+    Get information about the configured model.
+    Returns the model path and what its GGUF header says about it.
     """
-    return {
-        "model_path": str(config.model_path),
-        "description": "Llama model for inference",
-        "version": "1.0.0",
-    }
+    config = get_config()
+    info = {"model_path": str(config.model_path), "version": "1.0.0"}
+    try:
+        path = resolve_model_path(config.model_path)
+        entry = await run_in_threadpool(get_catalog(config).describe, path)
+    except RuntimeError:
+        entry = None
+    if entry is None:
+        return dict(info, description="Llama model for inference")
+    quantization = entry["quantization"] or "unknown quantization"
+    description = (
+        f"{entry['name']}: {entry['architecture']}, {entry['size_label']} "
+        f"parameters, {quantization}"
+    )
+    return dict(entry, **info, description=description)
+
+
+@router.get("/models")
+async def list_models():
+    """
+    Every model in the models directory with its GGUF header metadata, and
+    whether it is loaded. Headers are only read for new or changed files.
+    """
+    config = get_config()
+    models = await run_in_threadpool(get_catalog(config).scan)
+    # The model stack is imported on first use, maybe right now by the
+    # preloader; until it is, nothing is loaded
+    registry = getattr(
+        sys.modules.get("app.models.model_registry"), "model_registry", None
+    )
+    loaded, residency = {}, None
+    if registry is not None:
+        loaded = {m["model_path"]: m for m in registry.loaded_models()}
+        residency = registry.stats()
+    for model in models:
+        resident = loaded.get(model["path"])
+        model["loaded"] = resident is not None
+        model["refs"] = resident["refs"] if resident else 0
+    return {"models": models, "residency": residency}
 
 
 @router.post("/start_conversation", response_model=StartConversationResponse)
-async def start_conversation():
+async def start_conversation(req: Optional[StartConversationRequest] = None):
     """
     Initialize a new model session and return its conversation ID.
+    Idle conversations are evicted first if the memory budget requires it.
+    lora_adapters in the body are applied on top of the configured model for
+    this conversation; every conversation shares the same loaded weights.
     """
+    try:
+        await run_in_threadpool(session_store.admit)
+    except SessionCapacityError as e:
+        raise to_http_exception(e) from e
+    from app.models.model_runner import ModelRunner
+
+    config = get_config()
+    if req is not None and req.lora_adapters is not None:
+        config = config.model_copy(update={"lora_adapters": req.lora_adapters})
     runner = ModelRunner(config)
-    runner.start_model()
+    # Loading blocks, so keep it off the event loop
+    await run_in_threadpool(runner.start_model)
     if not hasattr(runner, "model_instance") or runner.model_instance is None:
         raise to_http_exception(
             ModelLoadError(detail=ModelErrorDetailEnum.MODEL_INITIALIZATION_ERROR)
         )
     cid = runner.model_instance.get_conversation_id()
-    _sessions[cid] = runner
+    add_runner(cid, runner)
     return {"conversation_id": cid}
 
 
+async def _restore(conversation_id: str):
+    """
+    Bring back a conversation that an earlier server process left in the
+    conversation store, so this request finds it. A conversation already in
+    memory costs one lookup.
+    """
+    config = get_config()
+    if not config.conversation_store_dir:
+        return
+    if session_store.get(conversation_id) is not None:
+        return
+    try:
+        await run_in_threadpool(restore_runner, conversation_id, config)
+    except SessionCapacityError as e:
+        raise to_http_exception(e) from e
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise to_http_exception(
+            ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+        ) from e
+
+
 @router.post("/continue_conversation", response_model=ContinueConversationResponse)
 async def continue_conversation(req: ContinueConversationRequest):
     """
     Continue an existing conversation by its ID.
     """
-    runner = _sessions.get(req.conversation_id)
-    if not runner:
-        raise to_http_exception(
-            ModelInferenceError(
-                detail=ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR
+    await _restore(req.conversation_id)
+    with lease_runner_or_404(req.conversation_id) as runner:
+        try:
+            response = await runner.executor.run(
+                runner.get_response, req.prompt, req.grammar, req.json_schema
             )
-        )
+        except InferenceQueueFullError as e:
+            raise to_http_exception(e) from e
+        except HTTPException:
+            raise
+    # The turn may have grown this session past the budget
+    await run_in_threadpool(session_store.sweep)
+    return {"response": response}
+
+
+async def _sse(
+    events: AsyncIterator[dict], on_close: Optional[Callable[[], None]] = None
+) -> AsyncIterator[str]:
+    """
+    Format model stream events as Server-Sent Events.
+    Errors after the stream has started are reported as an "error" event.
+    on_close runs once the stream ends, however it ends.
+    """
+    try:
+        async for event in events:
+            payload = {k: v for k, v in event.items() if k != "type"}
+            yield f"event: {event['type']}\ndata: {json.dumps(payload)}\n\n"
+    except Exception:
+        detail = ModelErrorDetailEnum.MODEL_INFERENCE_ERROR.value
+        yield f"event: error\ndata: {json.dumps({'detail': detail})}\n\n"
+    finally:
+        if on_close is not None:
+            on_close()
+
+
+@router.post("/continue_conversation/stream")
+async def continue_conversation_stream(req: ContinueConversationRequest):
+    """
+    Continue an existing conversation, streaming tokens as Server-Sent Events.
+    Emits "token" events while decoding and a final "done" event with usage.
+    """
+    if not req.prompt:
+        raise to_http_exception(InvalidPromptError())
+    await _restore(req.conversation_id)
+    runner = session_store.checkout(req.conversation_id)
+    if not runner:
+        raise to_http_exception(ConversationNotFoundError())
     try:
-        response = runner.get_response(req.prompt)
-        return {"response": response}
+        # A grammar that does not compile is a 400, not an error event
+        await run_in_threadpool(runner.compile_grammar, req.grammar, req.json_schema)
+        events = runner.executor.submit_stream(
+            lambda: runner.stream_response(req.prompt, req.grammar, req.json_schema)
+        )
+    except InferenceQueueFullError as e:
+        session_store.checkin(req.conversation_id)
+        raise to_http_exception(e) from e
     except HTTPException:
+        session_store.checkin(req.conversation_id)
         raise
+    return StreamingResponse(
+        _sse(events, on_close=lambda: session_store.checkin(req.conversation_id)),
+        media_type="text/event-stream",
+    )
 
 
-@router.post("/end_conversation", response_model=EndConversationResponse)
-async def end_conversation(req: EndConversationRequest):
+async def _relay(websocket: WebSocket, conversation_id: str, message: dict):
     """
-    End a conversation, freeing resources.
+    Generate the answer to a prompt message and send its events over the
+    socket. Cancelling the task stops decoding at the next token.
     """
-    runner = _sessions.pop(req.conversation_id, None)
+    prompt = message.get("prompt") or ""
+    try:
+        # The conversation may have been evicted since the socket opened
+        await _restore(conversation_id)
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "detail": e.detail})
+        return
+    runner = session_store.checkout(conversation_id)
     if not runner:
-        raise to_http_exception(
-            ModelInferenceError(
-                detail=ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR
+        detail = ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR.value
+        await websocket.send_json({"type": "error", "detail": detail})
+        return
+    events = None
+    try:
+        if not prompt:
+            raise to_http_exception(InvalidPromptError())
+        events = runner.executor.submit_stream(
+            lambda: runner.stream_response(
+                prompt, message.get("grammar"), message.get("json_schema")
             )
         )
-    runner.stop_model()
+        async for event in events:
+            await websocket.send_json(event)
+    except InferenceQueueFullError as e:
+        await websocket.send_json({"type": "error", "detail": e.detail})
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "detail": e.detail})
+    except Exception:
+        detail = ModelErrorDetailEnum.MODEL_INFERENCE_ERROR.value
+        await websocket.send_json({"type": "error", "detail": detail})
+    finally:
+        if events is not None:
+            # Stops the worker thread even when cancelled mid-send
+            await events.aclose()
+        session_store.checkin(conversation_id)
+
+
+@router.websocket("/ws/{conversation_id}")
+async def conversation_socket(websocket: WebSocket, conversation_id: str):
+    """
+    Chat over one connection per conversation. The client sends
+    {"type": "prompt", "prompt": ...}, optionally with a "grammar" or
+    "json_schema" to constrain the answer, and {"type": "cancel"}; each
+    prompt is answered with "token" events and a final "done" or "error"
+    event. A cancel, a new prompt while one is answered, or disconnecting
+    stops decoding at the next token, frees the model for the next request,
+    and keeps the partial answer in the history ("done" with finish_reason
+    "cancelled").
+    """
+    try:
+        await _restore(conversation_id)
+    except HTTPException as e:
+        raise WebSocketException(
+            code=status.WS_1013_TRY_AGAIN_LATER, reason=e.detail
+        ) from e
+    if session_store.get(conversation_id) is None:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION,
+            reason=ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR.value,
+        )
+    await websocket.accept()
+    generation: Optional[asyncio.Task] = None
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except ValueError:
+                message = None
+            kind = message.get("type") if isinstance(message, dict) else None
+            if kind not in ("prompt", "cancel"):
+                await websocket.send_json(
+                    {"type": "error", "detail": "Expected a prompt or cancel message"}
+                )
+                continue
+            if generation is not None and not generation.done():
+                generation.cancel()
+                await asyncio.gather(generation, return_exceptions=True)
+                cancelled = {"type": "done", "finish_reason": "cancelled"}
+                await websocket.send_json(cancelled)
+            if kind == "prompt":
+                generation = asyncio.ensure_future(
+                    _relay(websocket, conversation_id, message)
+                )
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if generation is not None and not generation.done():
+            generation.cancel()
+            await asyncio.gather(generation, return_exceptions=True)
+
+
+async def _ndjson_batch(
+    batch_id: str, batch, on_close: Callable[[], None]
+) -> AsyncIterator[str]:
+    """
+    Stream a batch's results as newline-delimited JSON in the order they
+    finish. Whatever is still running is cancelled once the stream ends,
+    including when the client disconnects.
+    """
+    started = time.perf_counter()
+    counts = {"completed": 0, "cancelled": 0, "failed": 0}
+    try:
+        header = {"type": "batch", "batch_id": batch_id, "count": len(batch)}
+        yield json.dumps(header) + "\n"
+        while True:
+            # Abandoned on disconnect; cancelling the batch below unblocks it
+            event = await anyio.to_thread.run_sync(
+                batch.next_result, abandon_on_cancel=True
+            )
+            if event is None:
+                break
+            if event["type"] == "error":
+                counts["failed"] += 1
+                detail = ModelErrorDetailEnum.MODEL_INFERENCE_ERROR.value
+                line = {"type": "error", "index": event["index"], "detail": detail}
+            else:
+                cancelled = event["finish_reason"] == "cancelled"
+                counts["cancelled" if cancelled else "completed"] += 1
+                line = {
+                    "type": "result",
+                    "index": event["index"],
+                    "text": event["text"],
+                    "finish_reason": event["finish_reason"],
+                    "usage": event["usage"],
+                }
+            yield json.dumps(line) + "\n"
+        seconds = round(time.perf_counter() - started, 3)
+        yield json.dumps({"type": "done", **counts, "seconds": seconds}) + "\n"
+    finally:
+        batch.cancel()
+        _batches.pop(batch_id, None)
+        on_close()
+
+
+@router.post("/batch")
+async def batch_generate(req: BatchRequest):
+    """
+    Answer many independent prompts (e.g. a review of each changed file) with
+    shared sampling settings. The prompts run together on the configured
+    model: their prefills share batches and their decodes are interleaved, so
+    the whole batch costs about as much as its longest answer while it fits
+    in max_batch_sequences. Streams NDJSON: a "batch" line with the batch ID,
+    a "result" (or "error") line per prompt as soon as it finishes, and a
+    final "done" line. Unlike conversations, answers are not cut at the first
+    newline unless stop says so. A grammar or json_schema constrains every
+    answer, and lora_adapters are applied to every answer.
+    """
+    if not req.prompts or not all(prompt.strip() for prompt in req.prompts):
+        raise to_http_exception(InvalidPromptError())
+    from app.models.model_registry import model_registry
+
+    try:
+        model = await run_in_threadpool(model_registry.acquire, get_config())
+    except Exception as e:
+        raise to_http_exception(
+            ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+        ) from e
+
+    system = (
+        [{"role": "system", "content": req.system_prompt}] if req.system_prompt else []
+    )
+    try:
+        grammar = await run_in_threadpool(
+            model.compile_grammar, req.grammar, req.json_schema
+        )
+    except ValueError as e:
+        model_registry.release(model)
+        raise to_http_exception(
+            InvalidPromptError(detail=ModelErrorDetailEnum.INVALID_GRAMMAR_ERROR)
+        ) from e
+    try:
+        adapters = await run_in_threadpool(model.resolve_adapters, req.lora_adapters)
+    except ValueError as e:
+        model_registry.release(model)
+        raise to_http_exception(
+            InvalidPromptError(detail=ModelErrorDetailEnum.INVALID_LORA_ADAPTER_ERROR)
+        ) from e
+    try:
+        batch = await run_in_threadpool(
+            model.generate_batch,
+            [system + [{"role": "user", "content": p}] for p in req.prompts],
+            req.max_tokens,
+            req.temperature,
+            req.stop,
+            req.seed,
+            grammar,
+            adapters,
+        )
+    except ValueError as e:
+        model_registry.release(model)
+        raise to_http_exception(
+            InvalidPromptError(detail=ModelErrorDetailEnum.PROMPT_TOO_LONG_ERROR)
+        ) from e
+    except Exception as e:
+        model_registry.release(model)
+        raise to_http_exception(ModelInferenceError()) from e
+
+    batch_id = str(uuid.uuid4())
+    _batches[batch_id] = batch
+    return StreamingResponse(
+        _ndjson_batch(batch_id, batch, on_close=lambda: model_registry.release(model)),
+        media_type="application/x-ndjson",
+    )
+
+
+@router.post("/batch/cancel", response_model=CancelBatchResponse)
+async def cancel_batch(req: CancelBatchRequest):
+    """
+    Cancel some or all prompts of a running batch. Each cancelled prompt still
+    gets a result line, with finish_reason "cancelled" and its partial text.
+    """
+    batch = _batches.get(req.batch_id)
+    if batch is None:
+        raise to_http_exception(BatchNotFoundError())
+    return {"batch_id": req.batch_id, "cancelled": batch.cancel(req.indices)}
+
+
+@router.post("/end_conversation", response_model=EndConversationResponse)
+async def end_conversation(req: EndConversationRequest):
+    """
+    End a conversation, freeing resources and deleting it from the
+    conversation store.
+    """
+    runner = session_store.pop(req.conversation_id)
+    if runner is not None:
+        await run_in_threadpool(runner.end_model)
+    elif not await run_in_threadpool(
+        delete_stored_conversation, req.conversation_id, get_config()
+    ):
+        raise to_http_exception(ConversationNotFoundError())
     return {"status": "ended"}
 
 
-@router.post("/change_model", response_model=ChangeModelRequest)
+@router.post("/change_model", response_model=ChangeModelResponse)
 async def change_model(req: ChangeModelRequest):
     """
     Change the model for an existing conversation.
+    The new model loads in the background while the current one keeps
+    answering; the conversation keeps its ID and history. If the new model
+    fails to load, the conversation stays on the old one.
     """
-    runner = pop_runner_or_404(req.conversation_id)
-    runner.stop_model()
-    runner.config.model_path = req.model_path
-    runner.start_model()
-    if not hasattr(runner, "model_instance") or runner.model_instance is None:
-        raise to_http_exception(
-            ModelLoadError(detail=ModelErrorDetailEnum.MODEL_INITIALIZATION_ERROR)
-        )
-    new_cid = runner.model_instance.get_conversation_id()
-    add_runner(new_cid, runner)
-    return {"conversation_id": new_cid, "status": "model changed"}
+    await _restore(req.conversation_id)
+    with lease_runner_or_404(req.conversation_id) as runner:
+        try:
+            await run_in_threadpool(runner.change_model, req.model_path)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise to_http_exception(
+                ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+            ) from e
+    return {"conversation_id": req.conversation_id, "status": "model changed"}
+
+
+@router.post("/change_adapters", response_model=ChangeModelResponse)
+async def change_adapters(req: ChangeAdaptersRequest):
+    """
+    Apply other LoRA adapters to an existing conversation, or none to go back
+    to the base model. The base model stays loaded; adapters are loaded once
+    and shared with every conversation using them. The conversation keeps its
+    ID and history, and its transcript is prefilled with the new adapters
+    while the old ones keep answering.
+    """
+    await _restore(req.conversation_id)
+    with lease_runner_or_404(req.conversation_id) as runner:
+        try:
+            await run_in_threadpool(runner.change_adapters, req.lora_adapters)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise to_http_exception(
+                ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+            ) from e
+    return {"conversation_id": req.conversation_id, "status": "adapters changed"}
@@ -0,0 +1,104 @@
+"""
+Unit tests for the chat API's error responses, and a smoke test of a whole
+conversation on the fake model the load test uses.
+"""
+
+import functools
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import chat
+from app.models.model_registry import model_registry
+from app.types import ModelConfig, ModelErrorDetailEnum
+from benchmarks.fake_model import FakeModelDefinition
+
+
+class TestChatErrors(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(chat.router, prefix="/api/chat")
+        self.client = TestClient(app)
+        patcher = patch(
+            "app.api.chat.get_config",
+            return_value=ModelConfig(model_path="models/fake.gguf"),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unknown_conversation_is_404_with_its_detail(self):
+        response = self.client.post(
+            "/api/chat/continue_conversation",
+            json={"conversation_id": "missing", "prompt": "hi"},
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(
+            response.json(),
+            {"detail": ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR.value},
+        )
+
+    def test_unknown_batch_is_404_with_its_detail(self):
+        response = self.client.post(
+            "/api/chat/batch/cancel", json={"batch_id": "missing"}
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(
+            response.json(),
+            {"detail": ModelErrorDetailEnum.BATCH_NOT_FOUND_ERROR.value},
+        )
+
+
+class TestFakeBackendConversation(unittest.TestCase):
+    def setUp(self):
+        # The registry resolves model paths, so the fake needs a real file
+        placeholder = tempfile.NamedTemporaryFile(suffix=".gguf", delete=False)
+        placeholder.close()
+        self.addCleanup(os.unlink, placeholder.name)
+        config = ModelConfig(model_path=placeholder.name, max_tokens=8)
+        fake = functools.partial(
+            FakeModelDefinition, token_delay=0, completion_tokens=4
+        )
+        for patcher in (
+            patch("app.config._config", config),
+            patch.object(model_registry, "factory", fake),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        app = FastAPI()
+        app.include_router(chat.router, prefix="/api/chat")
+        self.client = TestClient(app)
+
+    def test_start_continue_stream_end(self):
+        response = self.client.post("/api/chat/start_conversation")
+        self.assertEqual(response.status_code, 200)
+        cid = response.json()["conversation_id"]
+
+        response = self.client.post(
+            "/api/chat/continue_conversation",
+            json={"conversation_id": cid, "prompt": "hello"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"response": "word0 word1 word2 word3"})
+
+        response = self.client.post(
+            "/api/chat/continue_conversation/stream",
+            json={"conversation_id": cid, "prompt": "again"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text.count("event: token"), 4)
+        self.assertIn("event: done", response.text)
+        self.assertNotIn("event: error", response.text)
+
+        response = self.client.post(
+            "/api/chat/end_conversation", json={"conversation_id": cid}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(model_registry.stats()["resident_models"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import threading
+
+from fastapi import APIRouter
+from starlette.concurrency import run_in_threadpool
+
+from app.config import get_config
+from app.schemas import CompleteRequest, CompleteResponse
+from app.exceptions import (
+    InferenceQueueFullError,
+    InvalidPromptError,
+    ModelInferenceError,
+    ModelLoadError,
+    to_http_exception,
+)
+from app.types import ModelErrorDetailEnum
+
+router = APIRouter()
+
+# Cancellation flag of the newest completion of each document
+_latest: dict[str, threading.Event] = {}
+
+
+@router.post("/complete", response_model=CompleteResponse)
+async def complete(req: CompleteRequest):
+    """
+    Inline code completion: fill in the code between prefix and suffix with
+    the model's fill-in-the-middle tokens. Completions have their own queue
+    and llama context, and chat answers pause while one runs. A newer request
+    for the same document cancels this one, queued or running, which then
+    returns with finish_reason "cancelled".
+    """
+    if not req.prefix and not req.suffix:
+        raise to_http_exception(InvalidPromptError())
+    cancelled = threading.Event()
+    if req.document is not None:
+        previous = _latest.get(req.document)
+        if previous is not None:
+            previous.set()
+        _latest[req.document] = cancelled
+    from app.models.model_registry import model_registry
+
+    try:
+        try:
+            model = await run_in_threadpool(model_registry.acquire, get_config())
+        except Exception as e:
+            raise to_http_exception(
+                ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+            ) from e
+        try:
+            return await model.completion_executor.run(
+                model.complete,
+                req.prefix,
+                req.suffix,
+                req.max_tokens,
+                req.stop,
+                cancelled,
+            )
+        except InferenceQueueFullError as e:
+            raise to_http_exception(e) from e
+        except ValueError as e:
+            raise to_http_exception(
+                InvalidPromptError(detail=ModelErrorDetailEnum.PROMPT_TOO_LONG_ERROR)
+            ) from e
+        except Exception as e:
+            raise to_http_exception(ModelInferenceError()) from e
+        finally:
+            model_registry.release(model)
+    finally:
+        if req.document is not None and _latest.get(req.document) is cancelled:
+            del _latest[req.document]
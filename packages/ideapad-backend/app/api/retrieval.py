@@ -0,0 +1,91 @@
+from fastapi import APIRouter
+from starlette.concurrency import run_in_threadpool
+
+from app.config import get_config
+from app.schemas import (
+    EmbeddingsRequest,
+    EmbeddingsResponse,
+    IndexFilesRequest,
+    IndexFilesResponse,
+    SearchRequest,
+    SearchResponse,
+)
+from app.exceptions import (
+    ModelLoadError,
+    InvalidPromptError,
+    RetrievalDisabledError,
+    to_http_exception,
+)
+from app.types import ModelErrorDetailEnum
+
+# Like the chat routes, the embedding model loads on first use
+
+router = APIRouter()
+
+
+async def _retriever():
+    """
+    The configured workspace retriever, loading it off the event loop.
+    """
+    from app.models.retrieval import get_retriever
+
+    try:
+        retriever = await run_in_threadpool(get_retriever, get_config())
+    except Exception as e:
+        raise to_http_exception(
+            ModelLoadError(detail=ModelErrorDetailEnum.MODEL_LOAD_ERROR)
+        ) from e
+    if retriever is None:
+        raise to_http_exception(RetrievalDisabledError())
+    return retriever
+
+
+@router.post("/embeddings", response_model=EmbeddingsResponse)
+async def embeddings(req: EmbeddingsRequest):
+    """
+    Embed texts with the local embedding model into unit-length vectors.
+    """
+    if not req.input or not all(req.input):
+        raise to_http_exception(InvalidPromptError())
+    retriever = await _retriever()
+    vectors = await run_in_threadpool(retriever.embedder.embed, req.input)
+    return {
+        "model": retriever.embedder.name,
+        "dim": retriever.embedder.dim,
+        "embeddings": vectors.tolist(),
+    }
+
+
+@router.post("/index", response_model=IndexFilesResponse)
+async def index_files(req: IndexFilesRequest):
+    """
+    Bring the workspace index up to date: re-embed changed files and drop
+    removed ones. Files whose content is already indexed cost a hash only,
+    so the extension can send every file it has open or saved.
+    """
+    retriever = await _retriever()
+    result = await run_in_threadpool(
+        retriever.index_files, [(f.path, f.content) for f in req.files]
+    )
+    removed = await run_in_threadpool(retriever.remove_files, req.removed)
+    return {**result, "removed": removed}
+
+
+@router.post("/search", response_model=SearchResponse)
+async def search(req: SearchRequest):
+    """
+    The indexed code chunks most similar to a query, best first.
+    """
+    if not req.query:
+        raise to_http_exception(InvalidPromptError())
+    retriever = await _retriever()
+    return {"results": await run_in_threadpool(retriever.search, req.query, req.k)}
+
+
+@router.get("/stats")
+async def index_stats():
+    """
+    Indexed files and chunks, and the size of the vector matrix.
+    """
+    retriever = await _retriever()
+    return await run_in_threadpool(retriever.stats)
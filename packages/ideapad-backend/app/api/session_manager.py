@@ -1,26 +1,279 @@
-from app.models.model_runner import ModelRunner
-from app.exceptions import ConversationNotFoundError, to_http_exception
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, Optional
 
-# In-memory session store: conversation_id -> ModelRunner
-_sessions: dict[str, ModelRunner] = {}
+from app.exceptions import (
+    ConversationNotFoundError,
+    SessionCapacityError,
+    to_http_exception,
+)
+from app.types import ModelConfig
 
+if TYPE_CHECKING:
+    # Importing the model stack loads llama_cpp, so keep it off the startup path
+    from app.models.model_runner import ModelRunner
 
-def add_runner(conversation_id: str, runner: ModelRunner):
+
+class _Session:
+    __slots__ = ("runner", "last_used", "busy")
+
+    def __init__(self, runner: "ModelRunner"):
+        self.runner = runner
+        self.last_used = time.monotonic()
+        self.busy = 0
+
+
+def session_memory_bytes(runner: "ModelRunner") -> int:
+    """
+    Approximate memory held by one session: its saved KV snapshot plus history.
+    The shared model weights are not counted.
+    """
+    instance = runner.model_instance
+    if instance is None:
+        return 0
+    history = sum(len(turn["content"].encode("utf-8")) for turn in instance.history)
+    return instance.state.snapshot_bytes + history
+
+
+class SessionStore:
+    """
+    Process-wide conversation store. Sessions idle longer than the TTL are
+    evicted, and when the memory budget is exceeded the least recently used
+    idle sessions go first. Sessions with a request in flight are never evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = 0, memory_budget_bytes: int = 0):
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted_idle = 0
+        self.evicted_memory = 0
+        self.rejected = 0
+
+    def configure(self, ttl_seconds: float, memory_budget_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+
+    def admit(self):
+        """
+        Make room for a new session, evicting idle ones if needed.
+        Raises SessionCapacityError when even eviction cannot free enough memory.
+        """
+        evicted = self.evict_idle()
+        with self._lock:
+            evicted += self._evict_for_budget(reserve=self._average_bytes())
+            full = (
+                self.memory_budget_bytes > 0
+                and self._total_bytes() + self._average_bytes()
+                > self.memory_budget_bytes
+            )
+            if full:
+                self.rejected += 1
+        self._stop(evicted)
+        if full:
+            raise SessionCapacityError()
+
+    def add(self, conversation_id: str, runner: "ModelRunner"):
+        with self._lock:
+            self._sessions[conversation_id] = _Session(runner)
+
+    def get(self, conversation_id: str) -> Optional["ModelRunner"]:
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                return None
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(conversation_id)
+            return session.runner
+
+    def pop(self, conversation_id: str) -> Optional["ModelRunner"]:
+        with self._lock:
+            session = self._sessions.pop(conversation_id, None)
+        return session.runner if session is not None else None
+
+    def checkout(self, conversation_id: str) -> Optional["ModelRunner"]:
+        """
+        Like get(), but marks the session busy until checkin().
+        """
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                return None
+            session.busy += 1
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(conversation_id)
+            return session.runner
+
+    def checkin(self, conversation_id: str):
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is not None:
+                session.busy = max(session.busy - 1, 0)
+                session.last_used = time.monotonic()
+
+    def evict_idle(self) -> list["ModelRunner"]:
+        """
+        Remove sessions idle for longer than the TTL and return their runners
+        so the caller can stop them outside the lock.
+        """
+        if self.ttl_seconds <= 0:
+            return []
+        cutoff = time.monotonic() - self.ttl_seconds
+        with self._lock:
+            expired = [
+                cid
+                for cid, session in self._sessions.items()
+                if session.busy == 0 and session.last_used < cutoff
+            ]
+            runners = [self._sessions.pop(cid).runner for cid in expired]
+        self.evicted_idle += len(runners)
+        return runners
+
+    def sweep(self):
+        """
+        Apply the TTL and memory budget, stopping every evicted session.
+        Stopping may wait for a model lock, so call it off the event loop.
+        """
+        evicted = self.evict_idle()
+        with self._lock:
+            evicted += self._evict_for_budget()
+        self._stop(evicted)
+
+    def stop_all(self):
+        """
+        Stop every session, e.g. at shutdown, which leaves stored
+        conversations in the conversation store.
+        """
+        with self._lock:
+            runners = [session.runner for session in self._sessions.values()]
+            self._sessions.clear()
+        self._stop(runners)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "busy_sessions": sum(1 for s in self._sessions.values() if s.busy),
+                "memory_bytes": self._total_bytes(),
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "evicted_idle": self.evicted_idle,
+                "evicted_memory": self.evicted_memory,
+                "rejected": self.rejected,
+            }
+
+    def _evict_for_budget(self, reserve: int = 0) -> list["ModelRunner"]:
+        # Must be called with the lock held; oldest entries come first
+        if self.memory_budget_bytes <= 0:
+            return []
+        evicted = []
+        total = self._total_bytes()
+        for cid in list(self._sessions):
+            if total + reserve <= self.memory_budget_bytes:
+                break
+            session = self._sessions[cid]
+            if session.busy:
+                continue
+            total -= session_memory_bytes(session.runner)
+            evicted.append(self._sessions.pop(cid).runner)
+        self.evicted_memory += len(evicted)
+        return evicted
+
+    def _total_bytes(self) -> int:
+        return sum(session_memory_bytes(s.runner) for s in self._sessions.values())
+
+    def _average_bytes(self) -> int:
+        if not self._sessions:
+            return 0
+        return self._total_bytes() // len(self._sessions)
+
+    @staticmethod
+    def _stop(runners: list["ModelRunner"]):
+        for runner in runners:
+            try:
+                runner.stop_model()
+            except Exception:
+                pass  # An evicted session must not fail the request that evicted it
+
+
+# Single in-memory session store: conversation_id -> ModelRunner
+session_store = SessionStore()
+
+
+def add_runner(conversation_id: str, runner: "ModelRunner"):
     """Add a new runner to the session store."""
-    _sessions[conversation_id] = runner
+    session_store.add(conversation_id, runner)
+
+
+# Serialises restores so concurrent requests bring a conversation back once
+_restore_lock = threading.Lock()
+
 
+def restore_runner(conversation_id: str, config: ModelConfig) -> bool:
+    """
+    Load a conversation kept in the conversation store by an earlier process
+    into the session store, unless it is there already. Returns whether the
+    session store now has it. Blocks on model loading and disk reads.
+    """
+    with _restore_lock:
+        if session_store.get(conversation_id) is not None:
+            return True
+        from app.models.model_runner import ModelRunner
 
-def get_runner_or_404(conversation_id: str) -> ModelRunner:
+        runner = ModelRunner.restore(config, conversation_id)
+        if runner is None:
+            return False
+        try:
+            session_store.admit()
+        except SessionCapacityError:
+            runner.stop_model()
+            raise
+        session_store.add(conversation_id, runner)
+        return True
+
+
+def delete_stored_conversation(conversation_id: str, config: ModelConfig) -> bool:
+    """
+    Delete a conversation that is only in the conversation store. Returns
+    whether it was there.
+    """
+    if not config.conversation_store_dir:
+        return False
+    from app.models.conversation_store import get_conversation_store
+
+    store = get_conversation_store(config)
+    if store.load(conversation_id) is None:
+        return False
+    store.delete(conversation_id)
+    return True
+
+
+def get_runner_or_404(conversation_id: str) -> "ModelRunner":
     """Retrieve a runner or raise 404 if not found."""
-    runner = _sessions.get(conversation_id)
+    runner = session_store.get(conversation_id)
     if not runner:
         raise to_http_exception(ConversationNotFoundError())
     return runner
 
 
-def pop_runner_or_404(conversation_id: str) -> ModelRunner:
+def pop_runner_or_404(conversation_id: str) -> "ModelRunner":
     """Pop a runner or raise 404 if not found."""
-    runner = _sessions.pop(conversation_id, None)
+    runner = session_store.pop(conversation_id)
     if not runner:
         raise to_http_exception(ConversationNotFoundError())
     return runner
+
+
+@contextmanager
+def lease_runner_or_404(conversation_id: str) -> Iterator["ModelRunner"]:
+    """Hold a runner for the duration of a request so it cannot be evicted."""
+    runner = session_store.checkout(conversation_id)
+    if not runner:
+        raise to_http_exception(ConversationNotFoundError())
+    try:
+        yield runner
+    finally:
+        session_store.checkin(conversation_id)
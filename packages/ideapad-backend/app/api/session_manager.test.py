@@ -0,0 +1,52 @@
+"""
+Unit tests for session eviction and admission control.
+"""
+
+import unittest
+from unittest.mock import MagicMock, patch
+from app.api.session_manager import SessionStore
+from app.exceptions import SessionCapacityError
+
+
+def _runner(snapshot_bytes: int) -> MagicMock:
+    runner = MagicMock()
+    runner.model_instance.history = []
+    runner.model_instance.state.snapshot_bytes = snapshot_bytes
+    return runner
+
+
+class TestSessionStore(unittest.TestCase):
+    def test_idle_sessions_expire_after_ttl(self):
+        store = SessionStore(ttl_seconds=10)
+        runner = _runner(0)
+        with patch("app.api.session_manager.time.monotonic", return_value=100.0):
+            store.add("a", runner)
+        with patch("app.api.session_manager.time.monotonic", return_value=111.0):
+            store.sweep()
+        self.assertIsNone(store.get("a"))
+        runner.stop_model.assert_called_once()
+
+    def test_budget_evicts_least_recently_used(self):
+        store = SessionStore(memory_budget_bytes=250)
+        runners = {cid: _runner(100) for cid in "abc"}
+        for cid, runner in runners.items():
+            store.add(cid, runner)
+        store.get("a")
+        store.sweep()
+        self.assertIsNone(store.get("b"))
+        self.assertIsNotNone(store.get("a"))
+        self.assertIsNotNone(store.get("c"))
+
+    def test_busy_sessions_are_not_evicted(self):
+        store = SessionStore(memory_budget_bytes=100)
+        store.add("a", _runner(200))
+        store.checkout("a")
+        store.sweep()
+        self.assertIsNotNone(store.get("a"))
+        with self.assertRaises(SessionCapacityError):
+            store.admit()
+        self.assertEqual(store.stats()["rejected"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+"""Backend configuration, read from model_config.json on first use"""
+
+import json
+import threading
+from pathlib import Path
+from typing import Optional
+
+from app.types import ModelConfig
+
+CONFIG_PATH = Path(__file__).resolve().parents[1] / "model_config.json"
+
+_config: Optional[ModelConfig] = None
+_lock = threading.Lock()
+
+
+def get_config() -> ModelConfig:
+    """
+    Return the process-wide ModelConfig, loading and validating it once.
+    """
+    global _config
+    with _lock:
+        if _config is None:
+            with open(CONFIG_PATH) as f:
+                _config = ModelConfig.model_validate(json.load(f))
+        return _config
+
+
+def set_config(config: ModelConfig):
+    """
+    Replace the process-wide ModelConfig, e.g. to point benchmarks at another model.
+    """
+    global _config
+    with _lock:
+        _config = config
@@ -67,7 +67,8 @@ class ConversationNotFoundError(ModelError):
         self,
         detail: ModelErrorDetailEnum = ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR,
     ):
-        super().__init__(detail)
+        self.detail = detail
+        super().__init__(self.detail)
 
 
 class ModelInitError(ModelError):
@@ -80,6 +81,72 @@ class ModelInitError(ModelError):
         super().__init__(detail)
 
 
+class InferenceQueueFullError(ModelError):
+    """Raised when a model's inference queue cannot accept more work."""
+
+    def __init__(
+        self,
+        detail: ModelErrorDetailEnum = ModelErrorDetailEnum.INFERENCE_QUEUE_FULL_ERROR,
+    ):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
+class SessionCapacityError(ModelError):
+    """Raised when no memory can be freed for a new conversation."""
+
+    def __init__(
+        self,
+        detail: ModelErrorDetailEnum = ModelErrorDetailEnum.SESSION_CAPACITY_ERROR,
+    ):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
+class BatchNotFoundError(ModelError):
+    """Raised when an unknown or finished batch ID is used."""
+
+    def __init__(
+        self,
+        detail: ModelErrorDetailEnum = ModelErrorDetailEnum.BATCH_NOT_FOUND_ERROR,
+    ):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
+class RetrievalDisabledError(ModelError):
+    """Raised when retrieval is used without an embedding model configured."""
+
+    def __init__(
+        self,
+        detail: ModelErrorDetailEnum = ModelErrorDetailEnum.RETRIEVAL_DISABLED_ERROR,
+    ):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
+class ConversationLostError(ModelError):
+    """Raised when a conversation's inference worker exited and took it along."""
+
+    def __init__(
+        self,
+        detail: ModelErrorDetailEnum = ModelErrorDetailEnum.CONVERSATION_LOST_ERROR,
+    ):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
+class WorkerUnavailableError(ModelError):
+    """Raised when no inference worker can take a request right now."""
+
+    def __init__(
+        self,
+        detail: ModelErrorDetailEnum = ModelErrorDetailEnum.WORKER_UNAVAILABLE_ERROR,
+    ):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
 # Utility function to convert internal exceptions to HTTP exceptions
 def to_http_exception(exc: ModelError) -> HTTPException:
     if isinstance(exc, ModelLoadError):
@@ -100,12 +167,26 @@ def to_http_exception(exc: ModelError) -> HTTPException:
         return HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=exc.detail
         )
-    if isinstance(exc, ConversationNotFoundError):
-        return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc))
+    if isinstance(exc, (ConversationNotFoundError, BatchNotFoundError)):
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=exc.detail)
     if isinstance(exc, ModelInitError):
         return HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(exc)
         )
+    if isinstance(exc, ConversationLostError):
+        return HTTPException(status_code=status.HTTP_410_GONE, detail=exc.detail)
+    if isinstance(
+        exc, (InferenceQueueFullError, SessionCapacityError, WorkerUnavailableError)
+    ):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=exc.detail,
+            headers={"Retry-After": "1"},
+        )
+    if isinstance(exc, RetrievalDisabledError):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=exc.detail
+        )
     return HTTPException(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(exc)
     )
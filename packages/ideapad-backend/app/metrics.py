@@ -0,0 +1,271 @@
+"""Prometheus metrics: per-stage timings of the inference path and resource gauges"""
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# API endpoint the current work is done for. Set per request by the metrics
+# middleware and carried into inference worker threads with the request's context
+current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="none")
+
+STAGE_SECONDS = Histogram(
+    "ideapad_stage_seconds",
+    "Time spent in each stage of the inference path: queue_wait, tokenize, "
+    "kv_swap, prefill, decode, postprocess, load, warm_up and embed",
+    ["model", "endpoint", "stage"],
+    buckets=(
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+    ),
+)
+
+TOKENS = Counter(
+    "ideapad_tokens",
+    "Tokens evaluated by llama.cpp, by phase: prefill (prompt) or decode",
+    ["model", "endpoint", "phase"],
+)
+
+TOKENS_PER_SECOND = Gauge(
+    "ideapad_tokens_per_second",
+    "Prefill and decode throughput of the most recent generation",
+    ["model", "phase"],
+)
+
+# Tokenizer time of the generation running on this thread, see timed_tokenize
+_tokenize_seconds = threading.local()
+
+
+class GenerationTimer:
+    """
+    Collects the stage durations of one generation and records them together,
+    labeled with the model and the endpoint that asked for it.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.endpoint = current_endpoint.get()
+        self.started = time.perf_counter()
+        self.seconds: dict[str, float] = {}
+        self.tokens: dict[str, int] = {}
+        _tokenize_seconds.value = 0.0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def add_tokens(self, phase: str, count: int):
+        self.tokens[phase] = self.tokens.get(phase, 0) + count
+
+    def finish(self, postprocess: bool = True):
+        """
+        Record every stage. With postprocess, the time not accounted for by
+        another stage (sampling, detokenizing, assembling the response) is
+        recorded as "postprocess".
+        """
+        self.add("tokenize", getattr(_tokenize_seconds, "value", 0.0))
+        _tokenize_seconds.__dict__.pop("value", None)
+        if postprocess:
+            total = time.perf_counter() - self.started
+            self.seconds["postprocess"] = max(total - sum(self.seconds.values()), 0.0)
+        for stage, seconds in self.seconds.items():
+            STAGE_SECONDS.labels(self.model, self.endpoint, stage).observe(seconds)
+        for phase, count in self.tokens.items():
+            TOKENS.labels(self.model, self.endpoint, phase).inc(count)
+            seconds = self.seconds.get(phase, 0.0)
+            if count and seconds > 0:
+                TOKENS_PER_SECOND.labels(self.model, phase).set(count / seconds)
+
+
+def timed_tokenize(tokenize):
+    """
+    Wrap a tokenizer so calls made on a thread with a running GenerationTimer
+    count towards its "tokenize" stage; llama.cpp tokenizes inside
+    create_chat_completion, where it cannot be timed from outside.
+    """
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return tokenize(*args, **kwargs)
+        finally:
+            if hasattr(_tokenize_seconds, "value"):
+                _tokenize_seconds.value += time.perf_counter() - started
+
+    return wrapper
+
+
+def observe_stage(
+    model: str, stage: str, seconds: float, endpoint: Optional[str] = None
+):
+    """
+    Record a single stage outside of a generation, e.g. queue wait or model load.
+    """
+    STAGE_SECONDS.labels(model, endpoint or current_endpoint.get(), stage).observe(
+        seconds
+    )
+
+
+class LlamaPerf:
+    """
+    Cumulative llama.cpp perf counters of one context. llama.cpp resets its own
+    counters now and then (e.g. when decoding restarts on an empty KV cache),
+    so deltas are accumulated here to keep the totals monotonic.
+    """
+
+    FIELDS = ("t_p_eval_ms", "t_eval_ms", "n_p_eval", "n_eval")
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self.totals = dict.fromkeys(self.FIELDS, 0)
+        self.load_ms = 0.0
+        self._last = self._read()
+
+    def update(self) -> dict[str, float]:
+        """
+        Read the counters and return what changed since the last update.
+        Must not run concurrently with a decode on the same context.
+        """
+        current = self._read()
+        last = self._last
+        if any(current[f] < last[f] for f in self.FIELDS):
+            last = dict.fromkeys(self.FIELDS, 0)
+        delta = {f: current[f] - last[f] for f in self.FIELDS}
+        for f in self.FIELDS:
+            self.totals[f] += delta[f]
+        self._last = current
+        return delta
+
+    def _read(self) -> dict[str, float]:
+        import llama_cpp
+
+        data = llama_cpp.llama_perf_context(self._ctx)
+        self.load_ms = data.t_load_ms
+        return {f: getattr(data, f) for f in self.FIELDS}
+
+
+class _StateCollector:
+    """
+    Reads sessions, resident models, queues, KV-cache occupancy and llama.cpp's
+    own counters at scrape time, so none of them has to be kept in sync.
+    """
+
+    def describe(self):
+        # Keeps registration from calling collect() while modules still import
+        return []
+
+    def collect(self):
+        from app.api.session_manager import session_store
+
+        sessions = session_store.stats()
+        yield GaugeMetricFamily(
+            "ideapad_active_sessions", "Open conversations", value=sessions["sessions"]
+        )
+        yield GaugeMetricFamily(
+            "ideapad_session_memory_bytes",
+            "Estimated memory held by open conversations",
+            value=sessions["memory_bytes"],
+        )
+
+        # The model stack is imported on first use; until then nothing is loaded
+        registry_module = sys.modules.get("app.models.model_registry")
+        models = registry_module.model_registry.resident() if registry_module else []
+        yield GaugeMetricFamily(
+            "ideapad_resident_models", "Models loaded in memory", value=len(models)
+        )
+
+        refs = GaugeMetricFamily(
+            "ideapad_model_refs", "Conversations holding each model", labels=["model"]
+        )
+        queue_depth = GaugeMetricFamily(
+            "ideapad_queue_depth", "Requests waiting for a model", labels=["model"]
+        )
+        kv_used = GaugeMetricFamily(
+            "ideapad_kv_cache_used_tokens",
+            "Tokens held in the KV cache",
+            labels=["model", "context"],
+        )
+        kv_capacity = GaugeMetricFamily(
+            "ideapad_kv_cache_capacity_tokens",
+            "KV cache size in tokens",
+            labels=["model", "context"],
+        )
+        perf = {
+            field: CounterMetricFamily(name, help_text, labels=["model", "context"])
+            for field, name, help_text in (
+                (
+                    "t_p_eval_ms",
+                    "ideapad_llama_prompt_eval_seconds",
+                    "llama.cpp prompt evaluation time",
+                ),
+                (
+                    "t_eval_ms",
+                    "ideapad_llama_eval_seconds",
+                    "llama.cpp token generation time",
+                ),
+                (
+                    "n_p_eval",
+                    "ideapad_llama_prompt_eval_tokens",
+                    "Prompt tokens evaluated by llama.cpp",
+                ),
+                (
+                    "n_eval",
+                    "ideapad_llama_eval_tokens",
+                    "Tokens generated by llama.cpp",
+                ),
+            )
+        }
+        load = GaugeMetricFamily(
+            "ideapad_llama_load_seconds", "llama.cpp model load time", labels=["model"]
+        )
+        draft_tokens = CounterMetricFamily(
+            "ideapad_speculative_draft_tokens",
+            "Speculative draft tokens the model accepted or rejected",
+            labels=["model", "outcome"],
+        )
+
+        for refcount, model in models:
+            name = model.name
+            refs.add_metric([name], refcount)
+            queue_depth.add_metric([name], model.executor.stats()["queue_depth"])
+            for context, (used, capacity) in model.kv_cache_usage().items():
+                kv_used.add_metric([name, context], used)
+                kv_capacity.add_metric([name, context], capacity)
+            for context, timings in model.llama_timings().items():
+                for field, family in perf.items():
+                    value = timings[field]
+                    if field.startswith("t_"):
+                        value /= 1000
+                    family.add_metric([name, context], value)
+                if context == "main":
+                    load.add_metric([name], timings["load_ms"] / 1000)
+            if getattr(model, "speculative", None) is not None:
+                stats = model.speculative.stats()
+                accepted = stats["accepted_tokens"]
+                draft_tokens.add_metric([name, "accepted"], accepted)
+                draft_tokens.add_metric(
+                    [name, "rejected"], stats["proposed_tokens"] - accepted
+                )
+
+        yield refs
+        yield queue_depth
+        yield kv_used
+        yield kv_capacity
+        yield from perf.values()
+        yield load
+        yield draft_tokens
+
+
+REGISTRY.register(_StateCollector())
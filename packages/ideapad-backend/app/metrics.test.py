@@ -0,0 +1,90 @@
+"""
+Unit tests for the inference metrics.
+"""
+
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+from app.metrics import (
+    REGISTRY,
+    GenerationTimer,
+    LlamaPerf,
+    current_endpoint,
+    timed_tokenize,
+)
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestGenerationTimer(unittest.TestCase):
+    def test_stages_are_recorded_with_endpoint(self):
+        token = current_endpoint.set("/test")
+        self.addCleanup(current_endpoint.reset, token)
+        labels = {"model": "timer-test", "endpoint": "/test"}
+        tokenize = timed_tokenize(lambda text: text.split())
+
+        timer = GenerationTimer("timer-test")
+        tokenize("a b c")
+        timer.add("decode", 0.002)
+        timer.add_tokens("decode", 10)
+        time.sleep(0.02)
+        timer.finish()
+
+        self.assertEqual(
+            _sample("ideapad_stage_seconds_sum", stage="decode", **labels), 0.002
+        )
+        self.assertGreater(
+            _sample("ideapad_stage_seconds_sum", stage="tokenize", **labels), 0
+        )
+        # Time not covered by another stage counts as postprocess
+        self.assertGreater(
+            _sample("ideapad_stage_seconds_sum", stage="postprocess", **labels), 0
+        )
+        self.assertEqual(_sample("ideapad_tokens_total", phase="decode", **labels), 10)
+        self.assertEqual(
+            _sample("ideapad_tokens_per_second", model="timer-test", phase="decode"),
+            5000,
+        )
+
+    def test_tokenize_outside_a_generation_is_not_counted(self):
+        tokenize = timed_tokenize(lambda text: text.split())
+        tokenize("before")
+        timer = GenerationTimer("idle-test")
+        timer.finish(postprocess=False)
+        self.assertEqual(timer.seconds["tokenize"], 0)
+
+
+class TestLlamaPerf(unittest.TestCase):
+    def test_totals_survive_llama_resets(self):
+        readings = iter(
+            [
+                (0, 0, 1, 1),
+                (10, 20, 5, 40),
+                (15, 30, 6, 50),
+                (2, 4, 1, 2),  # llama.cpp reset its counters
+            ]
+        )
+
+        def perf_context(ctx):
+            t_p, t_e, n_p, n_e = next(readings)
+            return SimpleNamespace(
+                t_p_eval_ms=t_p, t_eval_ms=t_e, n_p_eval=n_p, n_eval=n_e, t_load_ms=3
+            )
+
+        with patch("llama_cpp.llama_perf_context", side_effect=perf_context):
+            perf = LlamaPerf(ctx=None)
+            perf.update()
+            self.assertEqual(perf.update()["n_eval"], 10)
+            self.assertEqual(perf.update()["n_eval"], 2)
+
+        self.assertEqual(
+            perf.totals,
+            {"t_p_eval_ms": 17, "t_eval_ms": 34, "n_p_eval": 6, "n_eval": 51},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+"""Measure llama.cpp thread, batch and KV-cache settings on this machine and keep the fastest"""
+
+import json
+import os
+import platform
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from app.types import ModelConfig
+
+DEFAULT_PROFILE_PATH = Path("~/.cache/ideapad-backend/tuning.json")
+
+# Settings a tuning profile overrides in ModelConfig
+TUNED_FIELDS = ("num_threads", "n_threads_batch", "n_batch", "kv_cache_type")
+
+KV_CACHE_TYPES = {"f16": 1, "q8_0": 8, "q4_0": 2}  # ggml type ids
+
+
+def cpu_signature() -> str:
+    """
+    Identify the host CPU: architecture, model name and logical core count.
+    """
+    name = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    name = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return f"{platform.machine()}|{name}|{os.cpu_count()}"
+
+
+def thread_candidates(cpu_count: Optional[int] = None) -> list[int]:
+    """
+    Thread counts worth trying: 1, 2, every multiple of four up to the number
+    of logical cores, and half and all of them.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    candidates = {1, 2, cpu_count, max(cpu_count // 2, 1)}
+    candidates.update(range(4, cpu_count + 1, 4))
+    return sorted(c for c in candidates if c <= cpu_count)
+
+
+class TuningStore:
+    """
+    JSON file of tuning profiles keyed by model fingerprint and CPU signature.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path or DEFAULT_PROFILE_PATH).expanduser()
+        self._lock = threading.Lock()
+
+    def lookup(self, fingerprint: str, cpu: str) -> Optional[dict[str, Any]]:
+        if not self.path.exists():
+            return None
+        return self._read().get(f"{fingerprint}|{cpu}")
+
+    def save(self, fingerprint: str, cpu: str, profile: dict[str, Any]):
+        with self._lock:
+            profiles = self._read()
+            profiles[f"{fingerprint}|{cpu}"] = profile
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(profiles, f, indent=2)
+            os.replace(tmp, self.path)
+
+    def _read(self) -> dict[str, Any]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+def apply_profile(config: ModelConfig, model_path: str) -> ModelConfig:
+    """
+    Return config with the saved profile for this model and CPU applied, or
+    config unchanged if autotune is off or the model was never tuned here.
+    """
+    if not config.autotune:
+        return config
+    store = TuningStore(config.tuning_profile_path)
+    if not store.path.exists():
+        return config
+    from app.models.response_cache import model_fingerprint
+
+    profile = store.lookup(model_fingerprint(model_path), cpu_signature())
+    if profile is None:
+        return config
+    print("Applying tuning profile:", {k: profile[k] for k in TUNED_FIELDS})
+    return config.model_copy(update={k: profile[k] for k in TUNED_FIELDS})
+
+
+def _measure(
+    llama,
+    n_threads: int,
+    n_threads_batch: int,
+    n_batch: int,
+    kv_cache_type: str,
+    prompt_tokens: int,
+    decode_tokens: int,
+) -> tuple[float, float]:
+    """
+    Prefill and decode throughput (tokens/s) of one context configuration,
+    created on the already loaded model so the weights are read only once.
+    """
+    import llama_cpp
+
+    params = llama_cpp.llama_context_default_params()
+    params.n_ctx = prompt_tokens + decode_tokens + 8
+    params.n_batch = n_batch
+    params.n_ubatch = n_batch
+    params.n_threads = n_threads
+    params.n_threads_batch = n_threads_batch
+    params.type_k = KV_CACHE_TYPES[kv_cache_type]
+    params.type_v = KV_CACHE_TYPES[kv_cache_type]
+    if kv_cache_type != "f16":
+        # A quantized V cache needs flash attention
+        params.flash_attn_type = llama_cpp.LLAMA_FLASH_ATTN_TYPE_ENABLED
+    ctx = llama_cpp.llama_init_from_model(llama.model, params)
+    if ctx is None:
+        raise RuntimeError(f"Could not create a context with {kv_cache_type} KV cache")
+    batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+    token = llama.token_bos()
+
+    def decode(start: int, count: int):
+        batch.n_tokens = count
+        for i in range(count):
+            batch.token[i] = token
+            batch.pos[i] = start + i
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = 0
+            batch.logits[i] = i == count - 1
+        if llama_cpp.llama_decode(ctx, batch) != 0:
+            raise RuntimeError("llama_decode failed while tuning")
+        llama_cpp.llama_synchronize(ctx)
+
+    try:
+        started = time.perf_counter()
+        for start in range(0, prompt_tokens, n_batch):
+            decode(start, min(n_batch, prompt_tokens - start))
+        prefill = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(decode_tokens):
+            decode(prompt_tokens + i, 1)
+        generation = time.perf_counter() - started
+    finally:
+        llama_cpp.llama_batch_free(batch)
+        llama_cpp.llama_free(ctx)
+    return prompt_tokens / prefill, decode_tokens / generation
+
+
+def tune(
+    config: ModelConfig,
+    threads: Optional[Iterable[int]] = None,
+    batch_sizes: Iterable[int] = (128, 256, 512),
+    kv_cache_types: Iterable[str] = tuple(KV_CACHE_TYPES),
+    prompt_tokens: int = 256,
+    decode_tokens: int = 32,
+    save: bool = True,
+) -> dict[str, Any]:
+    """
+    Find the fastest settings for config's model on this machine and, with
+    save, store them so later loads pick them up. Decode speed depends on
+    num_threads and prefill speed on n_threads_batch and n_batch, so each is
+    tuned on its own axis instead of over the full cross product; KV cache
+    types are then compared with the winners. Models that are already loaded
+    keep their settings until they are loaded again.
+    """
+    from llama_cpp import Llama
+    from app.models.model_definition import resolve_model_path
+    from app.models.response_cache import model_fingerprint
+
+    model_path = resolve_model_path(config.model_path)
+    threads = list(threads or thread_candidates())
+    llama = Llama(
+        model_path=model_path,
+        n_ctx=prompt_tokens + decode_tokens + 8,
+        use_mmap=config.use_mmap,
+        verbose=False,
+    )
+    try:
+        # One untimed run faults in the mmap'd weights
+        _measure(llama, threads[-1], threads[-1], 512, "f16", prompt_tokens, 4)
+
+        def run(t, tb, nb, kv):
+            return _measure(llama, t, tb, nb, kv, prompt_tokens, decode_tokens)
+
+        decode_speed = {t: run(t, t, 512, "f16")[1] for t in threads}
+        best_threads = max(decode_speed, key=decode_speed.get)
+
+        prefill_speed = {
+            (tb, nb): run(best_threads, tb, nb, "f16")[0]
+            for tb in threads
+            for nb in batch_sizes
+        }
+        best_threads_batch, best_batch = max(prefill_speed, key=prefill_speed.get)
+
+        results = {}
+        for kv in kv_cache_types:
+            try:
+                results[kv] = run(best_threads, best_threads_batch, best_batch, kv)
+            except RuntimeError as e:
+                print(f"Skipping {kv} KV cache: {e}")
+        # Decode dominates interactive latency, so rank by it
+        best_kv = max(results, key=lambda kv: results[kv][1])
+    finally:
+        llama.close()
+
+    profile = {
+        "num_threads": best_threads,
+        "n_threads_batch": best_threads_batch,
+        "n_batch": best_batch,
+        "kv_cache_type": best_kv,
+        "prefill_tokens_per_second": round(results[best_kv][0], 2),
+        "decode_tokens_per_second": round(results[best_kv][1], 2),
+        "model_path": model_path,
+        "cpu": cpu_signature(),
+        "tuned_at": datetime.now(timezone.utc).isoformat(),
+    }
+    if save:
+        TuningStore(config.tuning_profile_path).save(
+            model_fingerprint(model_path), profile["cpu"], profile
+        )
+    return profile
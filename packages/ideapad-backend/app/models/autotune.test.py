@@ -0,0 +1,51 @@
+"""
+Unit tests for tuning profile storage and lookup.
+"""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from app.models.autotune import TuningStore, apply_profile, thread_candidates
+from app.types import ModelConfig
+
+PROFILE = {"num_threads": 8, "n_threads_batch": 12, "n_batch": 256, "kv_cache_type": "q8_0"}
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "tuning.json")
+        patcher = patch("app.models.response_cache.model_fingerprint", return_value="m")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_thread_candidates_stay_within_core_count(self):
+        self.assertEqual(thread_candidates(12), [1, 2, 4, 6, 8, 12])
+        self.assertEqual(thread_candidates(1), [1])
+
+    def test_profile_round_trip(self):
+        store = TuningStore(self.path)
+        store.save("m", "cpu", PROFILE)
+        self.assertEqual(TuningStore(self.path).lookup("m", "cpu"), PROFILE)
+        self.assertIsNone(store.lookup("m", "other-cpu"))
+
+    def test_saved_profile_overrides_config(self):
+        config = ModelConfig(tuning_profile_path=self.path)
+        with patch("app.models.autotune.cpu_signature", return_value="cpu"):
+            self.assertIs(apply_profile(config, "model.gguf"), config)
+            TuningStore(self.path).save("m", "cpu", PROFILE)
+            tuned = apply_profile(config, "model.gguf")
+        self.assertEqual(tuned.num_threads, 8)
+        self.assertEqual(tuned.kv_cache_type, "q8_0")
+
+    def test_autotune_off_ignores_profile(self):
+        TuningStore(self.path).save("m", "cpu", PROFILE)
+        config = ModelConfig(tuning_profile_path=self.path, autotune=False)
+        with patch("app.models.autotune.cpu_signature", return_value="cpu"):
+            self.assertIs(apply_profile(config, "model.gguf"), config)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,558 @@
+"""Continuous batching: decode many conversations together in one shared llama.cpp context"""
+
+import codecs
+import collections
+import ctypes
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+from app.metrics import LlamaPerf
+from app.models.grammar import CompiledGrammar
+from app.models.lora import AdapterSet, LoraCache
+
+
+class _Sequence:
+    """
+    One in-flight request: its prompt, sampling settings and decode progress.
+    """
+
+    def __init__(
+        self,
+        prompt_tokens: list[int],
+        max_tokens: int,
+        temperature: float,
+        stop: list[str],
+        seed: Optional[int],
+        events: Optional[queue.Queue] = None,
+        index: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+        adapters: AdapterSet = (),
+    ):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.stop = stop
+        self.grammar = grammar
+        # llama.cpp grammar state, allocated while the sequence is active
+        self.grammar_sampler = None
+        self.adapters = adapters
+        # Admissions of sequences with other adapters while this one waited
+        self.passed_over = 0
+        self.rng = np.random.default_rng(seed)
+        self.submitted_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.prefilled_at: Optional[float] = None
+
+        self.seq_id = -1
+        self.n_past = 0
+        self.next_token: Optional[int] = None
+        self.completion_tokens: list[int] = []
+        self.text = ""
+        self.emitted = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        # Position in a submit_batch call; batch sequences share one queue and
+        # report only their final result
+        self.index = index
+        self.events: queue.Queue = events if events is not None else queue.Queue()
+        self.cancelled = threading.Event()
+        self.finished = False
+
+    @property
+    def prefilling(self) -> bool:
+        return self.n_past < len(self.prompt_tokens)
+
+
+class BatchHandle:
+    """
+    The sequences of one submit_batch call. Results arrive in the order the
+    sequences finish: the same "done" event a streamed sequence ends with,
+    plus its "index" and whole "text", or {"type": "error", "index", "error"}.
+    """
+
+    def __init__(
+        self,
+        sequences: list[_Sequence],
+        events: queue.Queue,
+        wake: threading.Event,
+        on_result: Optional[Callable[[dict], dict]] = None,
+    ):
+        self._sequences = sequences
+        self._events = events
+        self._wake = wake
+        self._on_result = on_result
+        self._remaining = len(sequences)
+
+    def __len__(self) -> int:
+        return len(self._sequences)
+
+    def next_result(self) -> Optional[dict]:
+        """
+        Block until another sequence finishes and return its result, or None
+        once every sequence has reported.
+        """
+        if self._remaining == 0:
+            return None
+        event = self._events.get()
+        self._remaining -= 1
+        if self._on_result is not None and event["type"] == "done":
+            event = self._on_result(event)
+        return event
+
+    def cancel(self, indices: Optional[Iterable[int]] = None) -> list[int]:
+        """
+        Stop the given sequences, or all of them, at the next step. Each still
+        reports a result, with finish_reason "cancelled" and the text decoded
+        so far. Returns the indices that were still running.
+        """
+        if indices is None:
+            indices = range(len(self._sequences))
+        cancelled = []
+        for index in indices:
+            if not 0 <= index < len(self._sequences):
+                continue
+            seq = self._sequences[index]
+            if seq.finished or seq.cancelled.is_set():
+                continue
+            seq.cancelled.set()
+            cancelled.append(index)
+        if cancelled:
+            self._wake.set()
+        return cancelled
+
+
+class BatchScheduler:
+    """
+    Runs every active request as its own sequence in a single llama.cpp context
+    created from an already loaded model. Each step packs the next token of every
+    decoding sequence, plus prompt chunks of newly admitted ones, into one
+    llama_decode call. Requests join and leave between steps.
+    The context decodes with one set of LoRA adapters at a time, so waiting
+    sequences with the applied set are admitted first; the set changes once
+    the active sequences drain, and a sequence with another set is passed
+    over at most max_sequences times before admissions stop to let it in.
+    """
+
+    def __init__(
+        self,
+        llama: Llama,
+        n_ctx: int,
+        max_sequences: int = 4,
+        n_batch: int = 512,
+        n_threads: Optional[int] = None,
+        n_threads_batch: Optional[int] = None,
+        top_k: int = 40,
+        top_p: float = 0.95,
+        pause: Optional[Callable[[], None]] = None,
+        lora: Optional[LoraCache] = None,
+    ):
+        self._llama = llama
+        self.n_ctx = n_ctx
+        self.max_sequences = max_sequences
+        self.n_batch = max(n_batch, max_sequences)
+        self.top_k = top_k
+        self.top_p = top_p
+        # Called before every step; blocks while higher-priority work runs
+        self._pause = pause
+        self._lora = lora
+        self._adapters: AdapterSet = ()
+        self.adapter_switches = 0
+
+        params = llama_cpp.llama_context_default_params()
+        # Every sequence gets its own n_ctx worth of KV cache
+        params.n_ctx = n_ctx * max_sequences
+        params.n_batch = self.n_batch
+        params.n_ubatch = self.n_batch
+        params.n_seq_max = max_sequences
+        params.no_perf = False
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads_batch or n_threads
+        self._ctx = llama_cpp.llama_init_from_model(llama.model, params)
+        if self._ctx is None:
+            raise RuntimeError("Failed to create batched llama context")
+        self._memory = llama_cpp.llama_get_memory(self._ctx)
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+        self._vocab = llama_cpp.llama_model_get_vocab(llama.model)
+        self._n_vocab = llama.n_vocab()
+        self._piece_buf = (ctypes.c_char * 64)()
+        # Every token with its logit, for grammar samplers to mask
+        self._candidates = np.zeros(
+            self._n_vocab,
+            dtype=np.dtype(
+                [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
+            ),
+        )
+        self._candidates["id"] = np.arange(self._n_vocab)
+        self._candidates_p = self._candidates.ctypes.data_as(
+            llama_cpp.llama_token_data_p
+        )
+        # llama.cpp's perf counters, refreshed by the scheduling thread
+        self.llama_perf = LlamaPerf(self._ctx)
+
+        self._pending: "queue.Queue[_Sequence]" = queue.Queue()
+        # Pending sequences the scheduling thread has taken, oldest first
+        self._waiting: "collections.deque[_Sequence]" = collections.deque()
+        self._active: dict[int, _Sequence] = {}
+        self._free_ids = list(range(max_sequences))
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._loop, name="batch-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt_tokens: list[int],
+        max_tokens: int,
+        temperature: float,
+        stop: Optional[list[str]] = None,
+        seed: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+        adapters: AdapterSet = (),
+    ) -> Iterator[dict]:
+        """
+        Queue a tokenized prompt and return an iterator over its events, in the
+        same shape as ModelDefinition.generate_stream. Closing the iterator early
+        retires the sequence at the next step. With a grammar, only tokens it
+        allows are sampled; LoRA adapters are applied while it decodes.
+        """
+        if len(prompt_tokens) >= self.n_ctx:
+            raise ValueError("Prompt does not fit in the context window")
+        self._check_adapters(adapters)
+        seq = _Sequence(
+            prompt_tokens,
+            max_tokens,
+            temperature,
+            stop or [],
+            seed,
+            grammar=grammar,
+            adapters=adapters,
+        )
+        self._pending.put(seq)
+        self._wake.set()
+        return self._events(seq)
+
+    def submit_batch(
+        self,
+        prompts_tokens: list[list[int]],
+        max_tokens: int,
+        temperature: float,
+        stop: Optional[list[str]] = None,
+        seed: Optional[int] = None,
+        on_result: Optional[Callable[[dict], dict]] = None,
+        grammar: Optional[CompiledGrammar] = None,
+        adapters: AdapterSet = (),
+    ) -> BatchHandle:
+        """
+        Queue independent prompts with shared sampling settings. They are
+        admitted as sequence slots free up, prefilled together and decoded
+        interleaved; each result is reported as soon as its sequence finishes.
+        on_result maps every "done" result before it is returned.
+        """
+        if any(len(tokens) >= self.n_ctx for tokens in prompts_tokens):
+            raise ValueError("Prompt does not fit in the context window")
+        self._check_adapters(adapters)
+        events: queue.Queue = queue.Queue()
+        sequences = [
+            _Sequence(
+                tokens,
+                max_tokens,
+                temperature,
+                stop or [],
+                seed,
+                events,
+                index,
+                grammar=grammar,
+                adapters=adapters,
+            )
+            for index, tokens in enumerate(prompts_tokens)
+        ]
+        for seq in sequences:
+            self._pending.put(seq)
+        self._wake.set()
+        return BatchHandle(sequences, events, self._wake, on_result)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "active_sequences": len(self._active),
+            "pending_sequences": self._pending.qsize() + len(self._waiting),
+            "max_sequences": self.max_sequences,
+            "adapter_switches": self.adapter_switches,
+        }
+
+    def kv_cache_usage(self) -> tuple[int, int]:
+        """
+        Tokens held by active sequences, and the KV cache size in tokens.
+        """
+        used = sum(seq.n_past for seq in list(self._active.values()))
+        return used, self.n_ctx * self.max_sequences
+
+    def close(self):
+        """
+        Stop the scheduling thread and free the batched context.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        for seq in self._active.values():
+            self._free_grammar(seq)
+        if self._lora is not None:
+            self._lora.forget(self._ctx)
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+
+    def _events(self, seq: _Sequence) -> Iterator[dict]:
+        try:
+            while True:
+                event = seq.events.get()
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+                if event["type"] == "done":
+                    return
+        finally:
+            seq.cancelled.set()
+
+    def _loop(self):
+        while not self._closed:
+            self._admit()
+            if not self._active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            if self._pause is not None:
+                self._pause()
+            try:
+                self._step()
+            except Exception as e:
+                for seq in list(self._active.values()):
+                    self._retire(seq, error=e)
+
+    def _check_adapters(self, adapters: AdapterSet):
+        if adapters and self._lora is None:
+            raise ValueError("LoRA adapters need a LoraCache")
+
+    def _admit(self):
+        while True:
+            try:
+                self._waiting.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        # Waiting sequences that need other adapters than the applied ones
+        held: list[_Sequence] = []
+        while self._free_ids and self._waiting:
+            seq = self._waiting.popleft()
+            if seq.cancelled.is_set():
+                self._report(seq, self._done_event(seq, "cancelled"))
+                continue
+            if seq.adapters != self._adapters:
+                if self._active or held:
+                    held.append(seq)
+                    continue
+                try:
+                    self._lora.apply(self._ctx, seq.adapters)
+                except Exception as e:
+                    self._report_error(seq, e)
+                    continue
+                self._adapters = seq.adapters
+                self.adapter_switches += 1
+            elif held:
+                if held[0].passed_over >= self.max_sequences:
+                    # Admit nothing more, so the active sequences drain
+                    held.append(seq)
+                    break
+                held[0].passed_over += 1
+            seq.seq_id = self._free_ids.pop()
+            seq.admitted_at = time.perf_counter()
+            if seq.grammar is not None:
+                seq.grammar_sampler = seq.grammar.new_sampler()
+            self._active[seq.seq_id] = seq
+        self._waiting.extendleft(reversed(held))
+
+    def _step(self):
+        batch = self._batch
+        batch.n_tokens = 0
+        sampled: list[tuple[_Sequence, int]] = []
+
+        for seq in list(self._active.values()):
+            if seq.cancelled.is_set():
+                self._retire(seq, finish_reason="cancelled")
+            elif not seq.prefilling:
+                sampled.append((seq, batch.n_tokens))
+                self._add(seq.next_token, seq.n_past, seq.seq_id, True)
+                seq.n_past += 1
+
+        # Fill the rest of the batch with prompt chunks of admitted sequences
+        for seq in list(self._active.values()):
+            if not seq.prefilling:
+                continue
+            room = self.n_batch - batch.n_tokens
+            if room <= 0:
+                break
+            chunk = seq.prompt_tokens[seq.n_past : seq.n_past + room]
+            for i, token in enumerate(chunk):
+                last = seq.n_past + i == len(seq.prompt_tokens) - 1
+                if last:
+                    sampled.append((seq, batch.n_tokens))
+                self._add(token, seq.n_past + i, seq.seq_id, last)
+            seq.n_past += len(chunk)
+
+        if batch.n_tokens == 0:
+            return
+        if llama_cpp.llama_decode(self._ctx, batch) != 0:
+            raise RuntimeError("llama_decode failed for batched step")
+
+        for seq, index in sampled:
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(self._ctx, index),
+                shape=(self._n_vocab,),
+            )
+            self._advance(seq, self._sample(seq, logits))
+        self.llama_perf.update()
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool):
+        batch = self._batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+        batch.n_tokens += 1
+
+    def _sample(self, seq: _Sequence, logits: np.ndarray) -> int:
+        if seq.grammar_sampler is not None:
+            logits = self._constrain(seq.grammar_sampler, logits)
+        if seq.temperature <= 0:
+            return int(np.argmax(logits))
+        k = min(self.top_k, logits.size) if self.top_k > 0 else logits.size
+        candidates = np.argpartition(logits, -k)[-k:]
+        scaled = logits[candidates] / seq.temperature
+        order = np.argsort(scaled)[::-1]
+        candidates, scaled = candidates[order], scaled[order]
+        probs = np.exp(scaled - scaled[0])
+        probs /= probs.sum()
+        keep = int(np.searchsorted(np.cumsum(probs), self.top_p)) + 1
+        probs = probs[:keep] / probs[:keep].sum()
+        return int(seq.rng.choice(candidates[:keep], p=probs))
+
+    def _constrain(self, grammar_sampler, logits: np.ndarray) -> np.ndarray:
+        """
+        The logits with every token the grammar does not allow next at -inf.
+        """
+        self._candidates["logit"] = logits
+        candidates = llama_cpp.llama_token_data_array(
+            data=self._candidates_p, size=self._n_vocab, selected=-1, sorted=False
+        )
+        llama_cpp.llama_sampler_apply(grammar_sampler, ctypes.byref(candidates))
+        return self._candidates["logit"]
+
+    def _advance(self, seq: _Sequence, token: int):
+        if seq.prefilled_at is None:
+            seq.prefilled_at = time.perf_counter()
+        if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+            self._retire(seq, finish_reason="stop")
+            return
+
+        if seq.grammar_sampler is not None:
+            llama_cpp.llama_sampler_accept(seq.grammar_sampler, token)
+        seq.completion_tokens.append(token)
+        seq.next_token = token
+        seq.text += seq.decoder.decode(self._piece(token))
+
+        for stop in seq.stop:
+            cut = seq.text.find(stop)
+            if cut != -1:
+                seq.text = seq.text[:cut]
+                self._emit_text(seq)
+                self._retire(seq, finish_reason="stop")
+                return
+
+        # Hold back text that could still turn into a stop sequence
+        hold = max((len(stop) - 1 for stop in seq.stop), default=0)
+        self._emit_text(seq, len(seq.text) - hold)
+
+        if len(seq.completion_tokens) >= seq.max_tokens:
+            self._emit_text(seq)
+            self._retire(seq, finish_reason="length")
+        elif seq.n_past + 1 >= self.n_ctx:
+            self._emit_text(seq)
+            self._retire(seq, finish_reason="length")
+
+    def _piece(self, token: int) -> bytes:
+        size = llama_cpp.llama_token_to_piece(
+            self._vocab, token, self._piece_buf, len(self._piece_buf), 0, False
+        )
+        return bytes(self._piece_buf[:size])
+
+    def _emit_text(self, seq: _Sequence, upto: Optional[int] = None):
+        if seq.index is not None:
+            # Batch sequences report their whole text when they finish
+            return
+        end = len(seq.text) if upto is None else max(upto, seq.emitted)
+        if end > seq.emitted:
+            seq.events.put({"type": "token", "text": seq.text[seq.emitted : end]})
+            seq.emitted = end
+
+    def _retire(
+        self,
+        seq: _Sequence,
+        finish_reason: Optional[str] = None,
+        error: Optional[Exception] = None,
+    ):
+        self._active.pop(seq.seq_id, None)
+        llama_cpp.llama_memory_seq_rm(self._memory, seq.seq_id, -1, -1)
+        self._free_ids.append(seq.seq_id)
+        self._free_grammar(seq)
+        if error is not None:
+            self._report_error(seq, error)
+        else:
+            self._report(seq, self._done_event(seq, finish_reason))
+
+    def _report_error(self, seq: _Sequence, error: Exception):
+        if seq.index is not None:
+            error = {"type": "error", "index": seq.index, "error": error}
+        self._report(seq, error)
+
+    @staticmethod
+    def _free_grammar(seq: _Sequence):
+        if seq.grammar_sampler is not None:
+            llama_cpp.llama_sampler_free(seq.grammar_sampler)
+            seq.grammar_sampler = None
+
+    def _done_event(self, seq: _Sequence, finish_reason: Optional[str]) -> dict:
+        completion = len(seq.completion_tokens)
+        now = time.perf_counter()
+        admitted = seq.admitted_at or now
+        prefilled = seq.prefilled_at or now
+        event = {
+            "type": "done",
+            "finish_reason": finish_reason,
+            "usage": {
+                "prompt_tokens": len(seq.prompt_tokens),
+                "completion_tokens": completion,
+                "total_tokens": len(seq.prompt_tokens) + completion,
+            },
+            "timings": {
+                "batch_wait": admitted - seq.submitted_at,
+                "prefill": prefilled - admitted,
+                "decode": now - prefilled,
+            },
+        }
+        if seq.index is not None:
+            event["index"] = seq.index
+            event["text"] = seq.text
+        return event
+
+    def _report(self, seq: _Sequence, event):
+        seq.finished = True
+        seq.events.put(event)
@@ -0,0 +1,108 @@
+"""
+Unit tests for the results and cancellation of submit_batch, and for
+admitting sequences grouped by LoRA adapters.
+"""
+
+import collections
+import queue
+import threading
+import unittest
+from unittest.mock import MagicMock
+from app.models.batch_scheduler import BatchHandle, BatchScheduler, _Sequence
+
+
+class TestBatchHandle(unittest.TestCase):
+    def setUp(self):
+        self.events = queue.Queue()
+        self.wake = threading.Event()
+        self.sequences = [
+            _Sequence([1, 2], 8, 0.0, [], None, self.events, index)
+            for index in range(3)
+        ]
+        self.batch = BatchHandle(
+            self.sequences,
+            self.events,
+            self.wake,
+            on_result=lambda event: dict(event, seen=True),
+        )
+
+    def finish(self, index: int, finish_reason: str = "stop"):
+        self.sequences[index].finished = True
+        self.events.put(
+            {"type": "done", "index": index, "finish_reason": finish_reason}
+        )
+
+    def test_results_arrive_in_finishing_order(self):
+        self.finish(2)
+        self.finish(0)
+        self.events.put({"type": "error", "index": 1, "error": RuntimeError()})
+        results = [self.batch.next_result() for _ in range(3)]
+        self.assertEqual([r["index"] for r in results], [2, 0, 1])
+        self.assertTrue(results[0]["seen"])
+        self.assertNotIn("seen", results[2])
+        self.assertIsNone(self.batch.next_result())
+
+    def test_cancel_skips_finished_and_unknown_sequences(self):
+        self.finish(0)
+        self.assertEqual(self.batch.cancel([0, 1, 7]), [1])
+        self.assertTrue(self.sequences[1].cancelled.is_set())
+        self.assertTrue(self.wake.is_set())
+        self.assertEqual(self.batch.cancel(), [2])
+
+
+class TestAdapterGrouping(unittest.TestCase):
+    def setUp(self):
+        # Only the admission state; no llama context is needed
+        self.scheduler = BatchScheduler.__new__(BatchScheduler)
+        self.scheduler.max_sequences = 2
+        self.scheduler._lora = MagicMock()
+        self.scheduler._adapters = ()
+        self.scheduler.adapter_switches = 0
+        self.scheduler._pending = queue.Queue()
+        self.scheduler._waiting = collections.deque()
+        self.scheduler._active = {}
+        self.scheduler._free_ids = [0, 1]
+        self.scheduler._ctx = None
+
+    def submit(self, adapters) -> _Sequence:
+        seq = _Sequence([1, 2], 8, 0.0, [], None, adapters=adapters)
+        self.scheduler._pending.put(seq)
+        return seq
+
+    def finish(self, seq: _Sequence):
+        del self.scheduler._active[seq.seq_id]
+        self.scheduler._free_ids.append(seq.seq_id)
+
+    def test_same_adapters_run_together(self):
+        style, sql = (("style.gguf", 1.0),), (("sql.gguf", 1.0),)
+        a, b, c = self.submit(style), self.submit(sql), self.submit(style)
+        self.scheduler._admit()
+        # c overtakes b, which waits for the style sequences to drain
+        self.assertEqual(set(self.scheduler._active.values()), {a, c})
+        self.finish(a)
+        self.scheduler._admit()
+        self.assertEqual(set(self.scheduler._active.values()), {c})
+        self.finish(c)
+        self.scheduler._admit()
+        self.assertEqual(list(self.scheduler._active.values()), [b])
+        self.assertEqual(self.scheduler.adapter_switches, 2)
+
+    def test_waiting_sequence_is_passed_over_a_bounded_number_of_times(self):
+        style, sql = (("style.gguf", 1.0),), (("sql.gguf", 1.0),)
+        first = self.submit(style)
+        self.scheduler._admit()
+        waiting = self.submit(sql)
+        later = [self.submit(style) for _ in range(4)]
+        admitted = [first]
+        for _ in range(4):
+            self.scheduler._admit()
+            for seq in self.scheduler._active.values():
+                if seq not in admitted:
+                    admitted.append(seq)
+            # The oldest active sequence finishes every step
+            self.finish(next(iter(self.scheduler._active.values())))
+        # Two style sequences get ahead of it, then the active ones drain
+        self.assertEqual(admitted[:4], [first, later[0], later[1], waiting])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,358 @@
+"""Model catalog: GGUF header metadata of every model file in a directory, cached by mtime"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+from app.types import ModelConfig
+
+DEFAULT_CACHE_PATH = Path("~/.cache/ideapad-backend/catalog.json")
+
+# Second and later files of a split model belong to the first one
+_SPLIT_PART = re.compile(r"-(\d{5})-of-\d{5}\.gguf$")
+
+# GGUF value types: struct format of each fixed-size one
+_SCALARS = {
+    0: "<B",
+    1: "<b",
+    2: "<H",
+    3: "<h",
+    4: "<I",
+    5: "<i",
+    6: "<f",
+    7: "<?",
+    10: "<Q",
+    11: "<q",
+    12: "<d",
+}
+_STRING, _ARRAY = 8, 9
+
+# llama.cpp's general.file_type values
+FILE_TYPES = {
+    0: "F32",
+    1: "F16",
+    2: "Q4_0",
+    3: "Q4_1",
+    7: "Q8_0",
+    8: "Q5_0",
+    9: "Q5_1",
+    10: "Q2_K",
+    11: "Q3_K_S",
+    12: "Q3_K_M",
+    13: "Q3_K_L",
+    14: "Q4_K_S",
+    15: "Q4_K_M",
+    16: "Q5_K_S",
+    17: "Q5_K_M",
+    18: "Q6_K",
+    19: "IQ2_XXS",
+    20: "IQ2_XS",
+    21: "Q2_K_S",
+    22: "IQ3_XS",
+    23: "IQ3_XXS",
+    24: "IQ1_S",
+    25: "IQ4_NL",
+    26: "IQ3_S",
+    27: "IQ3_M",
+    28: "IQ2_S",
+    29: "IQ2_M",
+    30: "IQ4_XS",
+    31: "IQ1_M",
+    32: "BF16",
+    36: "TQ1_0",
+    37: "TQ2_0",
+}
+
+# Bytes per KV cache element for each kv_cache_type
+_KV_ELEMENT_BYTES = {"f16": 2.0, "q8_0": 34 / 32, "q4_0": 18 / 32}
+
+# Header strings longer than this (chat templates, licenses) are not kept
+_MAX_STRING = 256
+
+
+def resolve_model_path(raw_path_str: str) -> str:
+    """
+    Resolve a configured model path to an absolute path on disk.
+    Relative paths are resolved against the project root. Called for every
+    registry lookup, so it only resolves; loading logs the result.
+    """
+    raw_path = Path(raw_path_str or "models/default.gguf")
+    candidate = Path(raw_path)
+    # Always define project_root for later use
+    project_root = Path(__file__).resolve().parents[4]
+    # Resolve relative paths against project root
+    if not candidate.is_absolute():
+        candidate = (project_root / raw_path).expanduser()
+    else:
+        candidate = candidate.expanduser()
+    if not candidate.exists():
+        raise RuntimeError(
+            f"Model path does not exist: {candidate} (project root: {project_root})"
+        )
+    return str(candidate)
+
+
+def read_gguf_metadata(path: str) -> dict[str, Any]:
+    """
+    Read a GGUF file's header and tensor table, never its weights: the
+    file is memory-mapped and only the pages holding the header are touched.
+    Returns the scalar and short string key/values, plus the total number
+    of weights as "parameters". Raises ValueError if it is not a GGUF file.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:4] != b"GGUF":
+            raise ValueError(f"Not a GGUF file: {path}")
+        version, n_tensors, n_kv = struct.unpack_from("<IQQ", mm, 4)
+        if version < 2:
+            raise ValueError(f"Unsupported GGUF version {version}: {path}")
+        pos = 24
+        values: dict[str, Any] = {}
+        for _ in range(n_kv):
+            key, pos = _read_string(mm, pos)
+            (kind,) = struct.unpack_from("<I", mm, pos)
+            value, pos = _read_value(mm, pos + 4, kind)
+            if value is not None:
+                values[key] = value
+
+        parameters = 0
+        for _ in range(n_tensors):
+            _, pos = _read_string(mm, pos)
+            (n_dims,) = struct.unpack_from("<I", mm, pos)
+            dims = struct.unpack_from(f"<{n_dims}Q", mm, pos + 4)
+            # Dimensions, then the tensor type and data offset
+            pos += 4 + 8 * n_dims + 12
+            count = 1
+            for dim in dims:
+                count *= dim
+            parameters += count
+    values["parameters"] = parameters
+    return values
+
+
+def _read_string(mm: mmap.mmap, pos: int) -> tuple[str, int]:
+    (length,) = struct.unpack_from("<Q", mm, pos)
+    start = pos + 8
+    return mm[start : start + length].decode("utf-8", errors="replace"), start + length
+
+
+def _read_value(mm: mmap.mmap, pos: int, kind: int) -> tuple[Any, int]:
+    """
+    Decode one value at pos and return it with the position after it. Arrays
+    and long strings are skipped and come back as None.
+    """
+    if kind in _SCALARS:
+        fmt = _SCALARS[kind]
+        return struct.unpack_from(fmt, mm, pos)[0], pos + struct.calcsize(fmt)
+    if kind == _STRING:
+        (length,) = struct.unpack_from("<Q", mm, pos)
+        if length > _MAX_STRING:
+            return None, pos + 8 + length
+        return _read_string(mm, pos)
+    if kind == _ARRAY:
+        item_kind, count = struct.unpack_from("<IQ", mm, pos)
+        pos += 12
+        if item_kind in _SCALARS:
+            return None, pos + count * struct.calcsize(_SCALARS[item_kind])
+        if item_kind == _STRING:
+            # Vocabularies: only the length of each string is read
+            unpack = struct.Struct("<Q").unpack_from
+            for _ in range(count):
+                pos += 8 + unpack(mm, pos)[0]
+            return None, pos
+        for _ in range(count):
+            _, pos = _read_value(mm, pos, item_kind)
+        return None, pos
+    raise ValueError(f"Unknown GGUF value type {kind}")
+
+
+def summarize(path: str, values: dict[str, Any]) -> dict[str, Any]:
+    """
+    The catalog entry of a model from its header values.
+    """
+    arch = values.get("general.architecture")
+
+    def arch_value(name: str) -> Optional[Any]:
+        return values.get(f"{arch}.{name}")
+
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "name": values.get("general.name") or Path(path).stem,
+        "architecture": arch,
+        "parameters": values["parameters"],
+        "size_label": values.get("general.size_label")
+        or _count_label(values["parameters"]),
+        "quantization": FILE_TYPES.get(values.get("general.file_type")),
+        "context_length": arch_value("context_length"),
+        "embedding_length": arch_value("embedding_length"),
+        "block_count": arch_value("block_count"),
+        "head_count": arch_value("attention.head_count"),
+        "head_count_kv": arch_value("attention.head_count_kv"),
+        "key_length": arch_value("attention.key_length"),
+        "value_length": arch_value("attention.value_length"),
+        "file_size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _count_label(count: int) -> str:
+    for unit, scale in (("T", 1e12), ("B", 1e9), ("M", 1e6), ("K", 1e3)):
+        if count >= scale:
+            return f"{count / scale:.1f}{unit}"
+    return str(count)
+
+
+def estimate_memory_bytes(entry: dict[str, Any], n_ctx: int, kv_cache_type: str) -> int:
+    """
+    RAM a loaded model takes: its weights, all of them once paged in through
+    mmap, plus a KV cache of n_ctx tokens. Compute buffers are not counted.
+    """
+    layers, heads = entry.get("block_count"), entry.get("head_count")
+    embedding = entry.get("embedding_length")
+    if not (layers and heads and embedding):
+        return entry["file_size"]
+    heads_kv = entry.get("head_count_kv") or heads
+    key = entry.get("key_length") or embedding // heads
+    value = entry.get("value_length") or embedding // heads
+    kv_elements = n_ctx * layers * heads_kv * (key + value)
+    return entry["file_size"] + int(kv_elements * _KV_ELEMENT_BYTES[kv_cache_type])
+
+
+class ModelCatalog:
+    """
+    Every .gguf file under a models directory with its header metadata.
+    Metadata is cached in memory and in a JSON file, keyed by path and
+    checked against each file's size and mtime, so a listing only stats the
+    files and a header is read again only after its file changes.
+    """
+
+    def __init__(self, directory: str, cache_path: Optional[str] = None):
+        self.dir = Path(directory).expanduser()
+        self.cache_path = Path(cache_path or DEFAULT_CACHE_PATH).expanduser()
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict[str, Any]] = self._read_cache()
+        self.headers_read = 0
+
+    def scan(self) -> list[dict[str, Any]]:
+        """
+        Catalog entries of every model in the directory, sorted by name.
+        Files that are not valid GGUF are left out.
+        """
+        paths = [
+            str(path)
+            for path in self.dir.rglob("*.gguf")
+            if not self._is_later_split(path.name)
+        ]
+        with self._lock:
+            changed = False
+            entries = []
+            for path in paths:
+                entry, read = self._entry(path)
+                changed = changed or read
+                if entry is not None:
+                    entries.append(dict(entry))
+            # Forget files that are gone
+            for path in set(self._entries) - set(paths):
+                if Path(path).is_relative_to(self.dir):
+                    del self._entries[path]
+                    changed = True
+            if changed:
+                self._write_cache()
+        return sorted(entries, key=lambda entry: entry["name"].lower())
+
+    def describe(self, path: str) -> Optional[dict[str, Any]]:
+        """
+        The catalog entry of one model file, which need not be in the
+        directory, or None if it cannot be read.
+        """
+        with self._lock:
+            entry, read = self._entry(str(Path(path).expanduser()))
+            if read:
+                self._write_cache()
+        return dict(entry) if entry is not None else None
+
+    def _entry(self, path: str) -> tuple[Optional[dict[str, Any]], bool]:
+        """
+        The cached entry for path if its file is unchanged, else one read from
+        its header. Returns the entry and whether the header was read. Must be
+        called with the lock held.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, False
+        cached = self._entries.get(path)
+        if (
+            cached is not None
+            and cached["mtime_ns"] == stat.st_mtime_ns
+            and cached["file_size"] == stat.st_size
+        ):
+            return cached, False
+        try:
+            entry = summarize(path, read_gguf_metadata(path))
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Skipping unreadable model {path}: {e}")
+            return None, False
+        self.headers_read += 1
+        self._entries[path] = entry
+        return entry, True
+
+    @staticmethod
+    def _is_later_split(name: str) -> bool:
+        match = _SPLIT_PART.search(name)
+        return match is not None and int(match.group(1)) > 1
+
+    def _read_cache(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.cache_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _write_cache(self):
+        # Must be called with the lock held
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            # Only costs a header read on the next start
+            print(f"Could not write the model catalog cache: {e}")
+
+
+_catalog: Optional[ModelCatalog] = None
+_lock = threading.Lock()
+
+
+def models_dir(config: ModelConfig) -> Path:
+    """
+    The configured models directory, or the one holding model_path. Relative
+    paths are resolved against the project root, like model paths.
+    """
+    if config.models_dir:
+        directory = Path(config.models_dir).expanduser()
+    else:
+        directory = Path(config.model_path or "models/default.gguf").parent
+    if not directory.is_absolute():
+        directory = Path(__file__).resolve().parents[4] / directory.expanduser()
+    return directory
+
+
+def get_catalog(config: ModelConfig) -> ModelCatalog:
+    """
+    Return the process-wide catalog of the configured models directory.
+    """
+    global _catalog
+    directory = models_dir(config)
+    with _lock:
+        if _catalog is None or _catalog.dir != directory:
+            _catalog = ModelCatalog(str(directory), config.model_catalog_cache_path)
+        return _catalog
@@ -0,0 +1,80 @@
+"""
+Unit tests for the GGUF model catalog.
+"""
+
+import os
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.models.catalog import ModelCatalog, estimate_memory_bytes
+
+
+def _string(text: str) -> bytes:
+    data = text.encode()
+    return struct.pack("<Q", len(data)) + data
+
+
+def write_gguf(path: Path, name: str):
+    """
+    A minimal GGUF file: a few header values, a vocabulary and two tensors.
+    """
+    kv = [
+        _string("general.architecture") + struct.pack("<I", 8) + _string("llama"),
+        _string("general.name") + struct.pack("<I", 8) + _string(name),
+        _string("general.file_type") + struct.pack("<II", 4, 15),
+        _string("llama.block_count") + struct.pack("<II", 4, 2),
+        _string("llama.embedding_length") + struct.pack("<II", 4, 64),
+        _string("llama.attention.head_count") + struct.pack("<II", 4, 4),
+        _string("tokenizer.ggml.tokens")
+        + struct.pack("<IIQ", 9, 8, 3)
+        + b"".join(_string(t) for t in ("a", "bb", "ccc")),
+    ]
+    tensors = [
+        _string("token_embd.weight") + struct.pack("<I2QIQ", 2, 64, 3, 0, 0),
+        _string("output_norm.weight") + struct.pack("<I1QIQ", 1, 64, 0, 0),
+    ]
+    header = struct.pack("<4sIQQ", b"GGUF", 3, len(tensors), len(kv))
+    path.write_bytes(header + b"".join(kv) + b"".join(tensors) + b"\0" * 64)
+
+
+class TestModelCatalog(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.cache = str(self.dir / "cache" / "catalog.json")
+        write_gguf(self.dir / "b.gguf", "Beta")
+        write_gguf(self.dir / "a-00001-of-00002.gguf", "Alpha")
+        write_gguf(self.dir / "a-00002-of-00002.gguf", "Alpha")
+        (self.dir / "broken.gguf").write_bytes(b"not a model")
+
+    def test_scan_reads_headers(self):
+        entries = ModelCatalog(str(self.dir), self.cache).scan()
+        self.assertEqual([e["name"] for e in entries], ["Alpha", "Beta"])
+        beta = entries[1]
+        self.assertEqual(beta["architecture"], "llama")
+        self.assertEqual(beta["quantization"], "Q4_K_M")
+        self.assertEqual(beta["parameters"], 64 * 3 + 64)
+        self.assertEqual(beta["block_count"], 2)
+        # Two layers of f16 keys and values, 16 dimensions per head
+        self.assertEqual(
+            estimate_memory_bytes(beta, 8, "f16") - beta["file_size"],
+            8 * 2 * 4 * (16 + 16) * 2,
+        )
+
+    def test_headers_are_read_again_only_after_a_change(self):
+        catalog = ModelCatalog(str(self.dir), self.cache)
+        catalog.scan()
+        self.assertEqual(catalog.headers_read, 2)
+        catalog.scan()
+        self.assertEqual(catalog.headers_read, 2)
+
+        # A new process starts from the cache file
+        reopened = ModelCatalog(str(self.dir), self.cache)
+        os.utime(self.dir / "b.gguf", ns=(1, 1))
+        reopened.scan()
+        self.assertEqual(reopened.headers_read, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
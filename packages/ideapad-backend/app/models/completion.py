@@ -0,0 +1,286 @@
+"""Fill-in-the-middle code completion in a llama.cpp context of its own, ahead of chat work"""
+
+import codecs
+import ctypes
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+from app.metrics import GenerationTimer, LlamaPerf
+
+# Characters of prefix and suffix tokenized per request, as a multiple of the
+# token budget; the rest of a large file could never fit anyway
+_CHARS_PER_TOKEN = 8
+# Granularity of where a long prefix is cut
+_PREFIX_STEP_CHARS = 1024
+
+
+class PriorityGate:
+    """
+    Lets latency-sensitive work pause background generation between tokens.
+    Chat decoding calls wait() (or uses the gate as a llama.cpp logits
+    processor) before every token and sleeps while any priority() block runs,
+    leaving the CPU cores to it.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = 0
+        self.pauses = 0
+
+    @contextmanager
+    def priority(self) -> Iterator[None]:
+        with self._cond:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                if not self._active:
+                    self._cond.notify_all()
+
+    def wait(self):
+        # Unlocked fast path: nothing has priority almost all of the time
+        if not self._active:
+            return
+        with self._cond:
+            if self._active:
+                self.pauses += 1
+            while self._active:
+                self._cond.wait()
+
+    def __call__(self, input_ids, scores):
+        self.wait()
+        return scores
+
+
+class CompletionEngine:
+    """
+    Single-sequence llama.cpp context created from an already loaded model,
+    so the weights are shared, used only for code completion. The prompt is
+    prefix and suffix with the model's FIM tokens, in prefix-suffix-middle
+    ("psm") or suffix-prefix-middle ("spm") order, or just the prefix if the
+    model has none. The KV cache of the previous request is kept: the next
+    keystroke in the same file only prefills from the first changed token.
+    Decoding is greedy and checks for cancellation before every token.
+    """
+
+    def __init__(
+        self,
+        llama: Llama,
+        n_ctx: int = 2048,
+        n_batch: int = 512,
+        n_threads: Optional[int] = None,
+        n_threads_batch: Optional[int] = None,
+        fim_order: str = "psm",
+    ):
+        self._llama = llama
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.fim_order = fim_order
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = 1
+        params.no_perf = False
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads_batch or n_threads
+        self._ctx = llama_cpp.llama_init_from_model(llama.model, params)
+        if self._ctx is None:
+            raise RuntimeError("Failed to create completion llama context")
+        self._memory = llama_cpp.llama_get_memory(self._ctx)
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+        self._vocab = llama_cpp.llama_model_get_vocab(llama.model)
+        self._n_vocab = llama.n_vocab()
+        self._piece_buf = (ctypes.c_char * 64)()
+        self.llama_perf = LlamaPerf(self._ctx)
+
+        fim = (
+            llama_cpp.llama_vocab_fim_pre(self._vocab),
+            llama_cpp.llama_vocab_fim_suf(self._vocab),
+            llama_cpp.llama_vocab_fim_mid(self._vocab),
+        )
+        self.fim_tokens: Optional[tuple[int, int, int]] = (
+            fim if all(token >= 0 for token in fim) else None
+        )
+        self._add_bos = llama_cpp.llama_vocab_get_add_bos(self._vocab)
+        # Tokens whose KV state the context holds, in order
+        self._cached: list[int] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def complete(
+        self,
+        prefix: str,
+        suffix: str,
+        max_tokens: int,
+        stop: Optional[list[str]] = None,
+        cancelled: Optional[threading.Event] = None,
+        timer: Optional[GenerationTimer] = None,
+    ) -> dict:
+        """
+        Generate the code between prefix and suffix. Returns the completion,
+        finish_reason ("stop", "length" or "cancelled") and usage. Setting
+        cancelled stops decoding before the next token.
+        """
+        stop = stop or []
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Completion context is closed")
+            if cancelled is not None and cancelled.is_set():
+                return self._result("", "cancelled", 0, 0)
+            tokens = self._prompt_tokens(prefix, suffix, max_tokens)
+            if not tokens:
+                # No prefix, and no FIM or BOS token: nothing to continue from
+                return self._result("", "stop", 0, 0)
+
+            started = time.perf_counter()
+            reused = self._prefill(tokens)
+            if timer is not None:
+                timer.add("prefill", time.perf_counter() - started)
+                timer.add_tokens("prefill", len(tokens) - reused)
+
+            started = time.perf_counter()
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            text, generated, finish_reason = "", 0, "length"
+            logits_index = self._batch.n_tokens - 1
+            while generated < max_tokens:
+                if cancelled is not None and cancelled.is_set():
+                    finish_reason = "cancelled"
+                    break
+                if len(self._cached) >= self.n_ctx:
+                    break
+                logits = np.ctypeslib.as_array(
+                    llama_cpp.llama_get_logits_ith(self._ctx, logits_index),
+                    shape=(self._n_vocab,),
+                )
+                token = int(np.argmax(logits))
+                if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+                    finish_reason = "stop"
+                    break
+                generated += 1
+                text += decoder.decode(self._piece(token))
+                cuts = [text.find(s) for s in stop if s in text]
+                if cuts:
+                    text, finish_reason = text[: min(cuts)], "stop"
+                    break
+                if generated < max_tokens:
+                    self._decode([token])
+                    logits_index = 0
+            if timer is not None:
+                timer.add("decode", time.perf_counter() - started)
+                timer.add_tokens("decode", generated)
+            self.llama_perf.update()
+            return self._result(text, finish_reason, len(tokens), generated)
+
+    def kv_cache_usage(self) -> tuple[int, int]:
+        return len(self._cached), self.n_ctx
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            llama_cpp.llama_batch_free(self._batch)
+            llama_cpp.llama_free(self._ctx)
+
+    def _prompt_tokens(self, prefix: str, suffix: str, max_tokens: int) -> list[int]:
+        """
+        FIM prompt for the code at the cursor: the start of the suffix, in at
+        most an eighth of the budget, and the end of the prefix. The prefix is
+        cut at steps, not exactly at the budget, so that while typing the
+        start of the prompt stays the same and its KV cache is reused.
+        """
+        budget = self.n_ctx - max_tokens - 4
+        if budget <= 0:
+            raise ValueError("max_tokens does not fit in the completion context")
+
+        def encode(text: str) -> list[int]:
+            return self._llama.tokenize(
+                text.encode("utf-8"), add_bos=False, special=False
+            )
+
+        bos = [llama_cpp.llama_vocab_bos(self._vocab)] if self._add_bos else []
+        after: list[int] = []
+        if self.fim_tokens is not None:
+            after = encode(suffix[: budget * _CHARS_PER_TOKEN // 8])[: budget // 8]
+        keep = budget - len(after)
+        start = max(len(prefix) - keep * _CHARS_PER_TOKEN, 0)
+        before = encode(prefix[start - start % _PREFIX_STEP_CHARS :])
+        step = max(keep // 8, 1)
+        excess = len(before) - keep
+        if excess > 0:
+            # Whole steps, rounded up
+            before = before[-(-excess // step) * step :]
+
+        if self.fim_tokens is None:
+            return bos + before
+        pre, suf, mid = self.fim_tokens
+        if self.fim_order == "spm":
+            # Typing only changes the end of the prefix, so only that and the
+            # middle token are prefilled again
+            return bos + [suf] + after + [pre] + before + [mid]
+        return bos + [pre] + before + [suf] + after + [mid]
+
+    def _prefill(self, tokens: list[int]) -> int:
+        """
+        Evaluate tokens, reusing the cached KV state of their longest common
+        prefix with the previous prompt. Returns the number of tokens reused.
+        """
+        common = 0
+        for cached, token in zip(self._cached, tokens):
+            if cached != token:
+                break
+            common += 1
+        # The last prompt token is always evaluated again for its logits
+        common = min(common, len(tokens) - 1)
+        llama_cpp.llama_memory_seq_rm(self._memory, 0, common, -1)
+        self._cached = self._cached[:common]
+        for start in range(common, len(tokens), self.n_batch):
+            self._decode(tokens[start : start + self.n_batch])
+        return common
+
+    def _decode(self, tokens: list[int]):
+        """
+        Evaluate tokens after the cached ones, with logits for the last.
+        """
+        batch = self._batch
+        batch.n_tokens = len(tokens)
+        for i, token in enumerate(tokens):
+            batch.token[i] = token
+            batch.pos[i] = len(self._cached) + i
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = 0
+            batch.logits[i] = i == len(tokens) - 1
+        if llama_cpp.llama_decode(self._ctx, batch) != 0:
+            self._cached = []
+            llama_cpp.llama_memory_clear(self._memory, True)
+            raise RuntimeError("llama_decode failed for completion")
+        self._cached.extend(tokens)
+
+    def _piece(self, token: int) -> bytes:
+        size = llama_cpp.llama_token_to_piece(
+            self._vocab, token, self._piece_buf, len(self._piece_buf), 0, False
+        )
+        return bytes(self._piece_buf[:size])
+
+    @staticmethod
+    def _result(text: str, finish_reason: str, prompt: int, completion: int) -> dict:
+        return {
+            "completion": text,
+            "finish_reason": finish_reason,
+            "usage": {
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "total_tokens": prompt + completion,
+            },
+        }
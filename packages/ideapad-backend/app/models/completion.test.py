@@ -0,0 +1,74 @@
+"""
+Unit tests for completion prompts and the chat/completion priority gate.
+"""
+
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from app.models.completion import CompletionEngine, PriorityGate
+
+
+def char_engine(fim_order="psm"):
+    """
+    A CompletionEngine without a llama context, one token per character.
+    """
+    engine = CompletionEngine.__new__(CompletionEngine)
+    engine.n_ctx = 100
+    engine.fim_order = fim_order
+    engine.fim_tokens = (1, 2, 3)
+    engine._add_bos = False
+    engine._llama = MagicMock()
+    engine._llama.tokenize = lambda text, add_bos, special: list(text.decode())
+    return engine
+
+
+class TestPromptTokens(unittest.TestCase):
+    def test_orders(self):
+        psm = char_engine()._prompt_tokens("ab", "cd", max_tokens=8)
+        spm = char_engine("spm")._prompt_tokens("ab", "cd", max_tokens=8)
+        self.assertEqual(psm, [1, "a", "b", 2, "c", "d", 3])
+        self.assertEqual(spm, [2, "c", "d", 1, "a", "b", 3])
+
+    def test_long_prefix_keeps_its_start_while_typing(self):
+        engine = char_engine()
+        code = "".join(chr(97 + i % 26) for i in range(500))
+        first = engine._prompt_tokens(code, "", max_tokens=8)
+        second = engine._prompt_tokens(code + "x", "", max_tokens=8)
+        self.assertLessEqual(len(first), engine.n_ctx - 8)
+        # Everything but the suffix and middle tokens is reused
+        self.assertEqual(second[: len(first) - 2], first[:-2])
+
+    def test_empty_prompt_completes_nothing(self):
+        engine = char_engine()
+        engine.fim_tokens = None
+        engine._lock = threading.Lock()
+        engine._closed = False
+        engine._decode = MagicMock()
+        result = engine.complete("", "def f():", max_tokens=8)
+        self.assertEqual(result["completion"], "")
+        self.assertEqual(result["finish_reason"], "stop")
+        engine._decode.assert_not_called()
+
+
+class TestPriorityGate(unittest.TestCase):
+    def test_wait_blocks_while_priority_work_runs(self):
+        gate = PriorityGate()
+        waited = threading.Event()
+
+        def chat():
+            gate.wait()
+            waited.set()
+
+        with gate.priority():
+            thread = threading.Thread(target=chat)
+            thread.start()
+            time.sleep(0.05)
+            self.assertFalse(waited.is_set())
+        thread.join(1)
+        self.assertTrue(waited.is_set())
+        self.assertEqual(gate.pauses, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Token-budgeted conversation window with per-turn token counts"""
+
+from typing import Callable
+
+# Tokens a chat template adds around each message (role markers, separators)
+TURN_OVERHEAD_TOKENS = 8
+
+
+class ContextWindow:
+    """
+    Conversation history that knows how many tokens each turn costs.
+    Counts are taken once, when a turn is added, so fitting the transcript
+    into n_ctx never re-tokenizes it. When the transcript outgrows the prompt
+    budget the oldest turns are dropped from what is sent to the model; the
+    system prompt and latest turns are always kept. Dropping happens down to
+    a low watermark rather than one turn at a time, so the prompt prefix stays
+    stable (and its KV cache reusable) for several turns after each trim.
+    """
+
+    def __init__(
+        self,
+        n_ctx: int,
+        max_tokens: int,
+        count_tokens: Callable[[str], int],
+        system_prompt: str = "",
+        low_watermark: float = 0.75,
+    ):
+        self.n_ctx = n_ctx
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.low_watermark = low_watermark
+        # Room always left for the answer, even when max_tokens is huge
+        self.output_reserve = min(max_tokens, n_ctx // 4)
+        self.system_prompt = system_prompt
+        self.system_tokens = self._cost(system_prompt)
+
+        self.turns: list[dict[str, str]] = []
+        self.turn_tokens: list[int] = []
+        # Index of the first turn still sent to the model
+        self.start = 0
+
+    @property
+    def prompt_budget(self) -> int:
+        return self.n_ctx - self.output_reserve
+
+    def append(self, role: str, content: str):
+        self.turns.append({"role": role, "content": content})
+        self.turn_tokens.append(self._cost(content))
+
+    def pop(self) -> dict[str, str]:
+        self.turn_tokens.pop()
+        turn = self.turns.pop()
+        self.start = min(self.start, len(self.turns))
+        return turn
+
+    def room(self, content: str) -> int:
+        """
+        Prompt tokens left beside the system prompt if content were the only
+        turn sent.
+        """
+        return self.prompt_budget - self.system_tokens - self._cost(content)
+
+    def window_tokens(self) -> int:
+        """
+        Estimated prompt tokens of the system prompt plus the kept turns.
+        """
+        return self.system_tokens + sum(self.turn_tokens[self.start :])
+
+    def fit(self) -> tuple[list[dict[str, str]], int]:
+        """
+        Trim the window to the prompt budget and return the messages to send
+        with the largest max_tokens that still fits in n_ctx.
+        Raises ValueError if the latest turn alone does not fit.
+        """
+        if self.window_tokens() > self.prompt_budget:
+            target = int(self.prompt_budget * self.low_watermark)
+            total = self.window_tokens()
+            last = len(self.turns) - 1
+            while self.start < last and total > target:
+                total -= self.turn_tokens[self.start]
+                self.start += 1
+            # Never open the window on an assistant turn
+            while self.start < last and self.turns[self.start]["role"] != "user":
+                total -= self.turn_tokens[self.start]
+                self.start += 1
+            if total > self.prompt_budget:
+                raise ValueError("Prompt does not fit in the context window")
+
+        max_tokens = min(self.max_tokens, self.n_ctx - self.window_tokens())
+        return self.messages(), max_tokens
+
+    def messages(self) -> list[dict[str, str]]:
+        """
+        The system prompt plus the turns currently inside the window.
+        """
+        return [{"role": "system", "content": self.system_prompt}] + self.turns[
+            self.start :
+        ]
+
+    def _cost(self, content: str) -> int:
+        return self.count_tokens(content) + TURN_OVERHEAD_TOKENS
@@ -0,0 +1,56 @@
+"""
+Unit tests for the token-budgeted context window.
+"""
+
+import unittest
+from unittest.mock import MagicMock
+from app.models.context_window import ContextWindow, TURN_OVERHEAD_TOKENS
+
+
+def _words(text: str) -> int:
+    return len(text.split())
+
+
+class TestContextWindow(unittest.TestCase):
+    def test_turns_are_tokenized_once(self):
+        count = MagicMock(side_effect=_words)
+        window = ContextWindow(n_ctx=1000, max_tokens=100, count_tokens=count)
+        window.append("user", "one two three")
+        window.fit()
+        window.fit()
+        # Once for the system prompt, once for the turn
+        self.assertEqual(count.call_count, 2)
+
+    def test_max_tokens_shrinks_to_remaining_context(self):
+        window = ContextWindow(n_ctx=200, max_tokens=1000, count_tokens=_words)
+        window.append("user", "word " * 40)
+        messages, max_tokens = window.fit()
+        used = 2 * TURN_OVERHEAD_TOKENS + 40
+        self.assertEqual(max_tokens, 200 - used)
+        self.assertEqual(len(messages), 2)
+
+    def test_oldest_turns_are_trimmed_keeping_latest(self):
+        window = ContextWindow(
+            n_ctx=200, max_tokens=50, count_tokens=_words, system_prompt="sys"
+        )
+        for i in range(10):
+            window.append("user", f"question {i} " + "x " * 10)
+            window.append("assistant", f"answer {i} " + "y " * 10)
+        window.append("user", "latest")
+        messages, max_tokens = window.fit()
+        self.assertEqual(messages[0]["role"], "system")
+        self.assertEqual(messages[1]["role"], "user")
+        self.assertEqual(messages[-1]["content"], "latest")
+        self.assertLessEqual(window.window_tokens(), window.prompt_budget)
+        self.assertGreater(max_tokens, 0)
+        self.assertEqual(len(window.turns), 21)
+
+    def test_oversized_prompt_is_rejected(self):
+        window = ContextWindow(n_ctx=100, max_tokens=50, count_tokens=_words)
+        window.append("user", "x " * 200)
+        with self.assertRaises(ValueError):
+            window.fit()
+
+
+if __name__ == "__main__":
+    unittest.main()
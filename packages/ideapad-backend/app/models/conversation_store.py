@@ -0,0 +1,429 @@
+"""Durable conversations: turns in SQLite (WAL), written behind the request path, plus optional KV snapshots"""
+
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from llama_cpp import LlamaState
+
+from app.types import ModelConfig
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    model_path TEXT NOT NULL,
+    window_start INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    lora_adapters TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS turns (
+    conversation_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, position)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    conversation_id TEXT PRIMARY KEY,
+    state_key TEXT NOT NULL,
+    nbytes INTEGER NOT NULL,
+    saved REAL NOT NULL
+);
+"""
+
+
+class StoredConversation:
+    __slots__ = (
+        "conversation_id",
+        "model_path",
+        "window_start",
+        "turns",
+        "lora_adapters",
+    )
+
+    def __init__(
+        self,
+        conversation_id: str,
+        model_path: str,
+        window_start: int,
+        turns: list[dict[str, str]],
+        lora_adapters: Optional[list[dict]] = None,
+    ):
+        self.conversation_id = conversation_id
+        self.model_path = model_path
+        self.window_start = window_start
+        self.turns = turns
+        self.lora_adapters = lora_adapters or []
+
+
+class ConversationStore:
+    """
+    Conversations and their turns in conversations.sqlite, so they outlive the
+    process. Writes are queued and a background thread commits everything
+    queued so far in one transaction, so a turn never waits for the disk. The
+    database is in WAL mode with synchronous=NORMAL: a commit is an append to
+    the log and only checkpoints fsync, which loses nothing when the process
+    dies and at most the last commits on power loss. KV snapshots are pickled
+    files next to it, kept under a byte budget, oldest removed first.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        snapshot_capacity_bytes: int = 4 << 30,
+        retention_days: float = 30,
+    ):
+        self.dir = Path(directory).expanduser()
+        self._snapshot_dir = self.dir / "snapshots"
+        self._snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshot_capacity_bytes = snapshot_capacity_bytes
+        # Every worker process opens the same database; wait out their commits
+        self._db = sqlite3.connect(
+            self.dir / "conversations.sqlite", timeout=30, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+
+        self._cond = threading.Condition()
+        self._pending: list[tuple[str, tuple]] = []
+        self._writing = False
+        self._closed = False
+        self.commits = 0
+        self.statements = 0
+
+        if retention_days > 0:
+            self._prune(time.time() - retention_days * 86400)
+        self._writer = threading.Thread(
+            target=self._write_loop, name="conversation-store", daemon=True
+        )
+        self._writer.start()
+
+    def create(
+        self,
+        conversation_id: str,
+        model_path: str,
+        lora_adapters: Optional[list[dict]] = None,
+    ):
+        now = time.time()
+        adapters = json.dumps(lora_adapters or [])
+        self._enqueue(
+            (
+                "INSERT OR IGNORE INTO conversations VALUES (?, ?, 0, ?, ?, ?)",
+                (conversation_id, model_path, now, now, adapters),
+            )
+        )
+
+    def save_turns(
+        self,
+        conversation_id: str,
+        start: int,
+        turns: list[dict[str, str]],
+        window_start: int,
+    ):
+        """
+        Replace the turns from position start on, e.g. with the two turns of
+        the latest exchange, and record where the context window opens.
+        """
+        statements = [
+            (
+                "DELETE FROM turns WHERE conversation_id = ? AND position >= ?",
+                (conversation_id, start),
+            )
+        ]
+        statements += [
+            (
+                "INSERT INTO turns VALUES (?, ?, ?, ?)",
+                (conversation_id, start + i, turn["role"], turn["content"]),
+            )
+            for i, turn in enumerate(turns)
+        ]
+        statements.append(
+            (
+                "UPDATE conversations SET window_start = ?, updated = ? WHERE id = ?",
+                (window_start, time.time(), conversation_id),
+            )
+        )
+        self._enqueue(*statements)
+
+    def set_model(
+        self,
+        conversation_id: str,
+        model_path: str,
+        lora_adapters: Optional[list[dict]] = None,
+    ):
+        self._enqueue(
+            (
+                "UPDATE conversations SET model_path = ?, lora_adapters = ?,"
+                " updated = ? WHERE id = ?",
+                (
+                    model_path,
+                    json.dumps(lora_adapters or []),
+                    time.time(),
+                    conversation_id,
+                ),
+            )
+        )
+
+    def delete(self, conversation_id: str):
+        self._enqueue(
+            ("DELETE FROM turns WHERE conversation_id = ?", (conversation_id,)),
+            ("DELETE FROM conversations WHERE id = ?", (conversation_id,)),
+        )
+        self.flush()
+        with self._lock:
+            self._delete_snapshots([conversation_id])
+
+    def load(self, conversation_id: str) -> Optional[StoredConversation]:
+        """
+        The stored conversation, including turns still queued for writing, or
+        None if there is none.
+        """
+        self.flush()
+        with self._lock:
+            found = self._db.execute(
+                "SELECT model_path, window_start, lora_adapters FROM conversations"
+                " WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            if found is None:
+                return None
+            turns = [
+                {"role": role, "content": content}
+                for role, content in self._db.execute(
+                    "SELECT role, content FROM turns WHERE conversation_id = ?"
+                    " ORDER BY position",
+                    (conversation_id,),
+                )
+            ]
+        return StoredConversation(
+            conversation_id, found[0], found[1], turns, json.loads(found[2])
+        )
+
+    def save_snapshot(self, conversation_id: str, state_key: str, state: LlamaState):
+        """
+        Write a conversation's KV state, replacing any earlier one. state_key
+        identifies the model and context layout it can be loaded into. Only
+        the KV data and token ids are kept: llama.cpp evaluates the last
+        token again after a restore, so the saved logits are never read.
+        """
+        compact = LlamaState(
+            input_ids=state.input_ids,
+            scores=np.zeros((1, state.scores.shape[1]), dtype=np.single),
+            n_tokens=state.n_tokens,
+            llama_state=state.llama_state,
+            llama_state_size=state.llama_state_size,
+            seed=state.seed,
+        )
+        path = self._snapshot_path(conversation_id)
+        partial = path.with_suffix(".partial")
+        with open(partial, "wb") as f:
+            pickle.dump(compact, f, protocol=pickle.HIGHEST_PROTOCOL)
+        nbytes = partial.stat().st_size
+        if nbytes > self.snapshot_capacity_bytes:
+            partial.unlink(missing_ok=True)
+            return
+        os.replace(partial, path)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                    (conversation_id, state_key, nbytes, time.time()),
+                )
+            self._evict_snapshots()
+
+    def load_snapshot(
+        self, conversation_id: str, state_key: str
+    ) -> Optional[LlamaState]:
+        """
+        The conversation's saved KV state if it was saved for state_key.
+        """
+        with self._lock:
+            found = self._db.execute(
+                "SELECT state_key FROM snapshots WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+        if found is None or found[0] != state_key:
+            return None
+        try:
+            with open(self._snapshot_path(conversation_id), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def flush(self):
+        """
+        Wait until every queued write is committed.
+        """
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            conversations, snapshot_bytes = self._db.execute(
+                "SELECT (SELECT COUNT(*) FROM conversations),"
+                " (SELECT COALESCE(SUM(nbytes), 0) FROM snapshots)"
+            ).fetchone()
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "conversations": conversations,
+            "snapshot_bytes": snapshot_bytes,
+            "pending_statements": pending,
+            "statements": self.statements,
+            "commits": self.commits,
+        }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        with self._lock:
+            self._db.close()
+
+    def _enqueue(self, *statements: tuple[str, tuple]):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Conversation store is closed")
+            self._pending.extend(statements)
+            self._cond.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                self._writing = True
+            try:
+                with self._lock, self._db:
+                    for sql, params in batch:
+                        self._db.execute(sql, params)
+                self.commits += 1
+                self.statements += len(batch)
+            except sqlite3.Error as e:
+                # Losing a batch beats taking the server down
+                print(f"Conversation store write failed: {e}")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _migrate(self):
+        # Databases written before conversations had LoRA adapters
+        columns = {
+            row[1] for row in self._db.execute("PRAGMA table_info(conversations)")
+        }
+        if "lora_adapters" not in columns:
+            with self._db:
+                self._db.execute(
+                    "ALTER TABLE conversations"
+                    " ADD COLUMN lora_adapters TEXT NOT NULL DEFAULT '[]'"
+                )
+
+    def _snapshot_path(self, conversation_id: str) -> Path:
+        # Conversation IDs are UUIDs, but never trust them as file names
+        name = "".join(c for c in conversation_id if c.isalnum() or c == "-")
+        return self._snapshot_dir / f"{name}.state"
+
+    def _evict_snapshots(self):
+        # Must be called with the lock held
+        total = 0
+        expired = []
+        for conversation_id, nbytes in self._db.execute(
+            "SELECT conversation_id, nbytes FROM snapshots ORDER BY saved DESC"
+        ).fetchall():
+            total += nbytes
+            if total > self.snapshot_capacity_bytes:
+                expired.append(conversation_id)
+        self._delete_snapshots(expired)
+
+    def _delete_snapshots(self, conversation_ids: list[str]):
+        # Must be called with the lock held
+        if not conversation_ids:
+            return
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM snapshots WHERE conversation_id = ?",
+                [(cid,) for cid in conversation_ids],
+            )
+        for conversation_id in conversation_ids:
+            self._snapshot_path(conversation_id).unlink(missing_ok=True)
+
+    def _prune(self, cutoff: float):
+        # Conversations untouched since cutoff are gone for good
+        with self._lock:
+            expired = [
+                cid
+                for (cid,) in self._db.execute(
+                    "SELECT id FROM conversations WHERE updated < ?", (cutoff,)
+                )
+            ]
+            with self._db:
+                self._db.executemany(
+                    "DELETE FROM turns WHERE conversation_id = ?",
+                    [(cid,) for cid in expired],
+                )
+                self._db.executemany(
+                    "DELETE FROM conversations WHERE id = ?",
+                    [(cid,) for cid in expired],
+                )
+            self._delete_snapshots(expired)
+
+
+_store: Optional[ConversationStore] = None
+_store_key: Optional[tuple] = None
+_lock = threading.Lock()
+
+
+def get_conversation_store(config: ModelConfig) -> Optional[ConversationStore]:
+    """
+    Return the process-wide conversation store for the configured directory,
+    opening it on first use, or None if conversations are kept in memory only.
+    """
+    global _store, _store_key
+    if not config.conversation_store_dir:
+        return None
+    key = (
+        config.conversation_store_dir,
+        config.conversation_snapshot_disk_bytes,
+        config.conversation_retention_days,
+    )
+    with _lock:
+        if _store is None or _store_key != key:
+            old, _store, _store_key = (
+                _store,
+                ConversationStore(
+                    config.conversation_store_dir,
+                    snapshot_capacity_bytes=config.conversation_snapshot_disk_bytes,
+                    retention_days=config.conversation_retention_days,
+                ),
+                key,
+            )
+            if old is not None:
+                old.close()
+        return _store
+
+
+def close_conversation_store():
+    """
+    Commit queued writes and close the process-wide store, if one is open.
+    """
+    global _store, _store_key
+    with _lock:
+        store, _store, _store_key = _store, None, None
+    if store is not None:
+        store.close()
@@ -0,0 +1,74 @@
+"""
+Unit tests for the durable conversation store.
+"""
+
+import tempfile
+import unittest
+
+import numpy as np
+from llama_cpp import LlamaState
+
+from app.models.conversation_store import ConversationStore
+
+
+def _state(n_bytes: int) -> LlamaState:
+    return LlamaState(
+        input_ids=np.arange(8, dtype=np.intc),
+        scores=np.ones((4, 16), dtype=np.single),
+        n_tokens=4,
+        llama_state=b"k" * n_bytes,
+        llama_state_size=n_bytes,
+        seed=1,
+    )
+
+
+class TestConversationStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ConversationStore(self.dir, snapshot_capacity_bytes=100_000)
+        self.addCleanup(self.store.close)
+
+    def test_turns_survive_reopening(self):
+        self.store.create("c", "models/a.gguf")
+        turns = [
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+        ]
+        self.store.save_turns("c", 0, turns, window_start=0)
+        # A later save from position 1 replaces the assistant turn
+        self.store.save_turns(
+            "c", 1, [{"role": "assistant", "content": "hey"}], window_start=1
+        )
+        self.store.close()
+
+        reopened = ConversationStore(self.dir)
+        self.addCleanup(reopened.close)
+        stored = reopened.load("c")
+        self.assertEqual(stored.model_path, "models/a.gguf")
+        self.assertEqual(stored.window_start, 1)
+        self.assertEqual([t["content"] for t in stored.turns], ["hi", "hey"])
+        self.assertIsNone(reopened.load("missing"))
+
+    def test_snapshot_loads_only_for_its_state_key(self):
+        self.store.create("c", "models/a.gguf")
+        self.store.save_snapshot("c", "model-a", _state(1000))
+        loaded = self.store.load_snapshot("c", "model-a")
+        self.assertEqual(loaded.llama_state, b"k" * 1000)
+        # Logits are not kept
+        self.assertEqual(loaded.scores.shape, (1, 16))
+        self.assertIsNone(self.store.load_snapshot("c", "model-b"))
+
+        self.store.delete("c")
+        self.assertIsNone(self.store.load("c"))
+        self.assertIsNone(self.store.load_snapshot("c", "model-a"))
+
+    def test_oldest_snapshots_go_over_budget(self):
+        for cid in ("a", "b", "c"):
+            self.store.save_snapshot(cid, "key", _state(40_000))
+        self.assertIsNone(self.store.load_snapshot("a", "key"))
+        self.assertIsNotNone(self.store.load_snapshot("c", "key"))
+        self.assertLessEqual(self.store.stats()["snapshot_bytes"], 100_000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Text embeddings from a local GGUF, using llama.cpp's embedding mode"""
+
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from llama_cpp import Llama
+
+from app.metrics import observe_stage
+
+
+class EmbeddingModel:
+    """
+    Loads an embedding GGUF (e.g. nomic-embed-text or bge-small) with pooled
+    embedding output and turns texts into unit-length float32 vectors, so
+    cosine similarity is a dot product. Inputs longer than n_ctx are truncated.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 2048, n_threads: int = 4):
+        from app.models.model_definition import resolve_model_path
+
+        self.model_path = resolve_model_path(model_path)
+        self.name = Path(self.model_path).stem
+        try:
+            # Non-causal models need a whole input in one ubatch
+            self.model = Llama(
+                model_path=self.model_path,
+                embedding=True,
+                n_ctx=n_ctx,
+                n_batch=n_ctx,
+                n_ubatch=n_ctx,
+                n_threads=n_threads,
+                verbose=False,
+            )
+        except Exception as e:
+            raise RuntimeError(f"Failed to initialize embedding model: {e}") from e
+        self.dim: int = self.model.n_embd()
+        self._lock = threading.Lock()
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        Embed texts into a (len(texts), dim) matrix of unit-length rows.
+        """
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        started = time.perf_counter()
+        with self._lock:
+            embedded = self.model.embed(texts)
+        observe_stage(self.name, "embed", time.perf_counter() - started)
+        # Models without a pooling type return one vector per token; average them
+        vectors = np.stack(
+            [
+                np.asarray(e, dtype=np.float32).reshape(-1, self.dim).mean(axis=0)
+                for e in embedded
+            ]
+        )
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def close(self):
+        self.model.close()
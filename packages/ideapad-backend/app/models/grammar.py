@@ -0,0 +1,137 @@
+"""Grammar-constrained decoding: GBNF grammars and JSON schemas compiled once per model, cached by content hash"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp.llama_grammar import json_schema_to_gbnf
+
+# llama-cpp-python's schema converter lets raw control characters into JSON
+# strings, which JSON parsers reject; llama.cpp's own converter excludes them
+_JSON_CHAR = r'char ::= [^"\\] |'
+_STRICT_JSON_CHAR = r'char ::= [^"\\\x7F\x00-\x1F] |'
+
+
+def grammar_key(grammar: Optional[str], json_schema: Optional[Any]) -> str:
+    """
+    Content hash of a grammar or JSON schema. Schemas are hashed in canonical
+    form, so key order and whitespace do not matter.
+    """
+    payload = json.dumps(
+        {"grammar": grammar, "json_schema": json_schema},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CompiledGrammar:
+    """
+    A grammar checked against one model's vocabulary. llama-cpp-python's
+    samplers take it as llama_grammar; decoders that drive llama.cpp directly
+    clone the parsed sampler with new_sampler() instead of parsing the text.
+    """
+
+    def __init__(self, key: str, gbnf: str, sampler):
+        self.key = key
+        self.gbnf = gbnf
+        self.llama_grammar = LlamaGrammar.from_string(gbnf, verbose=False)
+        self._sampler = sampler
+
+    def new_sampler(self):
+        """
+        A fresh llama.cpp grammar sampler at the start of the grammar. The
+        caller frees it with llama_cpp.llama_sampler_free.
+        """
+        return llama_cpp.llama_sampler_clone(self._sampler)
+
+    def __del__(self):
+        # Freed once no request holds the grammar, even after cache eviction
+        if self._sampler:
+            llama_cpp.llama_sampler_free(self._sampler)
+            self._sampler = None
+
+
+class GrammarCache:
+    """
+    Compiled grammars of one model in a bounded LRU, keyed by content hash,
+    so the same schema sent with every request is converted to GBNF and
+    parsed by llama.cpp only once.
+    """
+
+    def __init__(self, llama: Llama, capacity: int = 32):
+        self._llama = llama
+        self.capacity = capacity
+        self._entries: "OrderedDict[str, CompiledGrammar]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compile_seconds = 0.0
+
+    def get(
+        self, grammar: Optional[str] = None, json_schema: Optional[Any] = None
+    ) -> CompiledGrammar:
+        """
+        The compiled form of a GBNF grammar or a JSON schema, exactly one of
+        which must be given. Raises ValueError if it does not compile.
+        """
+        if (grammar is None) == (json_schema is None):
+            raise ValueError("Pass either a grammar or a JSON schema")
+        key = grammar_key(grammar, json_schema)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        # Compiled outside the lock; two requests racing on a new grammar
+        # both compile it, which is harmless
+        started = time.perf_counter()
+        compiled = self._compile(key, grammar, json_schema)
+        with self._lock:
+            self.compile_seconds += time.perf_counter() - started
+            if self.capacity > 0:
+                self._entries[key] = compiled
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+        return compiled
+
+    def _compile(
+        self, key: str, grammar: Optional[str], json_schema: Optional[Any]
+    ) -> CompiledGrammar:
+        if json_schema is not None:
+            try:
+                grammar = json_schema_to_gbnf(json.dumps(json_schema))
+            except Exception as e:
+                raise ValueError(f"Unsupported JSON schema: {e}") from e
+            grammar = grammar.replace(_JSON_CHAR, _STRICT_JSON_CHAR)
+        # llama.cpp logs parse errors and returns NULL
+        sampler = llama_cpp.llama_sampler_init_grammar(
+            llama_cpp.llama_model_get_vocab(self._llama.model),
+            grammar.encode("utf-8"),
+            b"root",
+        )
+        if not sampler:
+            raise ValueError("Grammar failed to parse")
+        return CompiledGrammar(key, grammar, sampler)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "compile_ms": round(self.compile_seconds * 1000, 3),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,54 @@
+"""
+Unit tests for the compiled-grammar cache.
+"""
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+from app.models.grammar import GrammarCache
+
+SCHEMA = {
+    "type": "object",
+    "properties": {"path": {"type": "string"}, "line": {"type": "integer"}},
+}
+
+
+class TestGrammarCache(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("app.models.grammar.llama_cpp")
+        self.llama_cpp = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = GrammarCache(MagicMock(), capacity=2)
+        # Free the mock samplers while llama_cpp is still patched
+        self.addCleanup(self.cache.clear)
+
+    def test_same_schema_compiles_once(self):
+        first = self.cache.get(json_schema=SCHEMA)
+        # Key order does not change the hash
+        reordered = {"properties": SCHEMA["properties"], "type": "object"}
+        self.assertIs(self.cache.get(json_schema=reordered), first)
+        self.assertEqual(self.llama_cpp.llama_sampler_init_grammar.call_count, 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        # JSON strings never admit raw control characters
+        self.assertIn(r"\x00-\x1F", first.gbnf)
+
+    def test_least_recently_used_grammar_is_dropped(self):
+        a = self.cache.get(grammar='root ::= "a"')
+        self.cache.get(grammar='root ::= "b"')
+        self.cache.get(grammar='root ::= "a"')
+        self.cache.get(grammar='root ::= "c"')
+        self.assertIs(self.cache.get(grammar='root ::= "a"'), a)
+        self.cache.get(grammar='root ::= "b"')
+        self.assertEqual(self.cache.stats()["misses"], 4)
+
+    def test_invalid_grammar_raises(self):
+        self.llama_cpp.llama_sampler_init_grammar.return_value = None
+        with self.assertRaises(ValueError):
+            self.cache.get(grammar="root ::= (")
+        with self.assertRaises(ValueError):
+            self.cache.get(grammar='root ::= "a"', json_schema=SCHEMA)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
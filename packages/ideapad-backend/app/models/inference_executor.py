@@ -0,0 +1,227 @@
+"""Per-model inference executor: a single worker thread fed by a bounded asyncio queue"""
+
+import asyncio
+import contextvars
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from app.exceptions import InferenceQueueFullError
+from app.metrics import current_endpoint, observe_stage
+
+_END = object()
+
+
+class _Job:
+    __slots__ = ("fn", "args", "future", "enqueued_at", "context")
+
+    def __init__(self, fn: Callable, args: tuple, future: asyncio.Future):
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        # The submitting request's context, so work on the worker thread is
+        # labeled with its endpoint
+        self.context = contextvars.copy_context()
+
+
+class InferenceExecutor:
+    """
+    Runs blocking inference calls for one loaded model on a dedicated worker
+    thread so the event loop stays responsive. Jobs wait in a bounded queue;
+    when it is full, submissions fail fast with InferenceQueueFullError.
+    With workers > 1 (continuous batching) that many jobs run at once.
+    """
+
+    def __init__(self, name: str, max_queue_size: int = 8, workers: int = 1):
+        self.name = name
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"inference-{name}"
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._running = 0
+
+        self.submitted = 0
+        self.started = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        Queue fn(*args) for the worker thread and wait for its result.
+        """
+        return await self.submit(fn, *args)
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> asyncio.Future:
+        """
+        Queue fn(*args) for the worker thread and return a future for its result.
+        Must be called from the event loop; raises InferenceQueueFullError when
+        the queue is full.
+        """
+        loop = asyncio.get_running_loop()
+        self._ensure_started(loop)
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait(_Job(fn, args, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise InferenceQueueFullError()
+        self.submitted += 1
+        return future
+
+    def submit_stream(
+        self, make_events: Callable[[], Iterator[Any]]
+    ) -> AsyncIterator[Any]:
+        """
+        Queue a streaming job and return an async iterator over its events.
+        The generator returned by make_events() is drained on the worker thread
+        at most one event ahead of the consumer: it is only resumed once the
+        consumer has taken the event before, so a slow reader slows decoding
+        down. Closing the async iterator early stops it at the next event,
+        which is dropped, so the generator is closed at the first event never
+        handed on.
+        """
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        # Released each time the consumer takes an event, and once on close
+        taken = threading.Semaphore(0)
+        received = 0
+
+        def drain():
+            source = make_events()
+            handed = 0
+            try:
+                for event in source:
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+                    handed += 1
+                    taken.acquire()
+                    # Resuming the generator tells it its event was taken
+                    if stop.is_set() and received < handed:
+                        break
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, e)
+            finally:
+                close = getattr(source, "close", None)
+                if close is not None:
+                    close()
+                loop.call_soon_threadsafe(events.put_nowait, _END)
+
+        def release():
+            stop.set()
+            taken.release()
+
+        future = self.submit(drain)
+
+        async def iterate() -> AsyncIterator[Any]:
+            nonlocal received
+            try:
+                while True:
+                    item = await events.get()
+                    if item is _END:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    received += 1
+                    taken.release()
+                    yield item
+            finally:
+                release()
+                future.cancel()
+
+        stream = iterate()
+        # An iterator dropped without being started never runs its finally
+        weakref.finalize(stream, release)
+        return stream
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Queue depth and wait-time counters, used to size max_queue_size.
+        """
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_size": self.max_queue_size,
+            "running": self._running,
+            "workers": self.workers,
+            "submitted": self.submitted,
+            "started": self.started,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": (
+                self._total_wait / self.started * 1000 if self.started else 0.0
+            ),
+            "max_wait_ms": self._max_wait * 1000,
+            "total_wait_ms": self._total_wait * 1000,
+        }
+
+    def shutdown(self):
+        """
+        Stop the dispatcher and the worker thread. Safe to call from any thread.
+        """
+        if self._dispatcher is not None and self._loop is not None:
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._dispatcher.cancel)
+            self._dispatcher = None
+        self._pool.shutdown(wait=False)
+
+    def _ensure_started(self, loop: asyncio.AbstractEventLoop):
+        # The queue and dispatcher belong to one event loop; rebuild them if
+        # the executor is used from a new loop (e.g. after a server restart)
+        if self._loop is loop and self._dispatcher is not None:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._slots = asyncio.Semaphore(self.workers)
+        self._dispatcher = loop.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        queue, slots = self._queue, self._slots
+        while True:
+            await slots.acquire()
+            job = await queue.get()
+            if job.future.cancelled():
+                slots.release()
+                continue
+            wait = time.monotonic() - job.enqueued_at
+            self.started += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            observe_stage(
+                self.name, "queue_wait", wait, job.context.get(current_endpoint)
+            )
+            task = asyncio.ensure_future(self._execute(job, slots))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job: _Job, slots: asyncio.Semaphore):
+        loop = asyncio.get_running_loop()
+        self._running += 1
+        try:
+            result = await loop.run_in_executor(
+                self._pool, job.context.run, job.fn, *job.args
+            )
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.completed += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            slots.release()
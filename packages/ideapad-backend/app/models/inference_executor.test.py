@@ -0,0 +1,84 @@
+"""
+Unit tests for the per-model inference executor.
+"""
+
+import asyncio
+import threading
+import unittest
+from app.models.inference_executor import InferenceExecutor
+from app.exceptions import InferenceQueueFullError
+
+
+class TestInferenceExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = InferenceExecutor("test", max_queue_size=1)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_run_returns_result_off_loop(self):
+        async def scenario():
+            loop_thread = threading.get_ident()
+            return await self.executor.run(
+                lambda: threading.get_ident() != loop_thread
+            )
+
+        self.assertTrue(asyncio.run(scenario()))
+        self.assertEqual(self.executor.stats()["completed"], 1)
+
+    def test_full_queue_rejects(self):
+        release = threading.Event()
+
+        async def scenario():
+            first = self.executor.submit(release.wait)
+            with self.assertRaises(InferenceQueueFullError):
+                self.executor.submit(release.wait)
+            release.set()
+            await first
+
+        asyncio.run(scenario())
+        self.assertEqual(self.executor.stats()["rejected"], 1)
+
+    def test_stream_yields_events_in_order(self):
+        async def scenario():
+            events = self.executor.submit_stream(lambda: iter([1, 2, 3]))
+            return [event async for event in events]
+
+        self.assertEqual(asyncio.run(scenario()), [1, 2, 3])
+
+    def test_stream_propagates_errors(self):
+        def failing():
+            yield 1
+            raise RuntimeError("boom")
+
+        async def scenario():
+            async for _ in self.executor.submit_stream(failing):
+                pass
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(scenario())
+
+    def test_closing_a_stream_stops_its_generator(self):
+        produced, closed = [], threading.Event()
+        taken = threading.Event()
+
+        def tokens():
+            try:
+                for i in range(1000):
+                    produced.append(i)
+                    if i == 1:
+                        # The consumer closes before the next event is handed on
+                        taken.wait(5)
+                    yield i
+            finally:
+                closed.set()
+
+        async def scenario():
+            events = self.executor.submit_stream(tokens)
+            first = await events.__anext__()
+            await events.aclose()
+            taken.set()
+            await asyncio.get_running_loop().run_in_executor(None, closed.wait, 5)
+            return first
+
+        self.assertEqual(asyncio.run(scenario()), 0)
+        self.assertTrue(closed.is_set())
+        self.assertEqual(produced, [0, 1])
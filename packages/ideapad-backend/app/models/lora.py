@@ -0,0 +1,190 @@
+"""LoRA adapters: loaded once per base model and applied per conversation on its shared llama contexts"""
+
+import ctypes
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import llama_cpp
+from llama_cpp import Llama
+
+from app.types import ModelConfig
+from app.models.catalog import models_dir
+from app.models.response_cache import model_fingerprint
+
+# Resolved adapter paths and scales, sorted by path; LoRA deltas add up, so
+# the order they are listed in makes no difference
+AdapterSet = tuple[tuple[str, float], ...]
+
+
+def adapters_dir(config: ModelConfig) -> Path:
+    """
+    The configured LoRA adapter directory, or lora/ in the models directory.
+    Relative paths are resolved against the project root, like model paths.
+    """
+    if not config.lora_adapters_dir:
+        return models_dir(config) / "lora"
+    directory = Path(config.lora_adapters_dir).expanduser()
+    if not directory.is_absolute():
+        directory = Path(__file__).resolve().parents[4] / directory
+    return directory
+
+
+def _address(ctx) -> int:
+    # llama_context pointers come back as ints or c_void_p, depending on caller
+    return ctypes.cast(ctx, ctypes.c_void_p).value or 0
+
+
+class LoraCache:
+    """
+    LoRA adapters of one base model, each loaded once and shared by every
+    conversation and context that uses it. Beyond capacity, least recently
+    used adapters that no context has applied are freed. Applying a set to a
+    context only swaps pointers; the base weights are never reloaded.
+    """
+
+    def __init__(self, llama: Llama, directory: Optional[str], capacity: int = 8):
+        self._llama = llama
+        self.dir = Path(directory).expanduser() if directory else None
+        self.capacity = capacity
+        self._adapters: "OrderedDict[str, Any]" = OrderedDict()
+        self._fingerprints: dict[str, str] = {}
+        # Adapter set applied to each context, by context address
+        self._applied: dict[int, tuple[Any, AdapterSet]] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        self.switches = 0
+        self.load_seconds = 0.0
+
+    def resolve(self, adapters: Iterable[tuple[str, float]]) -> AdapterSet:
+        """
+        The canonical set for (path, scale) pairs. Relative paths are looked
+        up in the adapters directory. Every adapter is loaded now, so a path
+        that does not exist or does not fit the base model raises ValueError
+        here rather than failing a later turn.
+        """
+        resolved: dict[str, float] = {}
+        for path, scale in adapters:
+            candidate = Path(path).expanduser()
+            if not candidate.is_absolute() and self.dir is not None:
+                candidate = self.dir / candidate
+            if not candidate.is_file():
+                raise ValueError(f"LoRA adapter does not exist: {candidate}")
+            key = str(candidate.resolve())
+            if key in resolved:
+                raise ValueError(f"LoRA adapter listed twice: {path}")
+            resolved[key] = float(scale)
+        adapter_set = tuple(sorted(resolved.items()))
+        with self._lock:
+            for path, _ in adapter_set:
+                self._load(path, keep=resolved)
+        return adapter_set
+
+    def key(self, adapters: AdapterSet) -> str:
+        """
+        Identifies the weights an adapter set produces, by adapter content
+        and scale; "" for the base model alone.
+        """
+        if not adapters:
+            return ""
+        digest = hashlib.blake2b(digest_size=16)
+        for path, scale in adapters:
+            fingerprint = self._fingerprints.get(path) or model_fingerprint(path)
+            digest.update(f"{fingerprint}:{scale!r};".encode())
+        return digest.hexdigest()
+
+    def apply(self, ctx, adapters: AdapterSet):
+        """
+        Make a llama context decode with this adapter set, loading adapters
+        that were freed since. A no-op if the context already has it. Must be
+        called while nothing decodes in the context; its KV cache is not
+        touched, and whatever it holds was computed with the previous set.
+        """
+        address = _address(ctx)
+        with self._lock:
+            current = self._applied.get(address)
+            if current is not None and current[1] == adapters:
+                return
+            if current is None and not adapters:
+                return
+            keep = {path for path, _ in adapters}
+            pointers = [self._load(path, keep) for path, _ in adapters]
+            n = len(adapters)
+            array, scales = None, None
+            if n:
+                array = (llama_cpp.llama_adapter_lora_p_ctypes * n)(*pointers)
+                scales = (ctypes.c_float * n)(*(scale for _, scale in adapters))
+            if llama_cpp.llama_set_adapters_lora(ctx, array, n, scales) != 0:
+                raise RuntimeError("Failed to apply LoRA adapters")
+            if adapters:
+                self._applied[address] = (ctx, adapters)
+            else:
+                self._applied.pop(address, None)
+            self.switches += 1
+
+    def forget(self, ctx):
+        """
+        Drop what is recorded for a context that is about to be freed.
+        """
+        with self._lock:
+            self._applied.pop(_address(ctx), None)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded": [Path(path).name for path in self._adapters],
+                "capacity": self.capacity,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "switches": self.switches,
+                "load_ms": round(self.load_seconds * 1000, 3),
+            }
+
+    def clear(self):
+        """
+        Take the adapters off every context still using them and free them.
+        Must be called before the base model is freed.
+        """
+        with self._lock:
+            for ctx, _ in self._applied.values():
+                llama_cpp.llama_set_adapters_lora(ctx, None, 0, None)
+            self._applied.clear()
+            for adapter in self._adapters.values():
+                llama_cpp.llama_adapter_lora_free(adapter)
+            self._adapters.clear()
+
+    def _load(self, path: str, keep: Iterable[str] = ()):
+        # Must be called with the lock held; adapters in keep are not freed
+        adapter = self._adapters.get(path)
+        if adapter is not None:
+            self._adapters.move_to_end(path)
+            return adapter
+        started = time.perf_counter()
+        # llama.cpp logs why an adapter does not fit the model and returns NULL
+        adapter = llama_cpp.llama_adapter_lora_init(
+            self._llama.model, path.encode("utf-8")
+        )
+        if not adapter:
+            raise ValueError(f"LoRA adapter does not fit the model: {path}")
+        self.load_seconds += time.perf_counter() - started
+        self.loads += 1
+        self._adapters[path] = adapter
+        self._fingerprints[path] = model_fingerprint(path)
+        self._evict(keep)
+        return adapter
+
+    def _evict(self, keep: Iterable[str]):
+        # Must be called with the lock held
+        in_use = {path for _, applied in self._applied.values() for path, _ in applied}
+        in_use.update(keep)
+        for path in list(self._adapters):
+            if len(self._adapters) <= self.capacity:
+                return
+            if path in in_use:
+                continue
+            llama_cpp.llama_adapter_lora_free(self._adapters.pop(path))
+            self.evictions += 1
@@ -0,0 +1,66 @@
+"""
+Unit tests for the LoRA adapter cache.
+"""
+
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from app.models.lora import LoraCache
+
+
+class TestLoraCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dir)
+        for name in ("style.gguf", "sql.gguf", "docs.gguf"):
+            (self.dir / name).write_bytes(name.encode())
+        patcher = patch("app.models.lora.llama_cpp")
+        self.llama_cpp = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.llama_cpp.llama_set_adapters_lora.return_value = 0
+        self.cache = LoraCache(MagicMock(), str(self.dir), capacity=2)
+        self.ctx = 0x1000
+
+    def test_sets_are_canonical_and_loaded_once(self):
+        first = self.cache.resolve([("sql.gguf", 0.5), ("style.gguf", 1)])
+        style = str(self.dir / "style.gguf")
+        second = self.cache.resolve([(style, 1.0), ("sql.gguf", 0.5)])
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.key(first), self.cache.key(second))
+        self.assertNotEqual(
+            self.cache.key(first), self.cache.key(((first[0][0], 0.25), first[1]))
+        )
+        self.assertEqual(self.llama_cpp.llama_adapter_lora_init.call_count, 2)
+        self.assertEqual(self.cache.key(()), "")
+
+    def test_bad_adapters_raise(self):
+        with self.assertRaises(ValueError):
+            self.cache.resolve([("missing.gguf", 1.0)])
+        with self.assertRaises(ValueError):
+            self.cache.resolve([("style.gguf", 1.0), ("style.gguf", 0.5)])
+        self.llama_cpp.llama_adapter_lora_init.return_value = None
+        with self.assertRaises(ValueError):
+            self.cache.resolve([("style.gguf", 1.0)])
+
+    def test_applied_adapters_are_never_freed(self):
+        style = self.cache.resolve([("style.gguf", 1.0)])
+        self.cache.apply(self.ctx, style)
+        self.cache.apply(self.ctx, style)
+        self.assertEqual(self.cache.stats()["switches"], 1)
+
+        self.cache.resolve([("sql.gguf", 1.0)])
+        self.cache.resolve([("docs.gguf", 1.0)])
+        # Over capacity: the idle sql adapter goes, the applied one stays
+        self.assertEqual(self.cache.stats()["loaded"], ["style.gguf", "docs.gguf"])
+        self.assertEqual(self.llama_cpp.llama_adapter_lora_free.call_count, 1)
+
+        self.cache.apply(self.ctx, ())
+        self.cache.clear()
+        self.assertEqual(self.llama_cpp.llama_adapter_lora_free.call_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
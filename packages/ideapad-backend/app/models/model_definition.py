@@ -1,6 +1,68 @@
+import threading
+import time
 from pathlib import Path
-from llama_cpp import Llama
-from app.types import ModelConfig
+from typing import Callable, Iterator, Optional
+from llama_cpp import Llama, LlamaState, LogitsProcessorList, llama_chat_format
+from app.types import LoraAdapter, ModelConfig
+from app.metrics import GenerationTimer, LlamaPerf, observe_stage, timed_tokenize
+from app.models.inference_executor import InferenceExecutor
+from app.models.autotune import KV_CACHE_TYPES, apply_profile
+from app.models.batch_scheduler import BatchHandle, BatchScheduler
+from app.models.catalog import resolve_model_path
+from app.models.completion import CompletionEngine, PriorityGate
+from app.models.grammar import CompiledGrammar, GrammarCache
+from app.models.lora import AdapterSet, LoraCache, adapters_dir
+from app.models.prefix_cache import PrefixCache, state_nbytes
+from app.models.response_cache import ResponseCache, model_fingerprint, response_key
+from app.models.speculative import SpeculativeDraft, create_draft
+
+
+class _UsageCounter:
+    """
+    Pass-through logits processor that counts prompt and completion tokens,
+    since llama.cpp does not report usage for streamed completions.
+    on_prefilled runs at the first sample, once the prompt is evaluated.
+    """
+
+    def __init__(self, on_prefilled: Optional[Callable[[], None]] = None):
+        self.prompt_tokens = 0
+        self.samples = 0
+        self._on_prefilled = on_prefilled
+
+    def __call__(self, input_ids, scores):
+        if self.samples == 0:
+            self.prompt_tokens = len(input_ids)
+            if self._on_prefilled is not None:
+                self._on_prefilled()
+        self.samples += 1
+        return scores
+
+    def as_dict(self, finish_reason: Optional[str]) -> dict[str, int]:
+        # A "stop" finish samples one final token (EOS) that is never emitted
+        completion = self.samples - 1 if finish_reason == "stop" else self.samples
+        completion = max(completion, 0)
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": completion,
+            "total_tokens": self.prompt_tokens + completion,
+        }
+
+
+class SequenceState:
+    """
+    Per-conversation decode state kept between turns. While a conversation owns
+    the shared llama context its KV cache lives there; when another conversation
+    takes the context over, a snapshot is saved here and restored on its next turn.
+    The LoRA adapters the conversation decodes with are fixed for its KV cache.
+    """
+
+    def __init__(self, adapters: AdapterSet = ()):
+        self.snapshot: Optional[LlamaState] = None
+        self.adapters = adapters
+
+    @property
+    def snapshot_bytes(self) -> int:
+        return state_nbytes(self.snapshot) if self.snapshot is not None else 0
 
 
 class ModelDefinition:
@@ -9,8 +71,14 @@ class ModelDefinition:
     """
 
     def __init__(self, config: ModelConfig):
+        self.model_path = resolve_model_path(config.model_path)
+        print("Resolved model path:", self.model_path)
+        self.name = Path(self.model_path).stem
+        # A saved autotune profile for this model and CPU overrides the defaults
+        config = apply_profile(config, self.model_path)
+
         self.n_ctx: int = getattr(config, "n_ctx", 2048)
-        self.max_tokens: int = getattr(config, "model_tokens", 512)
+        self.max_tokens: int = getattr(config, "max_tokens", 512)
         self.temperature: float = getattr(config, "temperature", 0.7)
         self.top_p: float = getattr(config, "top_p", 0.95)
         self.top_k: int = getattr(config, "top_k", 40)
@@ -18,44 +86,264 @@ class ModelDefinition:
         self.repeat_last_n: int = getattr(config, "repeat_last_n", 64)
         self.num_threads: int = getattr(config, "num_threads", 4)
         self.num_predict: int = getattr(config, "num_predict", 1)
+        self.n_threads_batch: int = config.n_threads_batch or self.num_threads
+        self.n_batch: int = config.n_batch
+        self.seed: Optional[int] = getattr(config, "seed", None)
+        self.max_batch_sequences: int = config.max_batch_sequences
+        self.completion_max_tokens: int = config.completion_max_tokens
+        self.completion_n_ctx: int = config.completion_n_ctx
+        self.completion_fim_order: str = config.completion_fim_order
 
-        raw_path_str: str = config.model_path or "models/default.gguf"
-        raw_path = Path(raw_path_str)    
         print("Loaded config:", config)
-        candidate = Path(raw_path)
-        print("Resolved model path:", candidate)
-        # Always define project_root for later use
-        project_root = Path(__file__).resolve().parents[4]
-        # Resolve relative paths against project root
-        if not candidate.is_absolute():
-            candidate = (project_root / raw_path).expanduser()
-        else:
-            candidate = candidate.expanduser()
-        if not candidate.exists():
-            print(f"Project root: {project_root}")
-            raise RuntimeError(f"Model path does not exist: {candidate}")
-        self.model_path = str(candidate)
+        self.lock = threading.Lock()
+        # Chat decoding pauses between tokens while a code completion runs
+        self.priority = PriorityGate()
+        # Conversation whose KV cache currently occupies the llama context
+        self._resident: Optional[SequenceState] = None
+        # LoRA adapters applied to the llama context
+        self._adapters: AdapterSet = ()
+        # Everything besides the weights that decides whether a saved KV state
+        # loads into this context
+        self._kv_layout = f"{self.n_ctx}:{config.kv_cache_type}:{config.flash_attn}"
 
+        started = time.perf_counter()
+        # Speculative decoding drafts tokens that one batched forward pass of
+        # the model then verifies; llama.cpp keeps the output unchanged
+        self.speculative: Optional[SpeculativeDraft] = None
+        if config.speculative != "off" and config.continuous_batching:
+            print("Speculative decoding is not used with continuous batching")
+        elif config.speculative != "off":
+            try:
+                self.speculative = create_draft(
+                    config, self.n_ctx, self.num_threads, self.n_threads_batch
+                )
+            except Exception as e:
+                raise RuntimeError(f"Failed to initialize draft model: {e}") from e
         try:
-            self.model: Llama = Llama(model_path=self.model_path, n_ctx=self.n_ctx)
+            kv_type = KV_CACHE_TYPES[config.kv_cache_type]
+            self.model: Llama = Llama(
+                model_path=self.model_path,
+                n_ctx=self.n_ctx,
+                n_batch=self.n_batch,
+                n_threads=self.num_threads,
+                n_threads_batch=self.n_threads_batch,
+                use_mmap=config.use_mmap,
+                use_mlock=config.use_mlock,
+                type_k=kv_type,
+                type_v=kv_type,
+                # A quantized V cache needs flash attention
+                flash_attn=config.flash_attn or config.kv_cache_type != "f16",
+                draft_model=self.speculative,
+            )
         except Exception as e:
+            if self.speculative is not None:
+                self.speculative.close()
             raise RuntimeError(f"Failed to initialize Llama model: {e}") from e
+        if self.speculative is not None:
+            try:
+                self.speculative.check_compatible(self.model)
+            except RuntimeError:
+                self.speculative.close()
+                self.model.close()
+                raise
+        self.model.tokenize = timed_tokenize(self.model.tokenize)
+        # Grammars and JSON schemas of structured-output requests, compiled
+        # against this model's vocabulary once and reused by later requests
+        self.grammars = GrammarCache(self.model, capacity=config.grammar_cache_entries)
+        # LoRA adapters of conversations, loaded once on top of these weights
+        self.lora = LoraCache(
+            self.model, str(adapters_dir(config)), capacity=config.lora_max_adapters
+        )
+        # llama.cpp's perf counters of the main context, read after each
+        # generation so /metrics never touches a context that is in use
+        self._llama_perf = LlamaPerf(self.model.ctx)
 
-    def generate_response(self, prompt: str) -> str:
-        if not prompt:
-            raise ValueError("Prompt must be a non-empty string")
+        # Prompt prefixes shared across conversations (system prompt, pasted
+        # files) are restored from cached KV state instead of being prefilled
+        self.prefix_cache: Optional[PrefixCache] = None
+        # Content hash of the model file, computed on first use
+        self._fingerprint: Optional[str] = None
+        if config.prefix_cache_bytes > 0:
+            self.prefix_cache = PrefixCache(
+                config.prefix_cache_bytes,
+                cache_dir=config.prefix_cache_dir,
+                disk_capacity_bytes=config.prefix_cache_disk_bytes,
+                scope=self.state_key() if config.prefix_cache_dir else "",
+            )
+            self.model.set_cache(self.prefix_cache)
+
+        # Identical requests under deterministic sampling get identical answers,
+        # so those are served from a response cache
+        self.response_cache: Optional[ResponseCache] = None
+        if config.response_cache_entries > 0 and self.deterministic:
+            self._fingerprint = model_fingerprint(self.model_path)
+            self.response_cache = ResponseCache(
+                config.response_cache_entries,
+                cache_dir=config.response_cache_dir,
+                disk_capacity=config.response_cache_disk_entries,
+            )
 
+        # With continuous batching, concurrent requests decode together as
+        # separate sequences of a second, multi-sequence context
+        self.scheduler: Optional[BatchScheduler] = None
+        self._chat_formatter = None
+        if config.continuous_batching:
+            self.scheduler = self._new_scheduler()
+        # Without continuous batching, /batch requests get a multi-sequence
+        # context of their own, created on first use
+        self._batch_scheduler: Optional[BatchScheduler] = None
+        self._batch_lock = threading.Lock()
+        # Code completions get a context and queue of their own, created on
+        # first use, so they never wait behind a chat answer
+        self._completer: Optional[CompletionEngine] = None
+        self.completion_executor = InferenceExecutor(
+            f"{self.name}-complete", max_queue_size=config.max_queue_size
+        )
+
+        # Requests for this model are queued and run on its own worker thread(s)
+        self.executor = InferenceExecutor(
+            self.name,
+            max_queue_size=config.max_queue_size,
+            workers=config.max_batch_sequences if self.scheduler else 1,
+        )
+        self.load_seconds = time.perf_counter() - started
+        observe_stage(self.name, "load", self.load_seconds)
+
+        # Warm up once per loaded model, not once per conversation
+        started = time.perf_counter()
         try:
-            result = self.model.create_chat_completion(
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                stop=["\n"],
-                stream=False,
+            self._warm_up(getattr(config, "warm_up", "minimal"))
+        except Exception:
+            self.close()
+            raise
+        self.warm_up_seconds = time.perf_counter() - started
+        observe_stage(self.name, "warm_up", self.warm_up_seconds)
+
+    def generate_response(
+        self,
+        messages: list[dict[str, str]],
+        state: Optional[SequenceState] = None,
+        max_tokens: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+    ) -> str:
+        """
+        Answer the last message given the full conversation. Passing the
+        conversation's SequenceState lets llama.cpp reuse its KV cache, so only
+        the tokens of the new turn are prefilled. max_tokens overrides the
+        configured limit, e.g. to fit what is left of the context window.
+        With a grammar from compile_grammar(), only text it accepts is decoded
+        and the answer is not cut at the first newline.
+        With deterministic sampling, repeated requests come from the response
+        cache and concurrent identical ones share a single generation.
+        """
+        if not messages or not messages[-1].get("content"):
+            raise ValueError("Prompt must be a non-empty string")
+        max_tokens = max_tokens or self.max_tokens
+
+        if self.response_cache is not None:
+            adapters = state.adapters if state is not None else ()
+            key = response_key(
+                self._fingerprint,
+                self._sampling(max_tokens, grammar, adapters),
+                messages,
             )
+            return self.response_cache.get_or_compute(
+                key,
+                lambda: self._generate_response(messages, state, max_tokens, grammar),
+            )
+        return self._generate_response(messages, state, max_tokens, grammar)
+
+    def resolve_adapters(self, adapters: list[LoraAdapter]) -> AdapterSet:
+        """
+        The adapter set for a conversation's LoRA adapters, loading the ones
+        not loaded yet. Raises ValueError if one is missing or was not
+        trained for this model.
+        """
+        return self.lora.resolve((adapter.path, adapter.scale) for adapter in adapters)
+
+    def compile_grammar(
+        self, grammar: Optional[str] = None, json_schema: Optional[dict] = None
+    ) -> Optional[CompiledGrammar]:
+        """
+        The compiled form of a GBNF grammar or JSON schema for this model, from
+        the grammar cache when it was seen before, or None if neither is given.
+        Raises ValueError if it does not compile.
+        """
+        if grammar is None and json_schema is None:
+            return None
+        return self.grammars.get(grammar, json_schema)
+
+    @property
+    def deterministic(self) -> bool:
+        """
+        Whether the same messages always produce the same answer.
+        """
+        return self.temperature <= 0 or self.seed is not None
+
+    def _sampling(
+        self,
+        max_tokens: int,
+        grammar: Optional[CompiledGrammar] = None,
+        adapters: AdapterSet = (),
+    ) -> dict:
+        sampling = {
+            "max_tokens": max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "repeat_penalty": self.repeat_penalty,
+            "repeat_last_n": self.repeat_last_n,
+            "seed": self.seed,
+            "stop": self._stop(grammar),
+        }
+        if grammar is not None:
+            sampling["grammar"] = grammar.key
+        if adapters:
+            sampling["lora"] = self.lora.key(adapters)
+        return sampling
+
+    @staticmethod
+    def _stop(grammar: Optional[CompiledGrammar]) -> list[str]:
+        # Structured output spans lines; its grammar decides where it ends
+        return [] if grammar is not None else ["\n"]
+
+    def _generate_response(
+        self,
+        messages: list[dict[str, str]],
+        state: Optional[SequenceState],
+        max_tokens: int,
+        grammar: Optional[CompiledGrammar] = None,
+    ) -> str:
+        if self.scheduler is not None:
+            adapters = state.adapters if state is not None else ()
+            events = self._generate_batched(messages, max_tokens, grammar, adapters)
+            return "".join(e["text"] for e in events if e["type"] == "token").strip()
+
+        try:
+            # The llama context is shared by every conversation using this model
+            with self.lock:
+                timer = GenerationTimer(self.name)
+                usage = self._begin_generation(state, timer)
+                result = self.model.create_chat_completion(
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=self.temperature,
+                    stop=self._stop(grammar),
+                    seed=self.seed,
+                    logits_processor=LogitsProcessorList([self.priority, usage]),
+                    grammar=grammar.llama_grammar if grammar is not None else None,
+                    stream=False,
+                )
+                self._record_decode(timer, usage)
         except Exception as e:
             raise RuntimeError(f"Model inference error: {e}") from e
 
+        try:
+            return self._response_text(result)
+        finally:
+            timer.finish()
+
+    def _response_text(self, result) -> str:
         if isinstance(
             result, dict
         ):  # Explicitly tell type checker we're handling non-stream response
@@ -73,10 +361,414 @@ class ModelDefinition:
 
         raise RuntimeError("Model returned invalid response structure.")
 
+    def generate_stream(
+        self,
+        messages: list[dict[str, str]],
+        state: Optional[SequenceState] = None,
+        max_tokens: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+    ) -> Iterator[dict]:
+        """
+        Stream the answer to the last message as llama.cpp decodes it.
+        Yields {"type": "token", "text": ...} events followed by a single
+        {"type": "done", "finish_reason": ..., "usage": {...}} event.
+        A "length" finish under a grammar means the output is incomplete.
+        """
+        if not messages or not messages[-1].get("content"):
+            raise ValueError("Prompt must be a non-empty string")
+        max_tokens = max_tokens or self.max_tokens
+
+        if self.scheduler is not None:
+            adapters = state.adapters if state is not None else ()
+            yield from self._generate_batched(messages, max_tokens, grammar, adapters)
+            return
+
+        finish_reason = None
+        # The lock is held until the stream is exhausted or closed
+        with self.lock:
+            try:
+                timer = GenerationTimer(self.name)
+                usage = self._begin_generation(state, timer)
+                chunks = self.model.create_chat_completion(
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=self.temperature,
+                    stop=self._stop(grammar),
+                    seed=self.seed,
+                    logits_processor=LogitsProcessorList([self.priority, usage]),
+                    grammar=grammar.llama_grammar if grammar is not None else None,
+                    stream=True,
+                )
+                for chunk in chunks:
+                    choice = chunk["choices"][0]
+                    text = choice["delta"].get("content")
+                    if text:
+                        yield {"type": "token", "text": text}
+                    if choice.get("finish_reason") is not None:
+                        finish_reason = choice["finish_reason"]
+                self._record_decode(timer, usage)
+            except GeneratorExit:
+                raise
+            except Exception as e:
+                raise RuntimeError(f"Model inference error: {e}") from e
+
+        timer.finish()
+        yield {
+            "type": "done",
+            "finish_reason": finish_reason,
+            "usage": usage.as_dict(finish_reason),
+        }
+
+    def _warm_up(self, policy: str):
+        """
+        "minimal" evaluates a few tokens, which faults in the mmap'd weights and
+        starts llama.cpp's thread pool; "full" runs a whole generation;
+        "off" does nothing.
+        """
+        if policy == "minimal":
+            with self.lock:
+                self.model.eval(self.model.tokenize(b"Warm up", add_bos=True))
+                # Leave the context empty for the first real request
+                self.model.reset()
+                self._llama_perf.update()
+        elif policy == "full":
+            self._generate_response(
+                [{"role": "user", "content": "Warm up"}], None, self.max_tokens
+            )
+
+    def prefill(self, messages: list[dict[str, str]], state: SequenceState):
+        """
+        Evaluate a conversation's transcript into its KV state ahead of its
+        next turn, so that turn only prefills the new message.
+        """
+        if self.scheduler is not None:
+            # Batched sequences do not keep KV state between turns
+            return
+        tokens = self._chat_prompt_tokens(messages)
+        if len(tokens) >= self.n_ctx:
+            return
+        with self.lock:
+            self._activate(state)
+            self.model.reset()
+            self.model.eval(tokens)
+            self._llama_perf.update()
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Number of tokens text encodes to, without BOS.
+        """
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def release_state(self, state: SequenceState):
+        """
+        Forget a finished conversation's KV state.
+        """
+        with self.lock:
+            if self._resident is state:
+                self._resident = None
+        state.snapshot = None
+
+    def save_state(self, state: SequenceState) -> Optional[LlamaState]:
+        """
+        A copy of a conversation's KV state, to keep beyond this process, or
+        None if it has none. Batched sequences do not keep KV state.
+        """
+        if self.scheduler is not None:
+            return None
+        with self.lock:
+            if state is self._resident:
+                return self.model.save_state() if self.model.n_tokens else None
+            return state.snapshot
+
+    def state_key(self, adapters: AdapterSet = ()) -> str:
+        """
+        Identifies the model file, LoRA adapters and context layout a saved
+        state belongs to; a state only loads into a context with the same key.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.model_path)
+        key = f"{self._fingerprint}:{self._kv_layout}"
+        return f"{key}:{self.lora.key(adapters)}" if adapters else key
+
+    def _activate(self, state: Optional[SequenceState]):
+        """
+        Make the llama context hold this conversation's KV cache, saving the
+        previous owner's cache first, and decode with its LoRA adapters.
+        Must be called with the lock held.
+        """
+        restored = False
+        if state is not self._resident:
+            if self._resident is not None:
+                self._resident.snapshot = self.model.save_state()
+            if state is not None and state.snapshot is not None:
+                self.model.load_state(state.snapshot)
+                # The live context now supersedes the snapshot
+                state.snapshot = None
+                restored = True
+            self._resident = state
+        adapters = state.adapters if state is not None else ()
+        if adapters != self._adapters:
+            self.lora.apply(self.model.ctx, adapters)
+            self._adapters = adapters
+            if not restored:
+                # Tokens the previous owner left behind were computed with
+                # other weights, so their KV cache cannot be reused
+                self.model.reset()
+            if self.prefix_cache is not None:
+                # Prefixes are only shared between conversations with the
+                # same adapters
+                self.prefix_cache.namespace = self.lora.key(adapters)
+
+    def _generate_batched(
+        self,
+        messages: list[dict[str, str]],
+        max_tokens: int,
+        grammar: Optional[CompiledGrammar] = None,
+        adapters: AdapterSet = (),
+    ) -> Iterator[dict]:
+        """
+        Run a chat completion as one sequence of the batch scheduler.
+        """
+        try:
+            timer = GenerationTimer(self.name)
+            tokens = self._chat_prompt_tokens(messages)
+            for event in self.scheduler.submit(
+                tokens,
+                max_tokens,
+                self.temperature,
+                stop=self._stop(grammar),
+                seed=self.seed,
+                grammar=grammar,
+                adapters=adapters,
+            ):
+                if event["type"] == "done":
+                    event = self._record_batched(event, timer)
+                yield event
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"Model inference error: {e}") from e
+
+    def generate_batch(
+        self,
+        prompts: list[list[dict[str, str]]],
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        stop: Optional[list[str]] = None,
+        seed: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+        adapters: AdapterSet = (),
+    ) -> BatchHandle:
+        """
+        Answer many independent conversations together, as sequences of the
+        batch scheduler: up to max_batch_sequences at a time are prefilled in
+        shared batches and decoded interleaved, the rest wait for a free slot.
+        Unset sampling settings fall back to the model's; a grammar constrains
+        every answer and LoRA adapters from resolve_adapters() apply to all
+        of them. Raises ValueError if a prompt does not fit in the context
+        window.
+        """
+        if not prompts or not all(m and m[-1].get("content") for m in prompts):
+            raise ValueError("Prompt must be a non-empty string")
+        scheduler = self.scheduler or self._ensure_batch_scheduler()
+        tokens = [self._chat_prompt_tokens(messages) for messages in prompts]
+        return scheduler.submit_batch(
+            tokens,
+            max_tokens or self.max_tokens,
+            self.temperature if temperature is None else temperature,
+            stop=stop,
+            seed=self.seed if seed is None else seed,
+            on_result=self._batch_result,
+            grammar=grammar,
+            adapters=adapters,
+        )
+
+    def complete(
+        self,
+        prefix: str,
+        suffix: str = "",
+        max_tokens: Optional[int] = None,
+        stop: Optional[list[str]] = None,
+        cancelled: Optional[threading.Event] = None,
+    ) -> dict:
+        """
+        Fill in the code between prefix and suffix. Chat generation on this
+        model pauses until it is done; setting cancelled stops it before the
+        next token. Raises ValueError if max_tokens leaves no room for a prompt.
+        """
+        completer = self._ensure_completer()
+        timer = GenerationTimer(self.name)
+        with self.priority.priority():
+            result = completer.complete(
+                prefix,
+                suffix,
+                max_tokens or self.completion_max_tokens,
+                stop=stop,
+                cancelled=cancelled,
+                timer=timer,
+            )
+        timer.finish()
+        return result
+
+    def _ensure_completer(self) -> CompletionEngine:
+        with self._batch_lock:
+            if self._completer is None:
+                self._completer = CompletionEngine(
+                    self.model,
+                    n_ctx=self.completion_n_ctx,
+                    n_batch=self.n_batch,
+                    n_threads=self.num_threads,
+                    n_threads_batch=self.n_threads_batch,
+                    fim_order=self.completion_fim_order,
+                )
+            return self._completer
+
+    def _batch_result(self, event: dict) -> dict:
+        event = self._record_batched(event)
+        event["text"] = event["text"].strip()
+        return event
+
+    def _record_batched(
+        self, event: dict, timer: Optional[GenerationTimer] = None
+    ) -> dict:
+        """
+        Record the stage timings of a finished batched sequence and return its
+        done event without them; they are for /metrics, not for the client.
+        """
+        timer = timer or GenerationTimer(self.name)
+        event = dict(event)
+        for stage, seconds in event.pop("timings").items():
+            timer.add(stage, seconds)
+        timer.add_tokens("prefill", event["usage"]["prompt_tokens"])
+        timer.add_tokens("decode", event["usage"]["completion_tokens"])
+        timer.finish(postprocess=False)
+        return event
+
+    def _ensure_batch_scheduler(self) -> BatchScheduler:
+        with self._batch_lock:
+            if self._batch_scheduler is None:
+                self._batch_scheduler = self._new_scheduler()
+            return self._batch_scheduler
+
+    def _new_scheduler(self) -> BatchScheduler:
+        return BatchScheduler(
+            self.model,
+            n_ctx=self.n_ctx,
+            max_sequences=self.max_batch_sequences,
+            n_batch=self.n_batch,
+            n_threads=self.num_threads,
+            n_threads_batch=self.n_threads_batch,
+            top_k=self.top_k,
+            top_p=self.top_p,
+            pause=self.priority.wait,
+            lora=self.lora,
+        )
+
+    def _begin_generation(
+        self, state: Optional[SequenceState], timer: GenerationTimer
+    ) -> _UsageCounter:
+        """
+        Give the llama context to this conversation and return a usage counter
+        that records llama.cpp's prefill timing once the prompt is evaluated.
+        Must be called with the lock held.
+        """
+        with timer.stage("kv_swap"):
+            self._activate(state)
+        if self.speculative is not None:
+            self.speculative.begin()
+        self._llama_perf.update()
+
+        def prefilled():
+            # Batches of several tokens count as prompt eval in llama.cpp, and
+            # a one-token prompt as eval, so both belong to prefill here
+            delta = self._llama_perf.update()
+            timer.add("prefill", (delta["t_p_eval_ms"] + delta["t_eval_ms"]) / 1000)
+            timer.add_tokens("prefill", delta["n_p_eval"] + delta["n_eval"])
+
+        return _UsageCounter(on_prefilled=prefilled)
+
+    def _record_decode(self, timer: GenerationTimer, usage: _UsageCounter):
+        """
+        Add llama.cpp's decode timing since the first sample. Speculative
+        verification evaluates drafts in batches, so every eval counts.
+        """
+        delta = self._llama_perf.update()
+        timer.add("decode", (delta["t_p_eval_ms"] + delta["t_eval_ms"]) / 1000)
+        timer.add_tokens("decode", usage.samples)
+
+    def llama_timings(self) -> dict[str, dict[str, float]]:
+        """
+        llama.cpp's load time and cumulative prompt-eval and eval counters,
+        per context.
+        """
+        contexts = {"main": self._llama_perf}
+        if self.scheduler is not None:
+            contexts["batched"] = self.scheduler.llama_perf
+        if self._batch_scheduler is not None:
+            contexts["batch_api"] = self._batch_scheduler.llama_perf
+        if self._completer is not None:
+            contexts["completion"] = self._completer.llama_perf
+        return {
+            context: dict(perf.totals, load_ms=perf.load_ms)
+            for context, perf in contexts.items()
+        }
+
+    def kv_cache_usage(self) -> dict[str, tuple[int, int]]:
+        """
+        Tokens held in, and capacity of, each llama context's KV cache.
+        """
+        usage = {"main": (self.model.n_tokens, self.n_ctx)}
+        if self.scheduler is not None:
+            usage["batched"] = self.scheduler.kv_cache_usage()
+        if self._batch_scheduler is not None:
+            usage["batch_api"] = self._batch_scheduler.kv_cache_usage()
+        if self._completer is not None:
+            usage["completion"] = self._completer.kv_cache_usage()
+        return usage
+
+    def _chat_prompt_tokens(self, messages: list[dict[str, str]]) -> list[int]:
+        """
+        Render messages with the model's chat template, as create_chat_completion
+        would, and tokenize the result.
+        """
+        if self._chat_formatter is None:
+            template = self.model.metadata.get("tokenizer.chat_template")
+            if template:
+                special = lambda token: self.model.detokenize(
+                    [token], special=True
+                ).decode("utf-8", errors="ignore")
+                self._chat_formatter = llama_chat_format.Jinja2ChatFormatter(
+                    template=template,
+                    eos_token=special(self.model.token_eos()),
+                    bos_token=special(self.model.token_bos()),
+                )
+            else:
+                self._chat_formatter = llama_chat_format.format_llama2
+        result = self._chat_formatter(messages=messages)
+        return self.model.tokenize(
+            result.prompt.encode("utf-8"),
+            add_bos=not result.added_special,
+            special=True,
+        )
+
     def close(self):
         """
         Safely closes the llama model and releases resources.
         """
+        self.executor.shutdown()
+        self.completion_executor.shutdown()
+        if self._completer is not None:
+            self._completer.close()
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self._batch_scheduler is not None:
+            self._batch_scheduler.close()
+        if self.speculative is not None:
+            self.speculative.close()
+        if self.prefix_cache is not None:
+            self.prefix_cache.close()
+        self.grammars.clear()
+        self.lora.clear()
         if hasattr(self.model, "close"):
             try:
                 self.model.close()
@@ -1,59 +1,375 @@
+import threading
 import uuid
-from app.models.model_definition import ModelDefinition
-from app.types import ModelConfig, ModelErrorDetailEnum
-from app.exceptions import ModelInferenceError, ModelShutdownError, to_http_exception
+from typing import Iterator, Optional
+from app.models.grammar import CompiledGrammar
+from app.models.lora import AdapterSet
+from app.models.model_definition import ModelDefinition, SequenceState
+from app.models.model_registry import model_registry
+from app.models.context_window import ContextWindow
+from app.models.conversation_store import get_conversation_store
+from app.models.retrieval import get_retriever
+from app.types import LoraAdapter, ModelConfig, ModelErrorDetailEnum
+from app.exceptions import (
+    InvalidPromptError,
+    ModelInferenceError,
+    ModelShutdownError,
+    to_http_exception,
+)
 
 
 class ModelInstance:
     """
     Represents a persistent model session tied to a conversation, identified by a UUID.
-    Handles session lifecycle, including warm-up and resource cleanup.
+    Handles session lifecycle and resource cleanup; warm-up happens once per
+    model when the registry loads it.
+    The underlying model is shared through the model registry; the instance
+    only owns its conversation history, kept in a token-budgeted ContextWindow.
+    With a conversation store configured, every finished turn is also queued
+    for writing there, and restore() brings the conversation back in a later
+    process. LoRA adapters in the config are applied on top of the shared
+    model for this conversation only.
     """
 
-    def __init__(self, config: ModelConfig):
-        self.conversation_id = str(uuid.uuid4())
+    def __init__(
+        self,
+        config: ModelConfig,
+        conversation_id: Optional[str] = None,
+        turns: Optional[list[dict[str, str]]] = None,
+        window_start: int = 0,
+    ):
+        self.conversation_id = conversation_id or str(uuid.uuid4())
         self.config = config
-        self.model = ModelDefinition(config)
-        self.run_warm_up()
-        self.history: list[dict[str, str]] = []
+        self.model: Optional[ModelDefinition] = model_registry.acquire(config)
+        try:
+            self.state = SequenceState(self._resolve_adapters(self.model, config))
+        except Exception:
+            model, self.model = self.model, None
+            model_registry.release(model)
+            raise
+        self.context = self._new_context(self.model)
+        for turn in turns or []:
+            self.context.append(turn["role"], turn["content"])
+        # Open the window where it was, so the prompt matches the saved KV state
+        self.context.start = min(window_start, len(self.context.turns))
+        # Held for a whole turn so a model switch never lands mid-generation
+        self._turn_lock = threading.Lock()
 
-    def get_response(self, prompt: str) -> str:
+        self._store = get_conversation_store(config)
+        # Turns already handed to the store
+        self._persisted = len(self.history)
+        if self._store is None:
+            return
+        if conversation_id is None:
+            self._store.create(
+                self.conversation_id, config.model_path, self._stored_adapters()
+            )
+        elif config.conversation_kv_snapshots and self.model.scheduler is None:
+            # Loaded into the llama context on the next turn
+            self.state.snapshot = self._store.load_snapshot(
+                self.conversation_id, self.model.state_key(self.state.adapters)
+            )
+
+    @classmethod
+    def restore(
+        cls, config: ModelConfig, conversation_id: str
+    ) -> Optional["ModelInstance"]:
+        """
+        Rebuild a conversation of an earlier process from the conversation
+        store, on the model and LoRA adapters it last used, or return None if
+        it is not stored.
+        Only the turns are read back; the KV cache comes from a saved snapshot
+        if there is one, and is otherwise prefilled by the next turn.
+        """
+        store = get_conversation_store(config)
+        stored = store.load(conversation_id) if store is not None else None
+        if stored is None:
+            return None
+        config = config.model_copy(
+            update={
+                "model_path": stored.model_path,
+                "lora_adapters": [LoraAdapter(**a) for a in stored.lora_adapters],
+            }
+        )
+        return cls(config, conversation_id, stored.turns, stored.window_start)
+
+    @staticmethod
+    def _resolve_adapters(model: ModelDefinition, config: ModelConfig) -> AdapterSet:
+        """
+        Load the config's LoRA adapters on the model. Raises a 400 if one is
+        missing or was not trained for the model.
+        """
+        if not config.lora_adapters:
+            return ()
         try:
-            # 1) append user turn
-            self.history.append({"role": "user", "content": prompt})
-            # 2) run inference via generate_response (which now uses chat API)
-            answer = self.model.generate_response(prompt)
-            # 3) append assistant turn
-            self.history.append({"role": "assistant", "content": answer})
-            return answer
-        except Exception as e:
+            return model.resolve_adapters(config.lora_adapters)
+        except ValueError as e:
             raise to_http_exception(
-                ModelInferenceError(ModelErrorDetailEnum.MODEL_INFERENCE_ERROR)
+                InvalidPromptError(ModelErrorDetailEnum.INVALID_LORA_ADAPTER_ERROR)
             ) from e
 
-    def run_warm_up(self):
+    def _stored_adapters(self) -> list[dict]:
+        return [adapter.model_dump() for adapter in self.config.lora_adapters]
+
+    def _new_context(self, model: ModelDefinition) -> ContextWindow:
+        return ContextWindow(
+            n_ctx=model.n_ctx,
+            max_tokens=model.max_tokens,
+            count_tokens=model.count_tokens,
+            system_prompt=self.system_prompt(),
+        )
+
+    @property
+    def history(self) -> list[dict[str, str]]:
+        """
+        Every turn of the conversation, including ones trimmed from the window.
+        """
+        return self.context.turns
+
+    def messages(self) -> list[dict[str, str]]:
         """
-        Warm up the model by performing a dummy inference.
+        The transcript sent to the model: system prompt plus the turns that
+        fit in the context window.
         """
+        return self.context.messages()
+
+    def _fit(self) -> tuple[list[dict[str, str]], int]:
         try:
-            self.model.generate_response(prompt="Warm up")
-        except Exception as e:
+            return self.context.fit()
+        except ValueError as e:
+            self._drop_unanswered_turn()
             raise to_http_exception(
-                ModelInferenceError(ModelErrorDetailEnum.MODEL_INFERENCE_ERROR)
+                InvalidPromptError(ModelErrorDetailEnum.PROMPT_TOO_LONG_ERROR)
             ) from e
 
+    def compile_grammar(
+        self, grammar: Optional[str] = None, json_schema: Optional[dict] = None
+    ) -> Optional[CompiledGrammar]:
+        """
+        Compile a GBNF grammar or JSON schema for the conversation's model, or
+        return None if neither is given. Raises a 400 if it does not compile.
+        """
+        if grammar is None and json_schema is None:
+            return None
+        try:
+            return self.model.compile_grammar(grammar, json_schema)
+        except ValueError as e:
+            raise to_http_exception(
+                InvalidPromptError(ModelErrorDetailEnum.INVALID_GRAMMAR_ERROR)
+            ) from e
+
+    def get_response(
+        self,
+        prompt: str,
+        grammar: Optional[str] = None,
+        json_schema: Optional[dict] = None,
+    ) -> str:
+        """
+        Answer a prompt. With a GBNF grammar or a JSON schema, the answer is
+        decoded to match it.
+        """
+        if not prompt:
+            raise to_http_exception(InvalidPromptError())
+        with self._turn_lock:
+            constraint = self.compile_grammar(grammar, json_schema)
+            # 1) append user turn and trim the window to the token budget
+            self.context.append("user", self._with_workspace_context(prompt))
+            messages, max_tokens = self._fit()
+            try:
+                # 2) run inference over the window, reusing the conversation's KV state
+                answer = self.model.generate_response(
+                    messages, self.state, max_tokens, grammar=constraint
+                )
+                # 3) append assistant turn
+                self.context.append("assistant", answer)
+                return answer
+            except Exception as e:
+                self._drop_unanswered_turn()
+                raise to_http_exception(
+                    ModelInferenceError(ModelErrorDetailEnum.MODEL_INFERENCE_ERROR)
+                ) from e
+            finally:
+                self._persist()
+
+    def stream_response(
+        self,
+        prompt: str,
+        grammar: Optional[str] = None,
+        json_schema: Optional[dict] = None,
+    ) -> Iterator[dict]:
+        """
+        Stream the assistant's answer event by event, constrained by a GBNF
+        grammar or JSON schema if one is given.
+        The full assistant turn is added to the history once generation ends.
+        Closing the stream early stops decoding and keeps the tokens consumed
+        so far as the assistant turn.
+        """
+        with self._turn_lock:
+            constraint = self.compile_grammar(grammar, json_schema)
+            self.context.append("user", self._with_workspace_context(prompt))
+            messages, max_tokens = self._fit()
+            pieces: list[str] = []
+            answered = False
+            try:
+                for event in self.model.generate_stream(
+                    messages, self.state, max_tokens, grammar=constraint
+                ):
+                    if event["type"] != "token":
+                        self.context.append("assistant", "".join(pieces).strip())
+                        answered = True
+                    yield event
+                    # A token counts once the consumer asks for the next one
+                    if event["type"] == "token":
+                        pieces.append(event["text"])
+            except GeneratorExit:
+                if not answered:
+                    self._keep_partial_answer(pieces)
+                raise
+            except Exception:
+                self._drop_unanswered_turn()
+                raise
+            finally:
+                self._persist()
+
+    def _with_workspace_context(self, prompt: str) -> str:
+        """
+        Prepend the indexed workspace code most relevant to the prompt, within
+        retrieval_max_tokens and what the context window has left, instead of
+        the user pasting whole files. The turn keeps the added code, so later
+        turns reuse its KV cache and the answer stays grounded in history.
+        """
+        try:
+            retriever = get_retriever(self.config)
+            if retriever is None:
+                return prompt
+            context = retriever.context_for(
+                prompt,
+                min(self.config.retrieval_max_tokens, self.context.room(prompt)),
+                self.model.count_tokens,
+                k=self.config.retrieval_top_k,
+                min_score=self.config.retrieval_min_score,
+            )
+        except Exception as e:
+            # Answering without workspace context beats not answering
+            print(f"Workspace retrieval failed: {e}")
+            return prompt
+        return f"{context}\n\n{prompt}" if context else prompt
+
+    def switch_model(self, config: ModelConfig):
+        """
+        Move this conversation to another model or set of LoRA adapters,
+        keeping its ID and history. The new model, or adapters on the shared
+        one, are loaded and prefilled with the transcript while the current
+        ones keep answering; the switch itself happens between turns.
+        If loading fails, the conversation stays as it is.
+        """
+        with self._turn_lock:
+            turns = list(self.history)
+        model = model_registry.acquire(config)
+        try:
+            # Turn token counts depend on the tokenizer, so recount them once
+            context = self._new_context(model)
+            for turn in turns:
+                context.append(turn["role"], turn["content"])
+            state = SequenceState(self._resolve_adapters(model, config))
+            if turns:
+                model.prefill(context.fit()[0], state)
+        except Exception:
+            model_registry.release(model)
+            raise
+
+        with self._turn_lock:
+            # Carry over turns that finished while the new model was loading
+            for turn in self.history[len(turns) :]:
+                context.append(turn["role"], turn["content"])
+            old_model, old_state = self.model, self.state
+            self.model, self.state, self.context = model, state, context
+            self.config = config
+            if self._store is not None:
+                self._store.set_model(
+                    self.conversation_id, config.model_path, self._stored_adapters()
+                )
+                self._persist()
+        if old_model is not None:
+            old_model.release_state(old_state)
+            model_registry.release(old_model)
+
+    def _keep_partial_answer(self, pieces: list[str]):
+        # A cancelled answer stays in the history, so the next turn can
+        # refer to it and reuses its KV cache
+        answer = "".join(pieces).strip()
+        if answer:
+            self.context.append("assistant", answer)
+        else:
+            self._drop_unanswered_turn()
+
+    def _persist(self):
+        """
+        Queue the turns added since the last call, and the window start, for
+        the conversation store. Costs a list append, not a disk write.
+        """
+        if self._store is None:
+            return
+        start = min(self._persisted, len(self.history))
+        self._store.save_turns(
+            self.conversation_id, start, self.history[start:], self.context.start
+        )
+        self._persisted = len(self.history)
+
+    def _drop_unanswered_turn(self):
+        # Keep the history alternating when a generation fails
+        if self.history and self.history[-1]["role"] == "user":
+            self.context.pop()
+
     def get_conversation_id(self) -> str:
         """
         Return the unique conversation ID associated with this model instance.
         """
         return self.conversation_id
 
+    def suspend(self):
+        """
+        Shut down, leaving the conversation in the conversation store, with
+        its KV state if conversation_kv_snapshots is set, for restore().
+        """
+        if self._store is not None and self.model is not None:
+            with self._turn_lock:
+                self._persist()
+                if self.config.conversation_kv_snapshots:
+                    self._save_snapshot()
+        self.shutdown()
+
+    def end(self):
+        """
+        Shut down and delete the conversation from the conversation store.
+        """
+        self.shutdown()
+        if self._store is not None:
+            self._store.delete(self.conversation_id)
+
+    def _save_snapshot(self):
+        try:
+            snapshot = self.model.save_state(self.state)
+            if snapshot is not None:
+                self._store.save_snapshot(
+                    self.conversation_id,
+                    self.model.state_key(self.state.adapters),
+                    snapshot,
+                )
+        except Exception as e:
+            # The turns are stored, so the next turn can still prefill them
+            print(f"Saving KV state of conversation {self.conversation_id} failed: {e}")
+
     def shutdown(self):
         """
-        Explicitly shut down the model resources.
+        Release this session's reference to the shared model.
+        Safe to call more than once.
         """
+        model, self.model = self.model, None
+        if model is None:
+            return
         try:
-            self.model.close()
+            model.release_state(self.state)
+            model_registry.release(model)
         except Exception as e:
             raise to_http_exception(
                 ModelShutdownError(ModelErrorDetailEnum.MODEL_SHUTDOWN_ERROR)
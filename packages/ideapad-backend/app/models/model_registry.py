@@ -0,0 +1,252 @@
+"""Process-wide, reference-counted registry of loaded models shared by all conversations"""
+
+import threading
+import time
+from typing import Callable, Optional
+
+from app.types import ModelConfig
+from app.models.catalog import estimate_memory_bytes, get_catalog
+from app.models.model_definition import ModelDefinition, resolve_model_path
+
+ModelKey = tuple
+
+
+def model_key(config: ModelConfig) -> ModelKey:
+    """
+    Build the registry key for a config: the resolved model path plus every
+    parameter that affects how the weights are loaded.
+    """
+    return (
+        resolve_model_path(config.model_path),
+        config.n_ctx,
+        config.n_batch,
+        config.num_threads,
+        config.n_threads_batch,
+        config.kv_cache_type,
+        config.flash_attn,
+        config.use_mmap,
+        config.use_mlock,
+        config.speculative,
+        config.draft_model_path,
+        config.speculative_draft_tokens,
+        config.prompt_lookup_max_ngram,
+    )
+
+
+def estimate_model_bytes(config: ModelConfig) -> int:
+    """
+    RAM the model of a config will take once loaded, from its GGUF header.
+    """
+    entry = get_catalog(config).describe(resolve_model_path(config.model_path))
+    if entry is None:
+        raise RuntimeError(f"Cannot read model metadata: {config.model_path}")
+    return estimate_memory_bytes(entry, config.n_ctx, config.kv_cache_type)
+
+
+class _RegistryEntry:
+    def __init__(self, key: ModelKey):
+        self.key = key
+        self.refs = 0
+        self.model: Optional[ModelDefinition] = None
+        # Serialises loading so concurrent acquires of the same key load once
+        self.load_lock = threading.Lock()
+        # Estimated RAM of the loaded model, and when it was last released
+        self.nbytes = 0
+        self.last_used = 0.0
+
+
+class ModelRegistry:
+    """
+    Loads each distinct model once and hands the same ModelDefinition to every
+    conversation that asks for it. Without a RAM budget the weights are
+    released when the last holder calls release(). With one, a model nobody
+    holds stays loaded, so switching back to it costs nothing, until loading
+    another model needs its memory: idle models are then closed least
+    recently used first. Models in use are never closed; if they alone
+    exceed the budget, the next model loads anyway.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[ModelConfig], ModelDefinition] = ModelDefinition,
+        estimate: Callable[[ModelConfig], int] = estimate_model_bytes,
+    ):
+        # Builds a model on first acquire; swappable, e.g. for the fake
+        # backend used by the load-test benchmarks
+        self.factory = factory
+        self.estimate = estimate
+        self.budget_bytes = 0
+        self._lock = threading.Lock()
+        self._entries: dict[ModelKey, _RegistryEntry] = {}
+        self.loads = 0
+        self.idle_hits = 0
+        self.evictions = 0
+
+    def acquire(self, config: ModelConfig) -> ModelDefinition:
+        """
+        Return the shared model for this config, loading it on first use.
+        Every successful acquire must be paired with a release().
+        """
+        key = model_key(config)
+        self.budget_bytes = config.model_ram_budget_bytes
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _RegistryEntry(key)
+                self._entries[key] = entry
+            elif entry.refs == 0 and entry.model is not None:
+                self.idle_hits += 1
+            entry.refs += 1
+
+        try:
+            with entry.load_lock:
+                if entry.model is None:
+                    if self.budget_bytes > 0:
+                        entry.nbytes = self.estimate(config)
+                        self._close(self._evict_idle(entry.nbytes))
+                    model = self.factory(config)
+                    model.registry_key = key
+                    entry.model = model
+                    self.loads += 1
+        except Exception:
+            self._drop_ref(entry)
+            raise
+        return entry.model
+
+    def release(self, model: ModelDefinition):
+        """
+        Drop one reference to a shared model, closing it when no holders remain.
+        """
+        key = getattr(model, "registry_key", None)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.model is not model:
+            return
+        self._drop_ref(entry)
+
+    def _drop_ref(self, entry: _RegistryEntry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.refs > 0:
+                return
+            entry.last_used = time.monotonic()
+            if self.budget_bytes > 0 and entry.model is not None:
+                # Stays loaded until its memory is needed
+                evicted = self._evict_idle_locked(0)
+            else:
+                self._entries.pop(entry.key, None)
+                evicted = [entry.model] if entry.model is not None else []
+                entry.model = None
+        self._close(evicted)
+
+    def _evict_idle(self, needed: int) -> list[ModelDefinition]:
+        with self._lock:
+            return self._evict_idle_locked(needed)
+
+    def _evict_idle_locked(self, needed: int) -> list[ModelDefinition]:
+        """
+        Unload idle models, least recently used first, until needed more bytes
+        fit in the budget. Returns them for closing outside the lock.
+        """
+        loaded = [e for e in self._entries.values() if e.model is not None]
+        used = sum(e.nbytes for e in loaded)
+        evicted = []
+        for entry in sorted(loaded, key=lambda e: e.last_used):
+            if used + needed <= self.budget_bytes:
+                break
+            if entry.refs > 0:
+                continue
+            used -= entry.nbytes
+            self._entries.pop(entry.key, None)
+            evicted.append(entry.model)
+            entry.model = None
+        self.evictions += len(evicted)
+        if needed and used + needed > self.budget_bytes:
+            print(
+                f"Models in use need {used + needed} bytes, over the RAM budget "
+                f"of {self.budget_bytes}"
+            )
+        return evicted
+
+    @staticmethod
+    def _close(models: list[ModelDefinition]):
+        for model in models:
+            try:
+                model.close()
+            except Exception as e:
+                print(f"Error closing an evicted model: {e}")
+
+    def stats(self) -> dict:
+        """
+        RAM budget, estimated use and load/eviction counters.
+        """
+        with self._lock:
+            loaded = [e for e in self._entries.values() if e.model is not None]
+            return {
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": sum(e.nbytes for e in loaded),
+                "resident_models": len(loaded),
+                "idle_models": sum(1 for e in loaded if e.refs == 0),
+                "loads": self.loads,
+                "idle_hits": self.idle_hits,
+                "evictions": self.evictions,
+            }
+
+    def resident(self) -> list[tuple[int, ModelDefinition]]:
+        """
+        Every loaded model with its number of holders.
+        """
+        with self._lock:
+            return [
+                (entry.refs, entry.model)
+                for entry in self._entries.values()
+                if entry.model is not None
+            ]
+
+    def loaded_models(self) -> list[dict]:
+        """
+        Describe the currently resident models and how many holders each has.
+        """
+        with self._lock:
+            return [
+                {
+                    "model_path": entry.key[0],
+                    "n_ctx": entry.key[1],
+                    "refs": entry.refs,
+                    "memory_bytes": entry.nbytes,
+                    "load_seconds": round(entry.model.load_seconds, 3),
+                    "warm_up_seconds": round(entry.model.warm_up_seconds, 3),
+                    "queue": entry.model.executor.stats(),
+                    "prefix_cache": (
+                        entry.model.prefix_cache.stats()
+                        if entry.model.prefix_cache is not None
+                        else None
+                    ),
+                    "response_cache": (
+                        entry.model.response_cache.stats()
+                        if entry.model.response_cache is not None
+                        else None
+                    ),
+                    "speculative": (
+                        entry.model.speculative.stats()
+                        if entry.model.speculative is not None
+                        else None
+                    ),
+                    "grammar_cache": (
+                        entry.model.grammars.stats()
+                        if entry.model.grammars is not None
+                        else None
+                    ),
+                    "lora": (
+                        entry.model.lora.stats()
+                        if entry.model.lora is not None
+                        else None
+                    ),
+                }
+                for entry in self._entries.values()
+                if entry.model is not None
+            ]
+
+
+# Process-wide registry used by every ModelInstance
+model_registry = ModelRegistry()
@@ -0,0 +1,67 @@
+"""
+Unit tests for the shared model registry.
+"""
+
+import unittest
+from unittest.mock import patch, MagicMock
+from app.models.model_registry import ModelRegistry
+from app.types import ModelConfig
+
+
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.factory = MagicMock(side_effect=lambda config: MagicMock())
+        self.registry = ModelRegistry(factory=self.factory)
+        self.config = ModelConfig(model_path="models/a.gguf")
+        patcher = patch(
+            "app.models.model_registry.resolve_model_path",
+            side_effect=lambda path: f"/abs/{path}",
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_config_loads_once(self):
+        first = self.registry.acquire(self.config)
+        second = self.registry.acquire(self.config.model_copy())
+        self.assertIs(first, second)
+        self.factory.assert_called_once()
+        self.assertEqual(self.registry.loaded_models()[0]["refs"], 2)
+
+    def test_different_load_params_load_separately(self):
+        first = self.registry.acquire(self.config)
+        second = self.registry.acquire(self.config.model_copy(update={"n_ctx": 512}))
+        self.assertIsNot(first, second)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_last_release_closes_model(self):
+        first = self.registry.acquire(self.config)
+        self.registry.acquire(self.config)
+        self.registry.release(first)
+        first.close.assert_not_called()
+        self.registry.release(first)
+        first.close.assert_called_once()
+        self.assertEqual(self.registry.loaded_models(), [])
+
+    def test_budget_keeps_idle_models_and_evicts_least_recently_used(self):
+        self.registry.estimate = lambda config: 100
+        budgeted = self.config.model_copy(update={"model_ram_budget_bytes": 250})
+        a = self.registry.acquire(budgeted)
+        b = self.registry.acquire(budgeted.model_copy(update={"model_path": "b"}))
+        self.registry.release(a)
+        self.registry.release(b)
+        # Switching back to an idle model does not reload it
+        self.assertIs(self.registry.acquire(budgeted), a)
+        self.registry.release(a)
+        a.close.assert_not_called()
+
+        self.registry.acquire(budgeted.model_copy(update={"model_path": "c"}))
+        b.close.assert_called_once()
+        a.close.assert_not_called()
+        self.assertEqual(self.registry.stats()["evictions"], 1)
+        self.assertEqual(self.factory.call_count, 3)
+
+    def test_failed_load_does_not_leak_entry(self):
+        self.factory.side_effect = RuntimeError("boom")
+        with self.assertRaises(RuntimeError):
+            self.registry.acquire(self.config)
+        self.assertEqual(self.registry.loaded_models(), [])
@@ -1,7 +1,9 @@
 """Stateful runner that explicitly manages model lifecycle for inference calls"""
 
-from app.types import ModelConfig
+from typing import Iterator, Optional
+from app.types import LoraAdapter, ModelConfig
 from app.models.model_instance import ModelInstance
+from app.models.inference_executor import InferenceExecutor
 from app.exceptions import ModelLoadError, to_http_exception
 
 
@@ -13,14 +15,92 @@ class ModelRunner:
     def start_model(self):
         if not self.model_instance:
             self.model_instance = ModelInstance(self.config)
-            self.model_instance.run_warm_up()
 
-    def get_response(self, prompt: str) -> str:
+    @classmethod
+    def restore(
+        cls, config: ModelConfig, conversation_id: str
+    ) -> Optional["ModelRunner"]:
+        """
+        A runner for a conversation kept in the conversation store, or None.
+        """
+        instance = ModelInstance.restore(config, conversation_id)
+        if instance is None:
+            return None
+        runner = cls(instance.config)
+        runner.model_instance = instance
+        return runner
+
+    @property
+    def executor(self) -> InferenceExecutor:
+        """The inference queue of the model this runner is using."""
+        if not self.model_instance:
+            raise to_http_exception(ModelLoadError())
+        return self.model_instance.model.executor
+
+    def get_response(
+        self,
+        prompt: str,
+        grammar: Optional[str] = None,
+        json_schema: Optional[dict] = None,
+    ) -> str:
         if not self.model_instance:
             raise to_http_exception(ModelLoadError())
-        return self.model_instance.get_response(prompt)
+        return self.model_instance.get_response(prompt, grammar, json_schema)
+
+    def stream_response(
+        self,
+        prompt: str,
+        grammar: Optional[str] = None,
+        json_schema: Optional[dict] = None,
+    ) -> Iterator[dict]:
+        if not self.model_instance:
+            raise to_http_exception(ModelLoadError())
+        return self.model_instance.stream_response(prompt, grammar, json_schema)
+
+    def compile_grammar(
+        self, grammar: Optional[str] = None, json_schema: Optional[dict] = None
+    ):
+        """
+        Check, and cache, a grammar or JSON schema before a turn uses it.
+        """
+        if not self.model_instance:
+            raise to_http_exception(ModelLoadError())
+        self.model_instance.compile_grammar(grammar, json_schema)
+
+    def change_model(self, model_path: str):
+        """
+        Switch the running conversation to another model file in place.
+        """
+        if not self.model_instance:
+            raise to_http_exception(ModelLoadError())
+        # The config object is shared process-wide, so never mutate it in place
+        config = self.config.model_copy(update={"model_path": model_path})
+        self.model_instance.switch_model(config)
+        self.config = config
+
+    def change_adapters(self, lora_adapters: list[LoraAdapter]):
+        """
+        Apply other LoRA adapters, or none, to the running conversation. The
+        base model stays loaded and shared; only the adapters are swapped.
+        """
+        if not self.model_instance:
+            raise to_http_exception(ModelLoadError())
+        config = self.config.model_copy(update={"lora_adapters": lora_adapters})
+        self.model_instance.switch_model(config)
+        self.config = config
 
     def stop_model(self):
+        """
+        Free the session; a stored conversation stays restorable.
+        """
+        if self.model_instance:
+            self.model_instance.suspend()
+            self.model_instance = None
+
+    def end_model(self):
+        """
+        Free the session and delete the conversation for good.
+        """
         if self.model_instance:
-            self.model_instance.shutdown()
+            self.model_instance.end()
             self.model_instance = None
@@ -2,12 +2,15 @@
 Unit tests for the Model Runner class.
 """
 
+import asyncio
+import threading
 import unittest
 from unittest.mock import patch, MagicMock
 from pathlib import Path
-from model_runner import ModelRunner
+from fastapi import HTTPException
+from app.models.inference_executor import InferenceExecutor
+from app.models.model_runner import ModelRunner
 from app.types import ModelConfig
-from app.exceptions import InvalidPromptError
 import tempfile
 
 # Create a temporary file to mock a model file for testing.
@@ -32,24 +35,75 @@ class TestModelRunner(unittest.TestCase):
         )
         self.runner: ModelRunner = ModelRunner(self.config)
 
-    @patch("model_runner.ModelRunner.run_warm_up")
-    def test_start_model(self, mock_run_warm_up: MagicMock):
+        # The shared model comes from the registry; hand out a mock instead
+        self.model = MagicMock(n_ctx=2048, max_tokens=100)
+        self.model.count_tokens.side_effect = lambda text: len(text.split())
+        patcher = patch("app.models.model_instance.model_registry")
+        self.registry = patcher.start()
+        self.registry.acquire.return_value = self.model
+        self.addCleanup(patcher.stop)
+
+    def test_start_model(self):
+        self.runner.start_model()
         self.runner.start_model()
-        mock_run_warm_up.assert_called_once_with()
+        self.registry.acquire.assert_called_once_with(self.config)
+        # Warm-up belongs to the model load, not to each conversation
+        self.model.generate_response.assert_not_called()
 
-    @patch("model_runner.ModelRunner.get_response")
-    def test_get_response(self, mock_get_response: MagicMock):
-        mock_get_response.return_value = "Test response"
+    def test_get_response(self):
+        self.model.generate_response.return_value = "Test response"
+        self.runner.start_model()
         response = self.runner.get_response("Test prompt")
         self.assertEqual(response, "Test response")
 
-    @patch("Model_runner.ModelRunner.shutdown")
-    def test_stop_model(self, mock_shutdown: MagicMock):
+    def test_stop_model(self):
+        self.runner.start_model()
         self.runner.stop_model()
-        mock_shutdown.assert_called_once()
+        self.registry.release.assert_called_once_with(self.model)
+        self.assertIsNone(self.runner.model_instance)
 
     def test_invalid_prompt(self):
-        with self.assertRaises(InvalidPromptError):
-            self.runner.get_response(
-                ""
-            )  # Assuming empty prompt raises InvalidPromptError
+        self.runner.start_model()
+        with self.assertRaises(HTTPException) as ctx:
+            self.runner.get_response("")
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    def test_cancelled_stream_keeps_what_a_slow_consumer_received(self):
+        produced, closed = [], threading.Event()
+
+        def tokens(*args, **kwargs):
+            try:
+                for i in range(1000):
+                    produced.append(i)
+                    yield {"type": "token", "text": f"t{i} "}
+            finally:
+                closed.set()
+
+        self.model.generate_stream.side_effect = tokens
+        self.runner.start_model()
+        executor = InferenceExecutor("test")
+        self.addCleanup(executor.shutdown)
+
+        async def scenario():
+            events = executor.submit_stream(
+                lambda: self.runner.stream_response("Test prompt")
+            )
+            received = []
+            async for event in events:
+                received.append(event["text"])
+                if len(received) == 3:
+                    break
+                # A client reading slower than the model decodes
+                await asyncio.sleep(0.02)
+            await events.aclose()
+            await asyncio.get_running_loop().run_in_executor(None, closed.wait, 5)
+            return received
+
+        self.assertEqual(asyncio.run(scenario()), ["t0 ", "t1 ", "t2 "])
+        self.assertTrue(closed.is_set())
+        # Decoding runs at most one token ahead of what was handed on
+        self.assertEqual(produced, [0, 1, 2, 3])
+        self.assertEqual(
+            self.runner.model_instance.history[-1],
+            {"role": "assistant", "content": "t0 t1 t2"},
+        )
@@ -0,0 +1,286 @@
+"""Cross-conversation prompt-prefix KV cache with byte-budgeted LRU eviction"""
+
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+
+def prefix_hashes(
+    tokens: Sequence[int], block_size: int, namespace: str = ""
+) -> list[str]:
+    """
+    Hash every block-aligned prefix of a token sequence: the i-th hash covers
+    tokens[: (i + 1) * block_size]. Computed incrementally in one pass.
+    Prefixes in different namespaces never hash alike.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if namespace:
+        digest.update(namespace.encode())
+    hashes = []
+    array = np.asarray(tokens, dtype=np.int32)
+    for end in range(block_size, len(array) + 1, block_size):
+        digest.update(array[end - block_size : end].tobytes())
+        hashes.append(digest.copy().hexdigest())
+    return hashes
+
+
+def state_nbytes(state: LlamaState) -> int:
+    """
+    Approximate memory held by a saved llama state: KV data plus the token ids
+    and logits Llama.save_state() copies alongside it.
+    """
+    return int(state.llama_state_size) + state.input_ids.nbytes + state.scores.nbytes
+
+
+class _Entry:
+    __slots__ = ("key", "tokens", "hashes", "nbytes", "state", "namespace")
+
+    def __init__(
+        self,
+        key: str,
+        tokens: tuple,
+        hashes: list[str],
+        nbytes: int,
+        state: Optional[LlamaState],
+        namespace: str = "",
+    ):
+        self.key = key
+        self.tokens = tokens
+        self.hashes = hashes
+        self.nbytes = nbytes
+        self.state = state
+        self.namespace = namespace
+
+
+class _Tier:
+    """
+    One LRU level of the cache, indexed by block-prefix hash.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        self.capacity_bytes = capacity_bytes
+        self.size = 0
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.by_prefix: dict[str, set[str]] = {}
+
+    def add(self, entry: _Entry):
+        self.remove(entry.key)
+        self.entries[entry.key] = entry
+        self.size += entry.nbytes
+        for h in entry.hashes:
+            self.by_prefix.setdefault(h, set()).add(entry.key)
+
+    def remove(self, key: str) -> Optional[_Entry]:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry.nbytes
+        for h in entry.hashes:
+            keys = self.by_prefix.get(h)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_prefix[h]
+        return entry
+
+    def pop_lru(self) -> Optional[_Entry]:
+        if not self.entries:
+            return None
+        return self.remove(next(iter(self.entries)))
+
+    def longest_match(
+        self, tokens: tuple, hashes: list[str]
+    ) -> tuple[Optional[_Entry], int]:
+        # Walk from the longest block prefix down to the first one that is indexed
+        for h in reversed(hashes):
+            keys = self.by_prefix.get(h)
+            if not keys:
+                continue
+            best, best_len = None, 0
+            for key in keys:
+                entry = self.entries[key]
+                matched = Llama.longest_token_prefix(entry.tokens, tokens)
+                if matched > best_len:
+                    best, best_len = entry, matched
+            self.entries.move_to_end(best.key)
+            return best, best_len
+        return None, 0
+
+
+class PrefixCache(BaseLlamaCache):
+    """
+    KV-state cache installed on a Llama with set_cache(). States are looked up
+    by longest shared token prefix, using hashes of block-aligned prefixes so a
+    lookup costs one pass over the prompt rather than a scan of every entry.
+    Entries are evicted least-recently-used under a RAM byte budget; with a
+    cache_dir, evicted entries spill to disk under their own byte budget.
+    Lookups and inserts only see entries of the current namespace, e.g. the
+    LoRA adapters the context decodes with. Disk entries live in a
+    subdirectory of cache_dir per scope (the model file and KV layout the
+    states were saved from), so models sharing cache_dir never load or
+    evict each other's states.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int,
+        cache_dir: Optional[str] = None,
+        disk_capacity_bytes: int = 2 << 30,
+        block_size: int = 32,
+        scope: str = "",
+    ):
+        super().__init__(capacity_bytes)
+        self.block_size = block_size
+        self.namespace = ""
+        self._ram = _Tier(capacity_bytes)
+        self._disk: Optional[_Tier] = None
+        self._dir: Optional[Path] = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.bytes_saved = 0
+
+        if cache_dir:
+            digest = hashlib.blake2b(scope.encode(), digest_size=16).hexdigest()
+            self._dir = Path(cache_dir).expanduser() / digest
+            self._dir.mkdir(parents=True, exist_ok=True)
+            self._disk = _Tier(disk_capacity_bytes)
+            self._load_disk_index()
+
+    @property
+    def cache_size(self) -> int:
+        return self._ram.size
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        tokens = tuple(key)
+        hashes = prefix_hashes(tokens, self.block_size, self.namespace)
+        with self._lock:
+            entry, matched = self._ram.longest_match(tokens, hashes)
+            state = entry.state if entry is not None else None
+            if self._disk is not None:
+                disk_entry, disk_matched = self._disk.longest_match(tokens, hashes)
+                if disk_entry is not None and disk_matched > matched:
+                    promoted = self._promote(disk_entry)
+                    if promoted is not None:
+                        state, matched = promoted, disk_matched
+            if state is None:
+                self.misses += 1
+                raise KeyError("Key not found")
+            self.hits += 1
+            self.tokens_saved += matched
+            if state.n_tokens:
+                self.bytes_saved += state.llama_state_size * matched // state.n_tokens
+            return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        tokens = tuple(key)
+        hashes = prefix_hashes(tokens, self.block_size, self.namespace)
+        with self._lock:
+            if self._ram.longest_match(tokens, hashes)[0] is not None:
+                return True
+            return (
+                self._disk is not None
+                and self._disk.longest_match(tokens, hashes)[0] is not None
+            )
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        tokens = tuple(key)
+        namespace = self.namespace
+        hashes = prefix_hashes(tokens, self.block_size, namespace)
+        if not hashes:
+            # Shorter than one block: not worth caching
+            return
+        entry = _Entry(
+            hashes[-1], tokens, hashes, state_nbytes(value), value, namespace
+        )
+        with self._lock:
+            if self._disk is not None:
+                self._drop_from_disk(entry.key)
+            self._ram.add(entry)
+            while self._ram.size > self._ram.capacity_bytes:
+                self._spill(self._ram.pop_lru())
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "tokens_saved": self.tokens_saved,
+                "bytes_saved": self.bytes_saved,
+                "ram_entries": len(self._ram.entries),
+                "ram_bytes": self._ram.size,
+                "disk_entries": len(self._disk.entries) if self._disk else 0,
+                "disk_bytes": self._disk.size if self._disk else 0,
+            }
+
+    def close(self):
+        """
+        Move every RAM entry to the disk tier, if there is one, so the next
+        process can reuse it.
+        """
+        with self._lock:
+            while self._disk is not None and self._ram.entries:
+                self._spill(self._ram.pop_lru())
+
+    def _spill(self, entry: _Entry):
+        if self._disk is None or entry.nbytes > self._disk.capacity_bytes:
+            return
+        with open(self._dir / f"{entry.key}.state", "wb") as f:
+            pickle.dump(entry.state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        np.save(self._dir / f"{entry.key}.tokens.npy", np.asarray(entry.tokens))
+        if entry.namespace:
+            (self._dir / f"{entry.key}.namespace").write_text(entry.namespace)
+        entry.state = None
+        self._disk.add(entry)
+        while self._disk.size > self._disk.capacity_bytes:
+            self._delete_files(self._disk.pop_lru().key)
+
+    def _promote(self, entry: _Entry) -> Optional[LlamaState]:
+        try:
+            with open(self._dir / f"{entry.key}.state", "rb") as f:
+                state = pickle.load(f)
+        except OSError:
+            self._drop_from_disk(entry.key)
+            return None
+        self._drop_from_disk(entry.key)
+        entry.state = state
+        self._ram.add(entry)
+        while self._ram.size > self._ram.capacity_bytes and len(self._ram.entries) > 1:
+            self._spill(self._ram.pop_lru())
+        return state
+
+    def _drop_from_disk(self, key: str):
+        if self._disk.remove(key) is not None:
+            self._delete_files(key)
+
+    def _delete_files(self, key: str):
+        for suffix in (".state", ".tokens.npy", ".namespace"):
+            (self._dir / f"{key}{suffix}").unlink(missing_ok=True)
+
+    def _load_disk_index(self):
+        # Rebuild the on-disk index from the token files left by a previous run
+        for path in self._dir.glob("*.tokens.npy"):
+            key = path.name[: -len(".tokens.npy")]
+            state_path = self._dir / f"{key}.state"
+            if not state_path.exists():
+                path.unlink(missing_ok=True)
+                continue
+            tokens = tuple(int(t) for t in np.load(path))
+            namespace_path = self._dir / f"{key}.namespace"
+            namespace = (
+                namespace_path.read_text() if namespace_path.exists() else ""
+            )
+            hashes = prefix_hashes(tokens, self.block_size, namespace)
+            nbytes = state_path.stat().st_size
+            self._disk.add(_Entry(key, tokens, hashes, nbytes, None, namespace))
+        while self._disk.size > self._disk.capacity_bytes:
+            self._delete_files(self._disk.pop_lru().key)
@@ -0,0 +1,79 @@
+"""
+Unit tests for the prompt-prefix KV cache.
+"""
+
+import tempfile
+import unittest
+import numpy as np
+from app.models.prefix_cache import PrefixCache, state_nbytes
+from llama_cpp import LlamaState
+
+
+def make_state(n_tokens: int, size: int = 1000) -> LlamaState:
+    return LlamaState(
+        input_ids=np.arange(n_tokens, dtype=np.intc),
+        scores=np.zeros((1, 4), dtype=np.single),
+        n_tokens=n_tokens,
+        llama_state=b"\0" * size,
+        llama_state_size=size,
+        seed=0,
+    )
+
+
+class TestPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.entry_bytes = state_nbytes(make_state(64))
+        self.cache = PrefixCache(capacity_bytes=self.entry_bytes * 2, block_size=4)
+
+    def test_longest_prefix_wins(self):
+        self.cache[list(range(8))] = make_state(8)
+        self.cache[list(range(16))] = make_state(16)
+        state = self.cache[list(range(16)) + [99, 98]]
+        self.assertEqual(state.n_tokens, 16)
+        self.assertEqual(self.cache.stats()["tokens_saved"], 16)
+
+    def test_miss_counts(self):
+        self.cache[list(range(8))] = make_state(8)
+        with self.assertRaises(KeyError):
+            self.cache[[50, 51, 52, 53]]
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_lru_eviction_respects_budget(self):
+        for start in (100, 200, 300):
+            self.cache[list(range(start, start + 64))] = make_state(64)
+        stats = self.cache.stats()
+        self.assertEqual(stats["ram_entries"], 2)
+        self.assertLessEqual(stats["ram_bytes"], self.entry_bytes * 2)
+        with self.assertRaises(KeyError):
+            self.cache[list(range(100, 164))]
+
+    def test_evicted_entries_spill_to_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = PrefixCache(self.entry_bytes, cache_dir=tmp, block_size=4)
+            cache[list(range(100, 164))] = make_state(64)
+            cache[list(range(200, 264))] = make_state(64)
+            self.assertEqual(cache.stats()["disk_entries"], 1)
+            state = cache[list(range(100, 164))]
+            self.assertEqual(state.n_tokens, 64)
+
+            cache.close()
+            reopened = PrefixCache(self.entry_bytes, cache_dir=tmp, block_size=4)
+            self.assertEqual(reopened[list(range(200, 264))].n_tokens, 64)
+
+    def test_disk_entries_are_scoped_to_their_model(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tokens = list(range(100, 164))
+            for scope in ("mistral:2048", "tinyllama:2048", "mistral:4096"):
+                cache = PrefixCache(
+                    self.entry_bytes, cache_dir=tmp, block_size=4, scope=scope
+                )
+                # Same prompt tokens, but another model's or layout's state
+                with self.assertRaises(KeyError):
+                    cache[tokens]
+                cache[tokens] = make_state(64)
+                cache.close()
+            reopened = PrefixCache(
+                self.entry_bytes, cache_dir=tmp, block_size=4, scope="mistral:2048"
+            )
+            self.assertEqual(reopened.stats()["disk_entries"], 1)
+            self.assertEqual(reopened[tokens].n_tokens, 64)
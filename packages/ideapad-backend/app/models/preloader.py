@@ -0,0 +1,120 @@
+"""Background model preload so the first conversation does not pay for the load"""
+
+import threading
+import time
+from typing import Any, Optional
+
+from app.metrics import current_endpoint
+from app.types import ModelConfig
+
+
+class ModelPreloader:
+    """
+    Imports the inference stack and loads the configured model on a background
+    thread while the server is already accepting requests. The loaded model is
+    held in the registry until stop(), so conversations started in the meantime
+    share it instead of loading their own copy.
+    """
+
+    STAGES = ("idle", "importing", "loading", "ready", "failed")
+
+    def __init__(self):
+        self.stage = "idle"
+        self.error: Optional[str] = None
+        self._model = None
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[float] = None
+        self._stage_started = 0.0
+        self._finished_at: Optional[float] = None
+        self._durations: dict[str, float] = {}
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.stage == "ready"
+
+    def start(self, config: ModelConfig):
+        """
+        Begin preloading config's model. Returns immediately.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._started_at = time.monotonic()
+            self._thread = threading.Thread(
+                target=self._run, args=(config,), name="model-preload", daemon=True
+            )
+            self._thread.start()
+
+    def status(self) -> dict[str, Any]:
+        """
+        Current stage, time spent in each finished stage, and any load error.
+        """
+        if self._started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished_at or time.monotonic()) - self._started_at
+        return {
+            "ready": self.ready,
+            "stage": self.stage,
+            "elapsed_seconds": round(elapsed, 3),
+            "stage_seconds": dict(self._durations),
+            "error": self.error,
+        }
+
+    def stop(self):
+        """
+        Release the preloaded model. A load still in progress is released
+        as soon as it finishes.
+        """
+        with self._lock:
+            self._stopped = True
+            model, self._model = self._model, None
+        if model is not None:
+            from app.models.model_registry import model_registry
+
+            model_registry.release(model)
+
+    def _enter(self, stage: str):
+        now = time.monotonic()
+        if self.stage in ("importing", "loading"):
+            self._durations[self.stage] = round(now - self._stage_started, 3)
+        self._stage_started = now
+        if stage in ("ready", "failed"):
+            self._finished_at = now
+        self.stage = stage
+
+    def _run(self, config: ModelConfig):
+        current_endpoint.set("preload")
+        try:
+            self._enter("importing")
+            # llama_cpp and the model stack are only imported here, off the
+            # startup path
+            from app.models.model_registry import model_registry
+
+            self._enter("loading")
+            # Loading includes the model's one-time warm-up
+            model = model_registry.acquire(config)
+        except Exception as e:
+            self._fail(e)
+            return
+
+        with self._lock:
+            if self._stopped:
+                # stop() ran while the model was loading
+                model_registry.release(model)
+                return
+            self._model = model
+            self._durations["model_load"] = round(model.load_seconds, 3)
+            self._durations["warm_up"] = round(model.warm_up_seconds, 3)
+            self._enter("ready")
+
+    def _fail(self, error: Exception):
+        self.error = str(error)
+        self._enter("failed")
+        print("Model preload failed:", error)
+
+
+# Process-wide preloader driven by the app lifespan
+model_preloader = ModelPreloader()
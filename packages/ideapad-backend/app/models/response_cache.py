@@ -0,0 +1,171 @@
+"""Cache of deterministic completions, with in-flight request deduplication"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+# Bytes read from each end of the model file for its fingerprint
+_FINGERPRINT_CHUNK = 1 << 20
+
+
+def model_fingerprint(model_path: str) -> str:
+    """
+    Identify a model file by size, mtime and hashes of its first and last MiB.
+    Hashing a multi-GB GGUF in full would add seconds to every load, and the
+    header plus tail are enough to tell quantizations and versions apart.
+    """
+    stat = os.stat(model_path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(model_path, "rb") as f:
+        digest.update(f.read(_FINGERPRINT_CHUNK))
+        if stat.st_size > _FINGERPRINT_CHUNK:
+            f.seek(max(stat.st_size - _FINGERPRINT_CHUNK, _FINGERPRINT_CHUNK))
+            digest.update(f.read(_FINGERPRINT_CHUNK))
+    return digest.hexdigest()
+
+
+def response_key(fingerprint: str, sampling: dict[str, Any], messages: list) -> str:
+    """
+    Cache key for one completion request: the model, every sampling setting
+    that affects the output, and the exact message list.
+    """
+    payload = json.dumps(
+        {"model": fingerprint, "sampling": sampling, "messages": messages},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """
+    Maps request keys to completion text. Recent entries live in an in-memory
+    LRU; with a cache_dir, entries are also written to disk and survive a
+    restart. Concurrent requests for the same key share a single generation.
+    Only use it for deterministic sampling (temperature 0 or a fixed seed).
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        cache_dir: Optional[str] = None,
+        disk_capacity: int = 10000,
+    ):
+        self.capacity = capacity
+        self.disk_capacity = disk_capacity
+        self._ram: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._dir: Optional[Path] = None
+        # Disk keys in least-recently-written order
+        self._disk: "OrderedDict[str, None]" = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.merged = 0
+
+        if cache_dir:
+            self._dir = Path(cache_dir).expanduser()
+            self._dir.mkdir(parents=True, exist_ok=True)
+            paths = sorted(self._dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
+            for path in paths:
+                self._disk[path.stem] = None
+            self._trim_disk()
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        """
+        Return the cached text for key, or run compute() once and cache it.
+        Callers that arrive while the same key is being computed wait for that
+        result instead of generating again; if it fails, they all see the error.
+        """
+        with self._lock:
+            text = self._lookup(key)
+            if text is not None:
+                return text
+            pending = self._inflight.get(key)
+            if pending is None:
+                self.misses += 1
+                owner = self._inflight[key] = Future()
+            else:
+                self.merged += 1
+        if pending is not None:
+            return pending.result()
+
+        try:
+            text = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            owner.set_exception(e)
+            raise
+        with self._lock:
+            try:
+                self._store(key, text)
+            except OSError:
+                pass  # The disk tier is best effort
+            finally:
+                del self._inflight[key]
+        owner.set_result(text)
+        return text
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "merged": self.merged,
+                "ram_entries": len(self._ram),
+                "disk_entries": len(self._disk),
+            }
+
+    def _lookup(self, key: str) -> Optional[str]:
+        # Must be called with the lock held
+        text = self._ram.get(key)
+        if text is not None:
+            self._ram.move_to_end(key)
+            self.hits += 1
+            return text
+        if self._dir is None or key not in self._disk:
+            return None
+        try:
+            with open(self._dir / f"{key}.json", encoding="utf-8") as f:
+                text = json.load(f)["text"]
+        except (OSError, ValueError, KeyError):
+            self._disk.pop(key, None)
+            return None
+        self.disk_hits += 1
+        self._remember(key, text)
+        return text
+
+    def _store(self, key: str, text: str):
+        # Must be called with the lock held
+        self._remember(key, text)
+        if self._dir is None:
+            return
+        path = self._dir / f"{key}.json"
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"text": text}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._disk[key] = None
+        self._disk.move_to_end(key)
+        self._trim_disk()
+
+    def _remember(self, key: str, text: str):
+        self._ram[key] = text
+        self._ram.move_to_end(key)
+        while len(self._ram) > self.capacity:
+            self._ram.popitem(last=False)
+
+    def _trim_disk(self):
+        while len(self._disk) > self.disk_capacity:
+            key, _ = self._disk.popitem(last=False)
+            (self._dir / f"{key}.json").unlink(missing_ok=True)
@@ -0,0 +1,82 @@
+"""
+Unit tests for the deterministic response cache.
+"""
+
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+from app.models.response_cache import ResponseCache, response_key
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_key_depends_on_sampling_and_messages(self):
+        messages = [{"role": "user", "content": "hi"}]
+        key = response_key("m", {"temperature": 0}, messages)
+        self.assertEqual(key, response_key("m", {"temperature": 0}, list(messages)))
+        self.assertNotEqual(key, response_key("m", {"temperature": 0.5}, messages))
+        self.assertNotEqual(key, response_key("other", {"temperature": 0}, messages))
+
+    def test_hit_skips_generation(self):
+        cache = ResponseCache(capacity=2)
+        compute = MagicMock(return_value="answer")
+        self.assertEqual(cache.get_or_compute("k", compute), "answer")
+        self.assertEqual(cache.get_or_compute("k", compute), "answer")
+        compute.assert_called_once()
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResponseCache(capacity=2)
+        for key in ("a", "b"):
+            cache.get_or_compute(key, lambda: key)
+        cache.get_or_compute("a", MagicMock())
+        cache.get_or_compute("c", lambda: "c")
+        compute = MagicMock(return_value="b")
+        cache.get_or_compute("b", compute)
+        compute.assert_called_once()
+
+    def test_concurrent_requests_share_one_generation(self):
+        cache = ResponseCache(capacity=2)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "shared"
+
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(cache.get_or_compute("k", compute))
+        )
+        first.start()
+        started.wait()
+        second = threading.Thread(
+            target=lambda: results.append(cache.get_or_compute("k", compute))
+        )
+        second.start()
+        while cache.stats()["merged"] == 0:
+            pass
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, ["shared", "shared"])
+        self.assertEqual(len(calls), 1)
+
+    def test_failure_is_not_cached(self):
+        cache = ResponseCache(capacity=2)
+        with self.assertRaises(RuntimeError):
+            cache.get_or_compute("k", MagicMock(side_effect=RuntimeError))
+        self.assertEqual(cache.get_or_compute("k", lambda: "ok"), "ok")
+
+    def test_disk_tier_survives_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ResponseCache(capacity=1, cache_dir=tmp).get_or_compute("k", lambda: "x")
+            restarted = ResponseCache(capacity=1, cache_dir=tmp)
+            self.assertEqual(restarted.get_or_compute("k", MagicMock()), "x")
+            self.assertEqual(restarted.stats()["disk_hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
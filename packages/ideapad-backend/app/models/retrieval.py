@@ -0,0 +1,144 @@
+"""Workspace code retrieval: chunk files into the vector index and pick relevant chunks for prompts"""
+
+import hashlib
+import threading
+from typing import Callable, Optional
+
+from app.types import ModelConfig
+from app.models.embeddings import EmbeddingModel
+from app.models.vector_index import VectorIndex
+
+# Chunks are windows of lines that overlap, so code near a boundary is whole
+# in at least one of them
+CHUNK_LINES = 24
+CHUNK_OVERLAP = 6
+# Minified or generated files can have enormous lines
+MAX_CHUNK_CHARS = 4000
+
+CONTEXT_HEADER = "Relevant code from the workspace:\n\n"
+
+
+def chunk_text(text: str) -> list[tuple[int, int, str]]:
+    """
+    Split a file into (start_line, end_line, text) chunks, lines counted from 1.
+    """
+    lines = text.splitlines()
+    chunks = []
+    start = 0
+    while start < len(lines):
+        end = min(start + CHUNK_LINES, len(lines))
+        body = "\n".join(lines[start:end])
+        if body.strip():
+            chunks.append((start + 1, end, body[:MAX_CHUNK_CHARS]))
+        if end == len(lines):
+            break
+        start += CHUNK_LINES - CHUNK_OVERLAP
+    return chunks
+
+
+class WorkspaceRetriever:
+    """
+    Keeps the vector index in step with the workspace, one file at a time:
+    a file is re-chunked and re-embedded only when its content changes.
+    """
+
+    def __init__(self, embedder: EmbeddingModel, index: VectorIndex):
+        self.embedder = embedder
+        self.index = index
+
+    def index_files(self, files: list[tuple[str, str]]) -> dict[str, int]:
+        """
+        Index (path, content) pairs, skipping files whose content is unchanged.
+        """
+        indexed = unchanged = chunks = 0
+        for path, content in files:
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+            if self.index.file_digest(path) == digest:
+                unchanged += 1
+                continue
+            pieces = chunk_text(content)
+            # The path is embedded too, so file names count towards a match
+            vectors = self.embedder.embed([f"{path}\n{text}" for _, _, text in pieces])
+            self.index.replace_file(path, digest, pieces, vectors)
+            indexed += 1
+            chunks += len(pieces)
+        return {"indexed": indexed, "unchanged": unchanged, "chunks": chunks}
+
+    def remove_files(self, paths: list[str]) -> int:
+        return sum(self.index.remove_file(path) for path in paths)
+
+    def search(self, query: str, k: int) -> list[dict]:
+        if len(self.index) == 0:
+            return []
+        return self.index.search(self.embedder.embed([query])[0], k)
+
+    def context_for(
+        self,
+        prompt: str,
+        max_tokens: int,
+        count_tokens: Callable[[str], int],
+        k: int = 4,
+        min_score: float = 0.0,
+    ) -> str:
+        """
+        The best matching chunks for a prompt, formatted to prepend to it and
+        costing at most max_tokens as counted by count_tokens. Chunks below
+        min_score, or overlapping a better chunk of the same file, are left out.
+        Returns "" when nothing qualifies.
+        """
+        if max_tokens <= 0:
+            return ""
+        used = count_tokens(CONTEXT_HEADER)
+        blocks: list[str] = []
+        taken: list[tuple[str, int, int]] = []
+        for hit in self.search(prompt, k):
+            if hit["score"] < min_score:
+                break
+            path, start, end = hit["path"], hit["start_line"], hit["end_line"]
+            if any(p == path and s <= end and start <= e for p, s, e in taken):
+                continue
+            block = f"{path} (lines {start}-{end}):\n```\n{hit['text']}\n```"
+            cost = count_tokens(block)
+            if used + cost > max_tokens:
+                continue
+            blocks.append(block)
+            taken.append((path, start, end))
+            used += cost
+        return CONTEXT_HEADER + "\n\n".join(blocks) if blocks else ""
+
+    def stats(self) -> dict:
+        return {"embedding_model": self.embedder.name, **self.index.stats()}
+
+    def close(self):
+        self.index.close()
+        self.embedder.close()
+
+
+_retriever: Optional[WorkspaceRetriever] = None
+_retriever_key: Optional[tuple] = None
+_lock = threading.Lock()
+
+
+def get_retriever(config: ModelConfig) -> Optional[WorkspaceRetriever]:
+    """
+    Return the process-wide retriever for the configured embedding model and
+    index directory, loading it on first use, or None if retrieval is off.
+    """
+    global _retriever, _retriever_key
+    if not config.embedding_model_path:
+        return None
+    key = (config.embedding_model_path, config.vector_index_dir)
+    with _lock:
+        if _retriever is None or _retriever_key != key:
+            embedder = EmbeddingModel(
+                config.embedding_model_path, n_threads=config.num_threads
+            )
+            index = VectorIndex(config.vector_index_dir, embedder.dim, embedder.name)
+            old, _retriever, _retriever_key = (
+                _retriever,
+                WorkspaceRetriever(embedder, index),
+                key,
+            )
+            if old is not None:
+                old.close()
+        return _retriever
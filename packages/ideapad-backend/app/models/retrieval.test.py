@@ -0,0 +1,66 @@
+"""
+Unit tests for workspace chunking and prompt context selection.
+"""
+
+import unittest
+from unittest.mock import MagicMock
+from app.models.retrieval import (
+    CHUNK_LINES,
+    CHUNK_OVERLAP,
+    WorkspaceRetriever,
+    chunk_text,
+)
+
+
+class TestChunkText(unittest.TestCase):
+    def test_chunks_overlap_and_cover_the_file(self):
+        text = "\n".join(f"line {i}" for i in range(1, 51))
+        chunks = chunk_text(text)
+        self.assertEqual(chunks[0][:2], (1, CHUNK_LINES))
+        self.assertEqual(chunks[1][0], CHUNK_LINES - CHUNK_OVERLAP + 1)
+        self.assertEqual(chunks[-1][1], 50)
+
+    def test_blank_files_have_no_chunks(self):
+        self.assertEqual(chunk_text("\n\n  \n"), [])
+
+
+class TestContextFor(unittest.TestCase):
+    def setUp(self):
+        self.retriever = WorkspaceRetriever(MagicMock(), MagicMock())
+        self.retriever.search = MagicMock(
+            return_value=[
+                self.hit("a.py", 1, 24, 0.9, "short"),
+                self.hit("a.py", 19, 42, 0.8, "overlaps the first"),
+                self.hit("b.py", 1, 24, 0.7, "long " * 50),
+                self.hit("c.py", 1, 24, 0.6, "also short"),
+                self.hit("d.py", 1, 24, 0.1, "too far"),
+            ]
+        )
+
+    @staticmethod
+    def hit(path, start, end, score, text):
+        return {
+            "path": path,
+            "start_line": start,
+            "end_line": end,
+            "score": score,
+            "text": text,
+        }
+
+    def test_picks_best_chunks_within_budget(self):
+        context = self.retriever.context_for(
+            "q", max_tokens=60, count_tokens=lambda s: len(s.split()), min_score=0.5
+        )
+        self.assertIn("a.py (lines 1-24)", context)
+        self.assertIn("c.py", context)
+        self.assertNotIn("overlaps", context)
+        self.assertNotIn("b.py", context)
+        self.assertNotIn("d.py", context)
+
+    def test_no_budget_means_no_context(self):
+        self.assertEqual(self.retriever.context_for("q", 0, len), "")
+        self.retriever.search.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""Speculative decoding drafts from prompt lookup or a small draft model, with acceptance stats"""
+
+import threading
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from app.types import ModelConfig
+
+
+class DraftModelDecoding(LlamaDraftModel):
+    """
+    Drafts tokens greedily with a small GGUF that shares the target model's
+    vocabulary (e.g. TinyLlama for Mistral). The draft keeps its own KV cache,
+    so only tokens it has not seen yet are evaluated on each call.
+    """
+
+    def __init__(self, llama: Llama, num_pred_tokens: int = 10):
+        self.llama = llama
+        self.num_pred_tokens = num_pred_tokens
+        self._eos = llama.token_eos()
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        room = self.llama.n_ctx() - len(input_ids)
+        draft: list[int] = []
+        if room <= 0:
+            return np.array(draft, dtype=np.intc)
+        tokens = self.llama.generate(
+            input_ids.tolist(), top_k=1, temp=0.0, repeat_penalty=1.0, reset=True
+        )
+        try:
+            for token in tokens:
+                draft.append(token)
+                if token == self._eos or len(draft) >= min(self.num_pred_tokens, room):
+                    break
+        finally:
+            tokens.close()
+        return np.array(draft, dtype=np.intc)
+
+
+class SpeculativeDraft(LlamaDraftModel):
+    """
+    Wraps a draft strategy and measures how many of its proposals the target
+    model accepts. llama.cpp verifies a draft by evaluating it in one batch and
+    keeping the longest prefix that matches what it would have sampled anyway,
+    so output is unchanged; each accepted token saves one decode step.
+    """
+
+    def __init__(self, mode: str, propose: LlamaDraftModel):
+        self.mode = mode
+        self._propose = propose
+        self._lock = threading.Lock()
+        # (input length, proposed tokens) of the draft awaiting verification
+        self._pending: Optional[tuple[int, int]] = None
+        self.drafts = 0
+        self.proposed = 0
+        self.accepted = 0
+
+    def begin(self):
+        """
+        Forget the draft of the previous generation, which was never verified.
+        """
+        self._pending = None
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        # The target calls back after verifying the previous draft: it kept the
+        # accepted tokens plus one token of its own
+        if self._pending is not None:
+            start, proposed = self._pending
+            accepted = min(len(input_ids) - start - 1, proposed)
+            if accepted >= 0:
+                with self._lock:
+                    self.drafts += 1
+                    self.proposed += proposed
+                    self.accepted += accepted
+        draft = self._propose(input_ids)
+        self._pending = (len(input_ids), len(draft)) if len(draft) else None
+        return draft
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Acceptance rate, and target tokens produced per verification pass:
+        the decode speedup speculation can give at most, since drafting and
+        verifying a batch cost extra.
+        """
+        with self._lock:
+            drafts, proposed, accepted = self.drafts, self.proposed, self.accepted
+        return {
+            "mode": self.mode,
+            "drafts": drafts,
+            "proposed_tokens": proposed,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / proposed if proposed else 0.0,
+            "tokens_per_pass": (accepted + drafts) / drafts if drafts else 1.0,
+        }
+
+    def check_compatible(self, target: Llama):
+        """
+        Raise RuntimeError if a draft model's tokens mean something else to
+        the target, which would make every draft miss.
+        """
+        llama = getattr(self._propose, "llama", None)
+        if llama is not None and llama.n_vocab() != target.n_vocab():
+            raise RuntimeError("Draft model does not share the model's vocabulary")
+
+    def close(self):
+        llama = getattr(self._propose, "llama", None)
+        if llama is not None:
+            llama.close()
+
+
+def create_draft(
+    config: ModelConfig, n_ctx: int, n_threads: int, n_threads_batch: int
+) -> Optional[SpeculativeDraft]:
+    """
+    Build the draft strategy config.speculative asks for, or None when off.
+    """
+    if config.speculative == "prompt_lookup":
+        return SpeculativeDraft(
+            "prompt_lookup",
+            LlamaPromptLookupDecoding(
+                max_ngram_size=config.prompt_lookup_max_ngram,
+                num_pred_tokens=config.speculative_draft_tokens,
+            ),
+        )
+    if config.speculative == "draft_model":
+        if not config.draft_model_path:
+            raise RuntimeError('speculative="draft_model" needs draft_model_path')
+        from app.models.model_definition import resolve_model_path
+
+        llama = Llama(
+            model_path=resolve_model_path(config.draft_model_path),
+            n_ctx=n_ctx,
+            n_batch=config.n_batch,
+            n_threads=n_threads,
+            n_threads_batch=n_threads_batch,
+            use_mmap=config.use_mmap,
+            verbose=False,
+        )
+        return SpeculativeDraft(
+            "draft_model",
+            DraftModelDecoding(llama, num_pred_tokens=config.speculative_draft_tokens),
+        )
+    return None
@@ -0,0 +1,39 @@
+"""
+Unit tests for speculative decoding statistics.
+"""
+
+import unittest
+import numpy as np
+from app.models.speculative import SpeculativeDraft
+
+
+class TestSpeculativeDraft(unittest.TestCase):
+    def setUp(self):
+        # Always proposes the same four tokens
+        self.draft = SpeculativeDraft(
+            "prompt_lookup", lambda ids: np.array([7, 8, 9, 10], dtype=np.intc)
+        )
+
+    def call(self, length: int):
+        return self.draft(np.zeros(length, dtype=np.intc))
+
+    def test_acceptance_is_read_from_the_next_call(self):
+        self.call(10)  # drafts positions 10..13
+        self.call(13)  # kept 2 draft tokens plus its own
+        self.call(18)  # kept all 4 plus its own
+        stats = self.draft.stats()
+        self.assertEqual(stats["drafts"], 2)
+        self.assertEqual(stats["proposed_tokens"], 8)
+        self.assertEqual(stats["accepted_tokens"], 6)
+        self.assertEqual(stats["acceptance_rate"], 0.75)
+        self.assertEqual(stats["tokens_per_pass"], 4.0)
+
+    def test_unverified_draft_is_dropped_between_generations(self):
+        self.call(10)
+        self.draft.begin()
+        self.call(50)
+        self.assertEqual(self.draft.stats()["drafts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
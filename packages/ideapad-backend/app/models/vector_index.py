@@ -0,0 +1,231 @@
+"""On-disk vector index: a memory-mapped float32 matrix searched with NumPy, chunk metadata in SQLite"""
+
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_INDEX_DIR = Path("~/.cache/ideapad-backend/index")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, digest TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (
+    row INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    start_line INTEGER NOT NULL,
+    end_line INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);
+"""
+
+
+class VectorIndex:
+    """
+    Unit-length embeddings of code chunks, one row each of a float32 matrix
+    memory-mapped from vectors.f32, so the OS pages it in on demand and a
+    search is a single matrix-vector product. Chunk text and positions live in
+    index.sqlite, which is the source of truth: rows it does not list are free
+    and get reused. Vectors are flushed before the metadata commits, so a
+    crash never leaves a listed row without its vector.
+    """
+
+    def __init__(self, directory: Optional[str], dim: int, embedder: str):
+        self.dir = Path(directory or DEFAULT_INDEX_DIR).expanduser()
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.dir / "index.sqlite", check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._vectors_path = self.dir / "vectors.f32"
+
+        # Vectors from another embedding model are meaningless to this one
+        stored = dict(self._db.execute("SELECT key, value FROM meta"))
+        if stored.get("embedder") != embedder or stored.get("dim") != str(dim):
+            with self._db:
+                self._db.execute("DELETE FROM chunks")
+                self._db.execute("DELETE FROM files")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    [("embedder", embedder), ("dim", str(dim))],
+                )
+            self._vectors_path.unlink(missing_ok=True)
+
+        self._capacity = 0
+        self._vectors: Optional[np.memmap] = None
+        self._load_rows()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return int(self._live.sum())
+
+    def file_digest(self, path: str) -> Optional[str]:
+        """
+        Content digest of the indexed version of a file, or None.
+        """
+        with self._lock:
+            found = self._db.execute(
+                "SELECT digest FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        return found[0] if found else None
+
+    def replace_file(
+        self,
+        path: str,
+        digest: str,
+        chunks: list[tuple[int, int, str]],
+        vectors: np.ndarray,
+    ):
+        """
+        Replace every chunk of a file with (start_line, end_line, text) chunks
+        and their unit-length embeddings.
+        """
+        if len(chunks) != len(vectors):
+            raise ValueError("Every chunk needs exactly one vector")
+        with self._lock:
+            old = self._rows_of(path)
+            # The old rows stay listed until the commit, so write elsewhere
+            rows = [self._take_row() for _ in chunks]
+            if rows:
+                self._vectors[rows] = vectors
+                self._vectors.flush()
+            with self._db:
+                self._db.execute("DELETE FROM chunks WHERE path = ?", (path,))
+                self._db.executemany(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (row, path, start, end, text)
+                        for row, (start, end, text) in zip(rows, chunks)
+                    ],
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?)", (path, digest)
+                )
+            self._release_rows(old)
+            self._live[rows] = True
+
+    def remove_file(self, path: str) -> bool:
+        """
+        Drop a file's chunks. Returns whether the file was indexed.
+        """
+        with self._lock:
+            old = self._rows_of(path)
+            with self._db:
+                self._db.execute("DELETE FROM chunks WHERE path = ?", (path,))
+                removed = self._db.execute(
+                    "DELETE FROM files WHERE path = ?", (path,)
+                ).rowcount
+            self._release_rows(old)
+        return removed > 0
+
+    def search(self, query: np.ndarray, k: int) -> list[dict]:
+        """
+        The k chunks most similar to a unit-length query vector, best first,
+        each with its cosine similarity as "score".
+        """
+        with self._lock:
+            self._refresh()
+            n = self._used
+            live = self._live[:n]
+            k = min(k, int(live.sum()))
+            if k <= 0:
+                return []
+            scores = self._vectors[:n] @ query.astype(np.float32)
+            scores[~live] = -np.inf
+            top = np.argpartition(scores, -k)[-k:]
+            top = top[np.argsort(scores[top])[::-1]]
+            found = {
+                row: (path, start, end, text)
+                for row, path, start, end, text in self._db.execute(
+                    "SELECT row, path, start_line, end_line, text FROM chunks "
+                    f"WHERE row IN ({','.join('?' * len(top))})",
+                    [int(row) for row in top],
+                )
+            }
+        return [
+            {
+                "path": found[row][0],
+                "start_line": found[row][1],
+                "end_line": found[row][2],
+                "text": found[row][3],
+                "score": float(scores[row]),
+            }
+            for row in top.tolist()
+            if row in found
+        ]
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            self._refresh()
+            files = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            return {
+                "files": files,
+                "chunks": int(self._live.sum()),
+                "dim": self.dim,
+                "vector_bytes": self._capacity * self.dim * 4,
+            }
+
+    def close(self):
+        with self._lock:
+            self._vectors = None
+            self._db.close()
+
+    def _load_rows(self):
+        rows = [row for (row,) in self._db.execute("SELECT row FROM chunks")]
+        self._used = max(rows, default=-1) + 1
+        if self._vectors is None or self._used > self._capacity:
+            self._map(max(1024, self._used))
+        self._live = np.zeros(self._capacity, dtype=bool)
+        self._live[rows] = True
+        self._free = [row for row in range(self._used) if not self._live[row]]
+        self._version = self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh(self):
+        """
+        Reload the live rows if another process committed since the last look;
+        with several inference workers, one writes and the others only search.
+        """
+        if self._db.execute("PRAGMA data_version").fetchone()[0] != self._version:
+            self._load_rows()
+
+    def _rows_of(self, path: str) -> list[int]:
+        return [
+            row
+            for (row,) in self._db.execute(
+                "SELECT row FROM chunks WHERE path = ?", (path,)
+            )
+        ]
+
+    def _release_rows(self, rows: list[int]):
+        self._live[rows] = False
+        self._free.extend(rows)
+
+    def _take_row(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._used == self._capacity:
+            self._map(self._capacity * 2)
+            self._live = np.concatenate(
+                [self._live, np.zeros(self._capacity - len(self._live), dtype=bool)]
+            )
+        self._used += 1
+        return self._used - 1
+
+    def _map(self, capacity: int):
+        """
+        (Re)map the vector file with room for capacity rows, growing it if needed.
+        """
+        nbytes = capacity * self.dim * 4
+        with open(self._vectors_path, "ab") as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        if self._vectors is not None:
+            self._vectors.flush()
+        self._vectors = np.memmap(
+            self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim)
+        )
+        self._capacity = capacity
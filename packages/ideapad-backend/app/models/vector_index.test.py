@@ -0,0 +1,61 @@
+"""
+Unit tests for the memory-mapped vector index.
+"""
+
+import tempfile
+import unittest
+import numpy as np
+from app.models.vector_index import VectorIndex
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.index = VectorIndex(self.dir.name, dim=2, embedder="test")
+
+    def add(self, path, *vectors):
+        chunks = [(i + 1, i + 1, f"{path}:{i}") for i in range(len(vectors))]
+        self.index.replace_file(path, path, chunks, np.stack(vectors))
+
+    def test_search_ranks_by_similarity(self):
+        self.add("a.py", unit(1, 0), unit(0, 1))
+        self.add("b.py", unit(1, 1))
+        hits = self.index.search(unit(1, 0.1), k=2)
+        self.assertEqual([h["text"] for h in hits], ["a.py:0", "b.py:0"])
+        self.assertAlmostEqual(hits[0]["score"], float(unit(1, 0.1)[0]), places=5)
+
+    def test_replacing_a_file_drops_its_old_chunks(self):
+        self.add("a.py", unit(1, 0), unit(0, 1))
+        self.add("a.py", unit(-1, 0))
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.search(unit(1, 0), k=5)[0]["text"], "a.py:0")
+        self.assertTrue(self.index.remove_file("a.py"))
+        self.assertEqual(self.index.search(unit(1, 0), k=5), [])
+
+    def test_index_survives_reopen_and_grows(self):
+        vectors = [unit(1, i / 3000) for i in range(3000)]
+        self.add("big.py", *vectors)
+        self.index.close()
+        index = VectorIndex(self.dir.name, dim=2, embedder="test")
+        self.assertEqual(len(index), 3000)
+        self.assertEqual(index.file_digest("big.py"), "big.py")
+        self.assertEqual(index.search(unit(1, 0), k=1)[0]["text"], "big.py:0")
+        index.close()
+
+    def test_another_embedder_starts_empty(self):
+        self.add("a.py", unit(1, 0))
+        self.index.close()
+        index = VectorIndex(self.dir.name, dim=2, embedder="other")
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.file_digest("a.py"))
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
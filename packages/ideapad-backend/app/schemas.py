@@ -1,11 +1,19 @@
 # Pydantic schemas
+from typing import Any, Optional
 from pydantic import BaseModel
 
+from app.types import LoraAdapter
+
 
 class PromptRequest(BaseModel):
     prompt: str
 
 
+class StartConversationRequest(BaseModel):
+    # LoRA adapters applied on top of the model; None uses the configured ones
+    lora_adapters: Optional[list[LoraAdapter]] = None
+
+
 class StartConversationResponse(BaseModel):
     conversation_id: str
 
@@ -13,6 +21,9 @@ class StartConversationResponse(BaseModel):
 class ContinueConversationRequest(BaseModel):
     conversation_id: str
     prompt: str
+    # Constrain the answer to a GBNF grammar or a JSON schema, not both
+    grammar: Optional[str] = None
+    json_schema: Optional[dict[str, Any]] = None
 
 
 class ContinueConversationResponse(BaseModel):
@@ -35,3 +46,94 @@ class ChangeModelRequest(BaseModel):
 class ChangeModelResponse(BaseModel):
     conversation_id: str
     status: str
+
+
+class ChangeAdaptersRequest(BaseModel):
+    conversation_id: str
+    # An empty list goes back to the base model
+    lora_adapters: list[LoraAdapter]
+
+
+class BatchRequest(BaseModel):
+    prompts: list[str]
+    system_prompt: Optional[str] = None
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    seed: Optional[int] = None
+    stop: Optional[list[str]] = None
+    # Constrain every answer to a GBNF grammar or a JSON schema, not both
+    grammar: Optional[str] = None
+    json_schema: Optional[dict[str, Any]] = None
+    # LoRA adapters applied to every answer
+    lora_adapters: list[LoraAdapter] = []
+
+
+class CancelBatchRequest(BaseModel):
+    batch_id: str
+    # Prompt positions to cancel; all of them when omitted
+    indices: Optional[list[int]] = None
+
+
+class CancelBatchResponse(BaseModel):
+    batch_id: str
+    cancelled: list[int]
+
+
+class EmbeddingsRequest(BaseModel):
+    input: list[str]
+
+
+class EmbeddingsResponse(BaseModel):
+    model: str
+    dim: int
+    embeddings: list[list[float]]
+
+
+class WorkspaceFile(BaseModel):
+    path: str
+    content: str
+
+
+class IndexFilesRequest(BaseModel):
+    # Changed or new files, and paths deleted from the workspace
+    files: list[WorkspaceFile] = []
+    removed: list[str] = []
+
+
+class IndexFilesResponse(BaseModel):
+    indexed: int
+    unchanged: int
+    removed: int
+    chunks: int
+
+
+class SearchRequest(BaseModel):
+    query: str
+    k: int = 8
+
+
+class SearchResult(BaseModel):
+    path: str
+    start_line: int
+    end_line: int
+    text: str
+    score: float
+
+
+class SearchResponse(BaseModel):
+    results: list[SearchResult]
+
+
+class CompleteRequest(BaseModel):
+    prefix: str
+    suffix: str = ""
+    # Editor document URI; a newer request for it cancels this one
+    document: Optional[str] = None
+    max_tokens: Optional[int] = None
+    stop: Optional[list[str]] = None
+
+
+class CompleteResponse(BaseModel):
+    completion: str
+    finish_reason: str
+    usage: dict[str, int]
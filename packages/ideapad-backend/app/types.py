@@ -1,7 +1,20 @@
-from typing import List, TypedDict
+from typing import List, Literal, Optional, TypedDict
 from enum import Enum
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class LoraAdapter(BaseModel):
+    """
+    A LoRA adapter applied on top of the base model.
+
+    Attributes:
+        path (str): Adapter GGUF; relative paths are looked up in lora_adapters_dir.
+        scale (float): Strength the adapter is applied with; 1.0 as trained. Default is 1.0.
+    """
+
+    path: str
+    scale: float = 1.0
 
 
 class ModelConfig(BaseModel):
@@ -19,11 +32,60 @@ class ModelConfig(BaseModel):
         repeat_last_n (int): Window size for repeat penalty. Default is 64.
         num_threads (int): Number of CPU threads. Default is 4.
         num_predict (int): Batch size for predict calls. Default is 1.
+        n_threads_batch (int): CPU threads for prompt prefill; None uses num_threads. Default is None.
+        n_batch (int): Prompt tokens evaluated per llama.cpp batch. Default is 512.
+        use_mmap (bool): Memory-map the model file. Default is True.
+        use_mlock (bool): Lock the model in RAM so it is never paged out. Default is False.
+        kv_cache_type (str): KV cache precision: "f16", "q8_0" or "q4_0". Default is "f16".
+        flash_attn (bool): Use flash attention; always on for quantized KV caches. Default is False.
+        autotune (bool): Apply the saved tuning profile for this model and CPU at load. Default is True.
+        tuning_profile_path (str): Tuning profile file. Default is ~/.cache/ideapad-backend/tuning.json.
+        max_queue_size (int): Pending inference requests allowed per model. Default is 8.
+        continuous_batching (bool): Decode concurrent requests in one batch. Default is False.
+        max_batch_sequences (int): Sequences decoded together when batching. Default is 4.
+        speculative (str): Speculative decoding: "off", "prompt_lookup" (drafts copied from the prompt) or "draft_model". Default is "off".
+        draft_model_path (str): Small GGUF sharing the model's vocabulary, for "draft_model". Default is None.
+        speculative_draft_tokens (int): Tokens drafted per verification step. Default is 10.
+        prompt_lookup_max_ngram (int): Longest n-gram matched against the prompt by "prompt_lookup". Default is 3.
+        prefix_cache_bytes (int): RAM budget of the prompt-prefix KV cache; 0 disables it. Default is 0.
+        prefix_cache_dir (str): Directory for the on-disk prefix cache tier. Default is None.
+        prefix_cache_disk_bytes (int): Disk budget of the prefix cache tier. Default is 2 GiB.
+        seed (int): Fixed sampling seed for reproducible answers. Default is None.
+        response_cache_entries (int): Answers kept in the response cache; 0 disables it. Default is 0.
+        response_cache_dir (str): Directory for the on-disk response cache tier. Default is None.
+        response_cache_disk_entries (int): Answers kept in the on-disk tier. Default is 10000.
+        warm_up (str): Per-model warm-up: "off", "minimal" (evaluate a few tokens) or "full" (one generation). Default is "minimal".
+        preload_model (bool): Load and warm up the model in the background at startup. Default is True.
+        session_ttl_seconds (float): Idle time before a conversation is evicted; 0 disables it. Default is 1800.
+        session_memory_budget_bytes (int): Memory budget for all conversations; 0 is unlimited. Default is 0.
+        conversation_store_dir (str): Directory of the durable conversation store; None keeps conversations in memory only. Default is None.
+        conversation_kv_snapshots (bool): Also save a conversation's KV cache when it is evicted or the server stops, so restoring it skips the prefill. Default is False.
+        conversation_snapshot_disk_bytes (int): Disk budget of saved KV snapshots, oldest removed first. Default is 4 GiB.
+        conversation_retention_days (float): Days a stored conversation is kept after its last turn; 0 keeps it forever. Default is 30.
+        embedding_model_path (str): Embedding GGUF for workspace code retrieval; None disables retrieval. Default is None.
+        vector_index_dir (str): Directory of the workspace vector index. Default is ~/.cache/ideapad-backend/index.
+        retrieval_top_k (int): Indexed chunks considered for each prompt. Default is 4.
+        retrieval_max_tokens (int): Prompt tokens of retrieved code added to a turn; 0 disables it. Default is 512.
+        retrieval_min_score (float): Cosine similarity a chunk needs to be added. Default is 0.5.
+        completion_max_tokens (int): Default token budget of a /api/complete code completion. Default is 64.
+        completion_n_ctx (int): Context size of the separate llama.cpp context used for code completion. Default is 2048.
+        completion_fim_order (str): Fill-in-the-middle prompt order, "psm" (prefix first) or "spm" (suffix first, faster while typing if the model was trained on it). Default is "psm".
+        grammar_cache_entries (int): Compiled grammars and JSON schemas of structured-output requests kept per model. Default is 32.
+        models_dir (str): Directory listed by the model catalog; None uses the directory of model_path. Default is None.
+        model_catalog_cache_path (str): Cache of model header metadata. Default is ~/.cache/ideapad-backend/catalog.json.
+        model_ram_budget_bytes (int): RAM budget of loaded models; idle models stay loaded within it, least recently used unloaded first. 0 unloads a model as soon as nothing uses it. Default is 0.
+        lora_adapters (list[LoraAdapter]): LoRA adapters applied on top of model_path for new conversations. Default is [].
+        lora_adapters_dir (str): Directory relative adapter paths are looked up in; None uses lora/ in the models directory. Default is None.
+        lora_max_adapters (int): LoRA adapters kept loaded per model; least recently used ones no context applies are freed beyond it. Default is 8.
+        inference_workers (int): Worker processes serving inference, each with its own models; 0 serves in-process. Default is 0.
+        worker_cpu_sets (list[str]): CPU list per worker, e.g. "0-7", handed out round-robin; empty leaves scheduling to the OS. Default is [].
 
     Config:
-        allow_population_by_field_name (bool): Allows population of fields by their name.
+        populate_by_name (bool): Allows population of fields by their name.
     """
 
+    model_config = ConfigDict(populate_by_name=True)
+
     model_path: str = Field("models/default.gguf", description="…")
 
     n_ctx: int = Field(2048, description="Maximum context size")
@@ -37,10 +99,145 @@ class ModelConfig(BaseModel):
     repeat_last_n: int = Field(64, description="Window size for repeat penalty")
     num_threads: int = Field(4, description="Number of CPU threads")
     num_predict: int = Field(1, description="Batch size for predict calls")
-
-
-class Config:
-    allow_population_by_field_name = True
+    n_threads_batch: Optional[int] = Field(
+        None, description="CPU threads for prompt prefill; None uses num_threads"
+    )
+    n_batch: int = Field(512, description="Prompt tokens evaluated per llama.cpp batch")
+    use_mmap: bool = Field(True, description="Memory-map the model file")
+    use_mlock: bool = Field(
+        False, description="Lock the model in RAM so it is never paged out"
+    )
+    kv_cache_type: Literal["f16", "q8_0", "q4_0"] = Field(
+        "f16", description="KV cache precision"
+    )
+    flash_attn: bool = Field(
+        False, description="Use flash attention; always on for quantized KV caches"
+    )
+    autotune: bool = Field(
+        True, description="Apply the saved tuning profile for this model and CPU"
+    )
+    tuning_profile_path: Optional[str] = Field(
+        None, description="Tuning profile file; defaults to ~/.cache/ideapad-backend"
+    )
+    max_queue_size: int = Field(
+        8, description="Pending inference requests allowed per model"
+    )
+    continuous_batching: bool = Field(
+        False, description="Decode concurrent requests in one batch"
+    )
+    max_batch_sequences: int = Field(
+        4, description="Sequences decoded together when batching"
+    )
+    speculative: Literal["off", "prompt_lookup", "draft_model"] = Field(
+        "off",
+        description="Speculative decoding: off, prompt_lookup or draft_model. "
+        "Keeps logits for every position, which enlarges saved conversation state",
+    )
+    draft_model_path: Optional[str] = Field(
+        None, description="Small GGUF sharing the model's vocabulary, for draft_model"
+    )
+    speculative_draft_tokens: int = Field(
+        10, description="Tokens drafted per verification step"
+    )
+    prompt_lookup_max_ngram: int = Field(
+        3, description="Longest n-gram matched against the prompt by prompt_lookup"
+    )
+    prefix_cache_bytes: int = Field(
+        0, description="RAM budget of the prompt-prefix KV cache; 0 disables it"
+    )
+    prefix_cache_dir: Optional[str] = Field(
+        None, description="Directory for the on-disk prefix cache tier"
+    )
+    prefix_cache_disk_bytes: int = Field(
+        2 << 30, description="Disk budget of the prefix cache tier"
+    )
+    seed: Optional[int] = Field(
+        None, description="Fixed sampling seed for reproducible answers"
+    )
+    response_cache_entries: int = Field(
+        0, description="Answers kept in the response cache; 0 disables it"
+    )
+    response_cache_dir: Optional[str] = Field(
+        None, description="Directory for the on-disk response cache tier"
+    )
+    response_cache_disk_entries: int = Field(
+        10000, description="Answers kept in the on-disk response cache tier"
+    )
+    warm_up: Literal["off", "minimal", "full"] = Field(
+        "minimal", description="Per-model warm-up: off, minimal or full"
+    )
+    preload_model: bool = Field(
+        True, description="Load and warm up the model in the background at startup"
+    )
+    session_ttl_seconds: float = Field(
+        1800, description="Idle time before a conversation is evicted; 0 disables it"
+    )
+    session_memory_budget_bytes: int = Field(
+        0, description="Memory budget for all conversations; 0 is unlimited"
+    )
+    conversation_store_dir: Optional[str] = Field(
+        None, description="Durable conversation store; None keeps them in memory"
+    )
+    conversation_kv_snapshots: bool = Field(
+        False, description="Save KV caches of evicted or stopped conversations"
+    )
+    conversation_snapshot_disk_bytes: int = Field(
+        4 << 30, description="Disk budget of saved conversation KV snapshots"
+    )
+    conversation_retention_days: float = Field(
+        30, description="Days a stored conversation is kept; 0 keeps it forever"
+    )
+    embedding_model_path: Optional[str] = Field(
+        None, description="Embedding GGUF for workspace retrieval; None disables it"
+    )
+    vector_index_dir: Optional[str] = Field(
+        None, description="Vector index directory; defaults to ~/.cache/ideapad-backend"
+    )
+    retrieval_top_k: int = Field(
+        4, description="Indexed chunks considered for each prompt"
+    )
+    retrieval_max_tokens: int = Field(
+        512, description="Tokens of retrieved code added to a turn; 0 disables it"
+    )
+    retrieval_min_score: float = Field(
+        0.5, description="Cosine similarity a chunk needs to be added to a prompt"
+    )
+    completion_max_tokens: int = Field(
+        64, description="Default token budget of a code completion"
+    )
+    completion_n_ctx: int = Field(
+        2048, description="Context size of the code completion llama context"
+    )
+    completion_fim_order: Literal["psm", "spm"] = Field(
+        "psm", description="Fill-in-the-middle order: prefix or suffix first"
+    )
+    grammar_cache_entries: int = Field(
+        32, description="Compiled grammars and JSON schemas kept per model"
+    )
+    models_dir: Optional[str] = Field(
+        None, description="Model catalog directory; defaults to that of model_path"
+    )
+    model_catalog_cache_path: Optional[str] = Field(
+        None, description="Model metadata cache; defaults to ~/.cache/ideapad-backend"
+    )
+    model_ram_budget_bytes: int = Field(
+        0, description="RAM budget of loaded models; 0 unloads unused models"
+    )
+    lora_adapters: list[LoraAdapter] = Field(
+        [], description="LoRA adapters applied on top of the model"
+    )
+    lora_adapters_dir: Optional[str] = Field(
+        None, description="LoRA adapter directory; defaults to lora/ under models_dir"
+    )
+    lora_max_adapters: int = Field(
+        8, description="LoRA adapters kept loaded per model"
+    )
+    inference_workers: int = Field(
+        0, description="Inference worker processes; 0 serves in-process"
+    )
+    worker_cpu_sets: list[str] = Field(
+        [], description='CPU list per worker such as "0-7", handed out round-robin'
+    )
 
 
 class ModelErrorDetailEnum(str, Enum):
@@ -56,6 +253,15 @@ class ModelErrorDetailEnum(str, Enum):
     MODEL_INVALID_RESPONSE_ERROR = "Model returned invalid response structure."
     CONVERSATION_NOT_FOUND_ERROR = "Conversation not found"
     MODEL_INITIALIZATION_ERROR = "Model instance failed to initialize"
+    INFERENCE_QUEUE_FULL_ERROR = "Inference queue is full, retry later"
+    PROMPT_TOO_LONG_ERROR = "Prompt does not fit in the model's context window"
+    SESSION_CAPACITY_ERROR = "Too many open conversations, retry later"
+    BATCH_NOT_FOUND_ERROR = "Batch not found"
+    RETRIEVAL_DISABLED_ERROR = "Workspace retrieval needs embedding_model_path"
+    INVALID_GRAMMAR_ERROR = "Grammar or JSON schema could not be compiled"
+    INVALID_LORA_ADAPTER_ERROR = "LoRA adapter is missing or does not fit the model"
+    CONVERSATION_LOST_ERROR = "Conversation was lost when its worker restarted"
+    WORKER_UNAVAILABLE_ERROR = "Inference worker is restarting, retry later"
 
 
 class ModelErrorDetail(TypedDict):
@@ -0,0 +1,653 @@
+"""Multi-process inference: the server process routes each conversation to one of N worker processes"""
+
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.metrics_core import Metric
+from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.samples import Sample
+from starlette.responses import JSONResponse, Response
+
+from app.exceptions import (
+    ConversationLostError,
+    ConversationNotFoundError,
+    ModelError,
+    WorkerUnavailableError,
+    to_http_exception,
+)
+from app.types import ModelConfig, ModelErrorDetailEnum
+
+# Index of the worker this process is, or None in the server process
+worker_index: Optional[int] = None
+
+# Scope entries that mean the same thing in another process
+_SCOPE_KEYS = (
+    "type",
+    "asgi",
+    "http_version",
+    "scheme",
+    "method",
+    "root_path",
+    "path",
+    "raw_path",
+    "query_string",
+    "headers",
+    "client",
+    "server",
+    "subprotocols",
+)
+
+# Answered by every worker and merged
+_BROADCAST = {
+    "/api/chat/queue_stats",
+    "/api/chat/sessions",
+    "/api/chat/health/ready",
+    "/api/chat/models",
+}
+
+# Answered by the server process itself, so liveness holds while workers load
+_LOCAL = {"/health", "/api/chat/health", "/api/chat/health/live"}
+
+# Conversations of crashed workers remembered as lost, so they answer 410, not 404
+_MAX_LOST = 10000
+
+_LOST = object()
+
+
+def parse_cpu_set(spec: str) -> set[int]:
+    """
+    Parse a CPU list like "0-7,16-23" into CPU numbers.
+    """
+    cpus: set[int] = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if part:
+            low, _, high = part.partition("-")
+            cpus.update(range(int(low), int(high or low) + 1))
+    return cpus
+
+
+def merge_metrics(texts: dict[int, str], extra: list[Metric] = ()) -> bytes:
+    """
+    Merge the Prometheus exposition of every worker into one, labeling each
+    sample with its worker.
+    """
+    families: dict[str, Metric] = {}
+    for index, text in texts.items():
+        for family in text_string_to_metric_families(text):
+            merged = families.get(family.name)
+            if merged is None:
+                merged = Metric(family.name, family.documentation, family.type)
+                families[family.name] = merged
+            for sample in family.samples:
+                labels = dict(sample.labels, worker=str(index))
+                merged.samples.append(
+                    Sample(sample.name, labels, sample.value, sample.timestamp)
+                )
+    for family in extra:
+        families[family.name] = family
+
+    class _Families:
+        def collect(self):
+            return list(families.values())
+
+    return generate_latest(_Families())
+
+
+class _Worker:
+    """
+    One worker process, its pipe and the requests it is answering.
+    """
+
+    def __init__(self, index: int, cpus: Optional[set[int]]):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.restarts = 0
+        # Response message queues of in-flight requests, by request ID
+        self.pending: dict[int, asyncio.Queue] = {}
+
+
+class WorkerPool:
+    """
+    Server-process side of multi-process inference. Each worker process runs
+    this same app with its own models and sessions, and a conversation stays
+    on the worker that started it. Requests and WebSocket connections go over
+    one duplex pipe per worker as ASGI messages in both directions, one per
+    streamed chunk. A worker that exits is restarted; its conversations then
+    answer 410 instead of hanging.
+    """
+
+    def __init__(self):
+        self.workers: list[_Worker] = []
+        self._affinity: dict[str, int] = {}
+        self._lost: "OrderedDict[str, None]" = OrderedDict()
+        self._ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping = False
+        # Whether workers share a conversation store to restore conversations from
+        self._stored = False
+
+    @property
+    def running(self) -> bool:
+        return bool(self.workers)
+
+    def start(self, config: ModelConfig):
+        """
+        Spawn config.inference_workers workers. Call from the event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        self._stored = bool(config.conversation_store_dir)
+        cpu_sets = [parse_cpu_set(spec) for spec in config.worker_cpu_sets]
+        context = multiprocessing.get_context("spawn")
+        for index in range(config.inference_workers):
+            cpus = cpu_sets[index % len(cpu_sets)] if cpu_sets else None
+            worker = _Worker(index, cpus)
+            self.workers.append(worker)
+            threading.Thread(
+                target=self._supervise,
+                args=(context, config, worker),
+                name=f"inference-worker-{index}",
+                daemon=True,
+            ).start()
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Ask every worker to shut down cleanly, killing those that do not.
+        """
+        self._stopping = True
+        for worker in self.workers:
+            self._post(worker, ("shutdown",))
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(max(deadline - time.monotonic(), 0))
+                if worker.process.is_alive():
+                    worker.process.kill()
+        self.workers = []
+
+    def stats(self) -> list[dict[str, Any]]:
+        conversations = Counter(self._affinity.values())
+        return [
+            {
+                "worker": worker.index,
+                "ready": worker.ready,
+                "pid": worker.process.pid if worker.process else None,
+                "restarts": worker.restarts,
+                "conversations": conversations[worker.index],
+                "in_flight": len(worker.pending),
+            }
+            for worker in self.workers
+        ]
+
+    async def handle(self, scope, receive, send):
+        """
+        Answer an HTTP request by routing it to the right worker(s).
+        """
+        body = b""
+        more = True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+        path = scope["path"]
+        if path == "/metrics":
+            return await self._metrics(scope, receive, send)
+        if path in _BROADCAST:
+            return await self._broadcast(scope, body, receive, send)
+
+        fields = _json_fields(body)
+        conversation_id = fields.get("conversation_id")
+        if isinstance(conversation_id, str):
+            index = self._affinity.get(conversation_id)
+            if index is None and self._stored:
+                index = self._adopt(conversation_id)
+                if index is None:
+                    error = WorkerUnavailableError()
+                    return await _reply_error(error, scope, receive, send)
+            if index is None:
+                lost = conversation_id in self._lost
+                error = ConversationLostError() if lost else ConversationNotFoundError()
+                return await _reply_error(error, scope, receive, send)
+            status, _ = await self._proxy(
+                self.workers[index], scope, body, receive, send
+            )
+            if status == 404 or (path.endswith("/end_conversation") and status == 200):
+                self._affinity.pop(conversation_id, None)
+            return
+
+        if path.endswith("/start_conversation"):
+            worker = self._pick(by_conversations=True)
+            if worker is None:
+                error = WorkerUnavailableError()
+                return await _reply_error(error, scope, receive, send)
+            status, response = await self._proxy(
+                worker, scope, body, receive, send, capture=True
+            )
+            if status == 200:
+                self._affinity[json.loads(response)["conversation_id"]] = worker.index
+            return
+
+        if path.endswith("/batch/cancel"):
+            return await self._first_found(scope, body, receive, send)
+
+        document = fields.get("document")
+        if path.startswith("/api/retrieval/"):
+            # The workspace index is shared on disk and has a single writer
+            worker = self.workers[0] if self.workers[0].ready else None
+        elif isinstance(document, str):
+            # A document's completions stay on one worker, where a newer one
+            # cancels the older and reuses its KV cache
+            worker = self.workers[zlib.crc32(document.encode()) % len(self.workers)]
+            worker = worker if worker.ready else self._pick()
+        else:
+            worker = self._pick()
+        if worker is None:
+            return await _reply_error(WorkerUnavailableError(), scope, receive, send)
+        await self._proxy(worker, scope, body, receive, send)
+
+    def _adopt(self, conversation_id: str) -> Optional[int]:
+        """
+        Give a conversation this process does not know, e.g. one from before a
+        restart or of a crashed worker, to a worker that restores it from the
+        conversation store. Requests arriving meanwhile go to the same worker.
+        """
+        worker = self._pick(by_conversations=True)
+        if worker is None:
+            return None
+        self._affinity[conversation_id] = worker.index
+        return worker.index
+
+    def _pick(self, by_conversations: bool = False) -> Optional[_Worker]:
+        ready = [worker for worker in self.workers if worker.ready]
+        if not ready:
+            return None
+        if by_conversations:
+            conversations = Counter(self._affinity.values())
+            return min(ready, key=lambda w: (conversations[w.index], len(w.pending)))
+        return min(ready, key=lambda w: len(w.pending))
+
+    async def _request(
+        self, worker: _Worker, request_id: int, scope, body: Optional[bytes]
+    ) -> AsyncIterator[dict]:
+        """
+        Send a request to a worker and yield its ASGI response messages. An
+        HTTP request's body goes along; WebSocket messages are forwarded as
+        they arrive. Raises WorkerUnavailableError if the worker dies before
+        finishing.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        worker.pending[request_id] = queue
+        finished = False
+        try:
+            portable = {key: scope[key] for key in _SCOPE_KEYS if key in scope}
+            if not self._post(worker, ("request", request_id, portable)):
+                raise WorkerUnavailableError()
+            if body is not None:
+                request = {"type": "http.request", "body": body, "more_body": False}
+                self._post(worker, ("receive", request_id, request))
+            while True:
+                message = await queue.get()
+                if message is None:
+                    finished = True
+                    return
+                if message is _LOST:
+                    finished = True
+                    raise WorkerUnavailableError()
+                yield message
+        finally:
+            worker.pending.pop(request_id, None)
+            if not finished:
+                gone = {"type": f"{scope['type']}.disconnect", "code": 1001}
+                self._post(worker, ("receive", request_id, gone))
+
+    async def _proxy(
+        self, worker: _Worker, scope, body: bytes, receive, send, capture=False
+    ) -> tuple[int, bytes]:
+        """
+        Relay a worker's response to the client as it arrives, passing a client
+        disconnect on to the worker. Returns the status and, with capture, the
+        response body.
+        """
+        request_id = next(self._ids)
+        watcher = asyncio.ensure_future(self._forward(worker, request_id, receive))
+        status, chunks, started = 0, [], False
+        try:
+            async for message in self._request(worker, request_id, scope, body):
+                if message["type"] == "http.response.start":
+                    status, started = message["status"], True
+                elif capture:
+                    chunks.append(message.get("body", b""))
+                await send(message)
+        except WorkerUnavailableError as e:
+            if not started:
+                await _reply_error(e, scope, receive, send)
+                return 503, b""
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+        return status, b"".join(chunks)
+
+    async def _forward(self, worker: _Worker, request_id: int, receive):
+        """
+        Pass the client's messages on to the worker until it disconnects.
+        """
+        while True:
+            message = await receive()
+            self._post(worker, ("receive", request_id, message))
+            if message["type"] in ("http.disconnect", "websocket.disconnect"):
+                return
+
+    async def websocket(self, scope, receive, send):
+        """
+        Connect a conversation's WebSocket to the worker that holds it.
+        """
+        conversation_id = scope["path"].rstrip("/").rpartition("/")[2]
+        index = self._affinity.get(conversation_id)
+        if index is None and self._stored and scope["path"].startswith("/api/chat/ws/"):
+            index = self._adopt(conversation_id)
+        if not scope["path"].startswith("/api/chat/ws/") or index is None:
+            if conversation_id in self._lost:
+                reason = ModelErrorDetailEnum.CONVERSATION_LOST_ERROR
+            else:
+                reason = ModelErrorDetailEnum.CONVERSATION_NOT_FOUND_ERROR
+            await receive()
+            close = {"type": "websocket.close", "code": 1008, "reason": reason.value}
+            await send(close)
+            return
+        worker, request_id = self.workers[index], next(self._ids)
+        forwarder = asyncio.ensure_future(self._forward(worker, request_id, receive))
+        try:
+            async for message in self._request(worker, request_id, scope, None):
+                await send(message)
+        except WorkerUnavailableError:
+            # 1012: service restart, so the client reconnects and learns the fate
+            # of its conversation
+            await send({"type": "websocket.close", "code": 1012})
+        finally:
+            forwarder.cancel()
+
+    async def _fetch(self, worker: _Worker, scope, body: bytes) -> tuple[int, bytes]:
+        """
+        Run a request on a worker and return its status and whole body.
+        """
+        status, chunks = 503, []
+        try:
+            async for message in self._request(worker, next(self._ids), scope, body):
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                else:
+                    chunks.append(message.get("body", b""))
+        except WorkerUnavailableError:
+            return 503, b""
+        return status, b"".join(chunks)
+
+    async def _broadcast(self, scope, body: bytes, receive, send):
+        """
+        Ask every worker and answer with all their replies; the readiness
+        probe only passes when every worker is ready.
+        """
+        ready = [worker for worker in self.workers if worker.ready]
+        results = await asyncio.gather(
+            *(self._fetch(worker, scope, body) for worker in ready)
+        )
+        replies = {worker.index: result for worker, result in zip(ready, results)}
+        workers, healthy = [], True
+        for worker in self.workers:
+            status, payload = replies.get(worker.index, (503, b""))
+            healthy = healthy and status == 200
+            try:
+                reply = json.loads(payload) if payload else {}
+            except ValueError:
+                reply = {}
+            workers.append({"worker": worker.index, "status": status, **reply})
+        status = 200 if healthy or not scope["path"].endswith("/ready") else 503
+        await JSONResponse({"workers": workers}, status_code=status)(
+            scope, receive, send
+        )
+
+    async def _first_found(self, scope, body: bytes, receive, send):
+        """
+        Try every worker until one knows the ID in the request.
+        """
+        status, payload = 404, b""
+        for worker in [w for w in self.workers if w.ready]:
+            status, payload = await self._fetch(worker, scope, body)
+            if status != 404:
+                break
+        await Response(payload, status_code=status, media_type="application/json")(
+            scope, receive, send
+        )
+
+    async def _metrics(self, scope, receive, send):
+        ready = [worker for worker in self.workers if worker.ready]
+        results = await asyncio.gather(
+            *(self._fetch(worker, scope, b"") for worker in ready)
+        )
+        texts = {
+            worker.index: payload.decode("utf-8")
+            for worker, (status, payload) in zip(ready, results)
+            if status == 200
+        }
+        up = Metric("ideapad_worker_up", "Inference worker is serving", "gauge")
+        restarts = Metric(
+            "ideapad_worker_restarts", "Inference worker restarts", "counter"
+        )
+        for worker in self.workers:
+            labels = {"worker": str(worker.index)}
+            up.add_sample("ideapad_worker_up", labels, float(worker.ready))
+            restarts.add_sample(
+                "ideapad_worker_restarts_total", labels, worker.restarts
+            )
+        await Response(
+            merge_metrics(texts, [up, restarts]), media_type=CONTENT_TYPE_LATEST
+        )(scope, receive, send)
+
+    def _post(self, worker: _Worker, message: tuple) -> bool:
+        conn = worker.conn
+        if conn is None:
+            return False
+        try:
+            conn.send(message)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _supervise(self, context, config: ModelConfig, worker: _Worker):
+        """
+        Run a worker process, relay its messages to the event loop, and start
+        a new one when it exits. Crash loops back off up to 30 seconds.
+        """
+        backoff = 1.0
+        while not self._stopping:
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(worker.index, child, config, worker.cpus),
+                name=f"inference-worker-{worker.index}",
+                daemon=True,
+            )
+            process.start()
+            child.close()
+            worker.process, worker.conn = process, parent
+            started = time.monotonic()
+            try:
+                while True:
+                    message = parent.recv()
+                    self._loop.call_soon_threadsafe(self._dispatch, worker, message)
+            except (EOFError, OSError):
+                pass
+            worker.conn = None
+            parent.close()
+            process.join(5)
+            try:
+                self._loop.call_soon_threadsafe(self._lose, worker)
+            except RuntimeError:
+                # The server's event loop is closed: a worker that took long to
+                # shut down, e.g. saving conversations, outlived it
+                return
+            if self._stopping:
+                return
+            print(
+                f"Inference worker {worker.index} exited with code "
+                f"{process.exitcode}, restarting"
+            )
+            worker.restarts += 1
+            backoff = 1.0 if time.monotonic() - started > 60 else min(backoff * 2, 30)
+            time.sleep(backoff)
+
+    def _dispatch(self, worker: _Worker, message: tuple):
+        if message[0] == "ready":
+            worker.ready = True
+            return
+        request_id, payload = message
+        queue = worker.pending.get(request_id)
+        if queue is not None:
+            queue.put_nowait(payload)
+
+    def _lose(self, worker: _Worker):
+        """
+        Forget a dead worker's conversations and fail its in-flight requests.
+        """
+        worker.ready = False
+        for conversation_id, index in list(self._affinity.items()):
+            if index == worker.index:
+                del self._affinity[conversation_id]
+                self._lost[conversation_id] = None
+        while len(self._lost) > _MAX_LOST:
+            self._lost.popitem(last=False)
+        for queue in worker.pending.values():
+            queue.put_nowait(_LOST)
+
+
+worker_pool = WorkerPool()
+
+
+class WorkerRouter:
+    """
+    ASGI middleware that hands HTTP requests to the worker pool while it runs,
+    and to the app itself otherwise. Liveness checks are always answered
+    here: the server process is up even while every worker is loading.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in _LOCAL:
+            await self.app(scope, receive, send)
+        elif scope["type"] == "http" and worker_pool.running:
+            await worker_pool.handle(scope, receive, send)
+        elif scope["type"] == "websocket" and worker_pool.running:
+            await worker_pool.websocket(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+def _json_fields(body: bytes) -> dict:
+    try:
+        fields = json.loads(body) if body else {}
+    except ValueError:
+        return {}
+    return fields if isinstance(fields, dict) else {}
+
+
+async def _reply_error(error: ModelError, scope, receive, send):
+    http = to_http_exception(error)
+    await JSONResponse(
+        {"detail": http.detail}, status_code=http.status_code, headers=http.headers
+    )(scope, receive, send)
+
+
+def worker_config(config: ModelConfig, index: int) -> ModelConfig:
+    """
+    The config a worker runs with. The disk cache tiers keep their index in
+    process memory, so each worker gets its own directory for them.
+    """
+    update: dict[str, Any] = {}
+    for field in ("prefix_cache_dir", "response_cache_dir"):
+        directory = getattr(config, field)
+        if directory:
+            update[field] = str(Path(directory).expanduser() / f"worker-{index}")
+    return config.model_copy(update=update)
+
+
+def _worker_main(index: int, conn, config: ModelConfig, cpus: Optional[set[int]]):
+    global worker_index
+    worker_index = index
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    from app.config import set_config
+
+    set_config(worker_config(config, index))
+    asyncio.run(_serve(conn))
+
+
+async def _serve(conn):
+    """
+    Worker process main loop: run the app's lifespan, then serve every
+    request from the pipe as a task of its own until told to shut down.
+    """
+    import main
+
+    loop = asyncio.get_running_loop()
+    inbox: asyncio.Queue = asyncio.Queue()
+
+    def read():
+        try:
+            while True:
+                message = conn.recv()
+                loop.call_soon_threadsafe(inbox.put_nowait, message)
+        except (EOFError, OSError):
+            # The server process is gone
+            loop.call_soon_threadsafe(inbox.put_nowait, ("shutdown",))
+
+    threading.Thread(target=read, name="worker-pipe", daemon=True).start()
+    # Client messages of each request, forwarded by the server process
+    inboxes: dict[int, asyncio.Queue] = {}
+    tasks: set[asyncio.Task] = set()
+
+    async def answer(request_id: int, scope: dict):
+        async def send(message):
+            conn.send((request_id, message))
+
+        try:
+            await main.app(dict(scope, state={}), inboxes[request_id].get, send)
+        except Exception as e:
+            # The app already sent its 500 response when it could
+            print(f"Request failed in inference worker: {e}")
+        finally:
+            inboxes.pop(request_id, None)
+            conn.send((request_id, None))
+
+    async with main.app.router.lifespan_context(main.app):
+        conn.send(("ready",))
+        while True:
+            message = await inbox.get()
+            if message[0] == "shutdown":
+                break
+            if message[0] == "receive":
+                _, request_id, received = message
+                if request_id in inboxes:
+                    inboxes[request_id].put_nowait(received)
+                continue
+            _, request_id, scope = message
+            inboxes[request_id] = asyncio.Queue()
+            task = asyncio.create_task(answer(request_id, scope))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        for task in list(tasks):
+            task.cancel()
@@ -0,0 +1,67 @@
+"""
+Unit tests for inference worker configuration and metrics merging.
+"""
+
+import unittest
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client.parser import text_string_to_metric_families
+from starlette.responses import JSONResponse
+from app.api import chat
+from app.types import ModelConfig
+from app.workers import WorkerRouter, merge_metrics, parse_cpu_set, worker_config
+
+
+class TestParseCpuSet(unittest.TestCase):
+    def test_ranges_and_single_cpus(self):
+        self.assertEqual(parse_cpu_set("0-3, 8,10-11"), {0, 1, 2, 3, 8, 10, 11})
+        self.assertEqual(parse_cpu_set(""), set())
+
+
+class TestWorkerConfig(unittest.TestCase):
+    def test_disk_caches_get_a_directory_per_worker(self):
+        config = ModelConfig(prefix_cache_dir="/tmp/prefix", inference_workers=2)
+        worker = worker_config(config, 1)
+        self.assertEqual(Path(worker.prefix_cache_dir), Path("/tmp/prefix/worker-1"))
+        self.assertIsNone(worker.response_cache_dir)
+        self.assertEqual(config.prefix_cache_dir, "/tmp/prefix")
+
+
+class TestMergeMetrics(unittest.TestCase):
+    def test_samples_are_labeled_by_worker(self):
+        text = (
+            "# HELP ideapad_sessions Open conversations\n"
+            "# TYPE ideapad_sessions gauge\n"
+            "ideapad_sessions {}\n"
+        )
+        merged = merge_metrics({0: text.format(2), 1: text.format(5)}).decode()
+        (family,) = text_string_to_metric_families(merged)
+        values = {s.labels["worker"]: s.value for s in family.samples}
+        self.assertEqual(values, {"0": 2.0, "1": 5.0})
+
+
+class TestWorkerRouter(unittest.TestCase):
+    def test_liveness_is_answered_while_workers_load(self):
+        app = FastAPI()
+        app.include_router(chat.router, prefix="/api/chat")
+        app.add_middleware(WorkerRouter)
+
+        async def loading(scope, receive, send):
+            await JSONResponse({"ready": False}, status_code=503)(scope, receive, send)
+
+        with patch("app.workers.worker_pool") as pool:
+            pool.running = True
+            pool.handle = AsyncMock(side_effect=loading)
+            client = TestClient(app)
+            for path in ("/api/chat/health/live", "/api/chat/health"):
+                self.assertEqual(client.get(path).status_code, 200)
+            pool.handle.assert_not_called()
+            # Readiness still reflects the workers
+            self.assertEqual(client.get("/api/chat/health/ready").status_code, 503)
+            pool.handle.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Compare aggregate decode throughput of continuous batching against the
+one-request-at-a-time path.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.batching --model models/tinyllama.gguf --concurrency 1 2 4
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from app.types import ModelConfig
+from app.models.model_definition import ModelDefinition
+
+
+def _run_one(model: ModelDefinition, prompt: str, results: list):
+    started = time.perf_counter()
+    usage = {}
+    for event in model.generate_stream([{"role": "user", "content": prompt}]):
+        if event["type"] == "done":
+            usage = event["usage"]
+    results.append((time.perf_counter() - started, usage.get("completion_tokens", 0)))
+
+
+def run_workload(model: ModelDefinition, prompts: list[str], concurrent: bool) -> dict:
+    """
+    Generate every prompt, either one after another or all at once.
+    """
+    results: list = []
+    started = time.perf_counter()
+    if concurrent:
+        threads = [
+            threading.Thread(target=_run_one, args=(model, prompt, results))
+            for prompt in prompts
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for prompt in prompts:
+            _run_one(model, prompt, results)
+    elapsed = time.perf_counter() - started
+    tokens = sum(count for _, count in results)
+    return {
+        "requests": len(prompts),
+        "completion_tokens": tokens,
+        "wall_seconds": round(elapsed, 3),
+        "tokens_per_second": round(tokens / elapsed, 2) if elapsed else 0.0,
+        "max_request_seconds": round(max(t for t, _ in results), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument(
+        "--prompt", default="Write a Python function that reverses a string."
+    )
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        base = ModelConfig.model_validate(json.load(f))
+    overrides = {"max_tokens": args.max_tokens, "temperature": 0.0}
+    if args.model:
+        overrides["model_path"] = args.model
+
+    report = {}
+    for mode, batching in (("sequential", False), ("batched", True)):
+        config = base.model_copy(
+            update={
+                **overrides,
+                "continuous_batching": batching,
+                "max_batch_sequences": max(args.concurrency),
+            }
+        )
+        model = ModelDefinition(config)
+        try:
+            report[mode] = {
+                str(n): run_workload(model, [args.prompt] * n, concurrent=batching)
+                for n in args.concurrency
+            }
+        finally:
+            model.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
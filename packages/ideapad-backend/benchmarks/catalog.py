@@ -0,0 +1,118 @@
+"""
+Measure the model catalog and the RAM-budgeted model registry: how long
+listing a directory of models takes with and without cached headers, and
+what alternating between two models costs with no budget (every switch
+reloads) and with one that fits both.
+
+The directory is filled with hard links to the given models, so it takes
+no extra disk space.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.catalog --model models/a.gguf --other models/b.gguf
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from app.types import ModelConfig
+from app.models.catalog import ModelCatalog
+from app.models.model_registry import ModelRegistry
+
+
+def list_seconds(directory: Path, cache_path: Path, repeats: int = 5) -> dict:
+    """
+    Milliseconds to list the directory from scratch and from a warm catalog.
+    """
+    cache_path.unlink(missing_ok=True)
+    catalog = ModelCatalog(str(directory), str(cache_path))
+    started = time.perf_counter()
+    catalog.scan()
+    cold = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(repeats):
+        catalog.scan()
+    warm = (time.perf_counter() - started) / repeats
+    started = time.perf_counter()
+    ModelCatalog(str(directory), str(cache_path)).scan()
+    restarted = time.perf_counter() - started
+    return {
+        "cold_ms": round(cold * 1e3, 2),
+        "warm_ms": round(warm * 1e3, 2),
+        "from_cache_file_ms": round(restarted * 1e3, 2),
+        "headers_read": catalog.headers_read,
+    }
+
+
+def switch(configs: list[ModelConfig], budget: int, switches: int) -> dict:
+    """
+    Alternate between the models, holding one at a time as a conversation
+    would, and report the loads and mean seconds per switch.
+    """
+    registry = ModelRegistry()
+    started = time.perf_counter()
+    for i in range(switches):
+        config = configs[i % len(configs)].model_copy(
+            update={"model_ram_budget_bytes": budget}
+        )
+        registry.release(registry.acquire(config))
+    elapsed = time.perf_counter() - started
+    stats = registry.stats()
+    # Unload everything before the next run
+    registry.budget_bytes = 0
+    registry._close(registry._evict_idle(0))
+    return {
+        "budget_bytes": budget,
+        "mean_switch_seconds": round(elapsed / switches, 4),
+        "loads": stats["loads"],
+        "idle_hits": stats["idle_hits"],
+        "evictions": stats["evictions"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--other", required=True)
+    parser.add_argument("--copies", type=int, default=20)
+    parser.add_argument("--switches", type=int, default=10)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = ModelConfig.model_validate(json.load(f))
+    directory = Path(tempfile.mkdtemp(prefix="ideapad-catalog-"))
+    try:
+        sources = [Path(args.model).resolve(), Path(args.other).resolve()]
+        for i in range(args.copies):
+            source = sources[i % 2]
+            os.link(source, directory / f"{source.stem}-{i}.gguf")
+        report = {
+            "models": args.copies,
+            "list": list_seconds(directory, directory / "catalog.json"),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    configs = [
+        config.model_copy(update={"model_path": str(source)}) for source in sources
+    ]
+    report["switch_without_budget"] = switch(configs, 0, args.switches)
+    report["switch_with_budget"] = switch(configs, 1 << 40, args.switches)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
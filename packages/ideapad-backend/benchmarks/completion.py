@@ -0,0 +1,127 @@
+"""
+Measure code completion latency while typing through a source file, first
+with the model otherwise idle and then while a chat answer is being
+generated, and report p50/p95 per phase.
+
+Every keystroke inserts one character at the cursor, so consecutive
+completions share most of their prompt, as in an editor. Compare
+--fim-order psm and spm for models trained on both.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.completion --model models/codellama-7b.Q4_K_M.gguf
+"""
+
+import argparse
+import json
+import threading
+import time
+from pathlib import Path
+
+from app.types import ModelConfig
+from app.models.model_definition import ModelDefinition
+
+_TYPED = "        total = sum(len(turn) for turn in self.turns)\n"
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def type_through(
+    model: ModelDefinition,
+    source: str,
+    keystrokes: int,
+    max_tokens: int,
+    interval: float,
+) -> dict:
+    """
+    Type a new line into the middle of source, one character per keystroke
+    every interval seconds, requesting a completion after each.
+    """
+    cursor = source.index("\n", len(source) // 2) + 1
+    before, after = source[:cursor], source[cursor:]
+    line = (_TYPED * keystrokes)[:keystrokes]
+    model.complete(before, after, max_tokens)
+    latencies = []
+    for typed in range(1, keystrokes + 1):
+        started = time.perf_counter()
+        model.complete(before + line[:typed], after, max_tokens)
+        latencies.append(time.perf_counter() - started)
+        time.sleep(interval)
+    return {
+        "completions": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+    }
+
+
+def chat_forever(model: ModelDefinition, stop: threading.Event, tokens: list[int]):
+    messages = [{"role": "user", "content": "Explain how a hash map works."}]
+    while not stop.is_set():
+        for event in model.generate_stream(messages, None, 256):
+            if event["type"] == "token":
+                tokens[0] += 1
+            if stop.is_set():
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--keystrokes", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--fim-order", choices=["psm", "spm"])
+    parser.add_argument(
+        "--interval", type=float, default=0.15, help="Seconds between keystrokes"
+    )
+    parser.add_argument(
+        "--source",
+        default=Path(__file__).resolve().parents[1] / "app/models/context_window.py",
+        help="Code file typed through",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = ModelConfig.model_validate(json.load(f))
+    if args.model:
+        config = config.model_copy(update={"model_path": args.model})
+    if args.fim_order:
+        config = config.model_copy(update={"completion_fim_order": args.fim_order})
+    source = Path(args.source).read_text()
+
+    model = ModelDefinition(config)
+    try:
+        typing = (source, args.keystrokes, args.max_tokens, args.interval)
+        report = {"idle": type_through(model, *typing)}
+        stop, tokens = threading.Event(), [0]
+        chat = threading.Thread(target=chat_forever, args=(model, stop, tokens))
+        chat.start()
+        try:
+            # Let the chat answer get past its prefill
+            time.sleep(2)
+            tokens[0], started = 0, time.perf_counter()
+            report["during_chat"] = type_through(model, *typing)
+            elapsed = time.perf_counter() - started
+            report["during_chat"]["chat_tokens_per_second"] = round(
+                tokens[0] / elapsed, 2
+            )
+        finally:
+            stop.set()
+            chat.join()
+    finally:
+        model.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Deterministic stand-in for ModelDefinition that sleeps instead of running
+llama.cpp, so server overhead can be measured without a GGUF file.
+"""
+
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from app.metrics import GenerationTimer
+from app.types import ModelConfig
+from app.models.inference_executor import InferenceExecutor
+
+
+class FakeModelDefinition:
+    """
+    Answers every prompt with the same words after fixed prefill and per-token
+    delays. Like the real model, one generation runs at a time.
+    """
+
+    def __init__(
+        self,
+        config: ModelConfig,
+        token_delay: float = 0.01,
+        prefill_delay: float = 0.0002,
+        completion_tokens: int = 32,
+    ):
+        self.n_ctx = config.n_ctx
+        self.max_tokens = config.max_tokens
+        self.model_path = config.model_path
+        self.name = f"fake-{Path(self.model_path).stem}"
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+        self.completion_tokens = completion_tokens
+        self.lock = threading.Lock()
+        self.scheduler = None
+        self.prefix_cache = None
+        self.response_cache = None
+        self.speculative = None
+        self.grammars = None
+        self.lora = None
+        self.load_seconds = 0.0
+        self.warm_up_seconds = 0.0
+        self.executor = InferenceExecutor(
+            self.name, max_queue_size=config.max_queue_size
+        )
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def generate_stream(
+        self,
+        messages: list[dict[str, str]],
+        state=None,
+        max_tokens: Optional[int] = None,
+        grammar=None,
+    ) -> Iterator[dict]:
+        if not messages or not messages[-1].get("content"):
+            raise ValueError("Prompt must be a non-empty string")
+        completion = min(self.completion_tokens, max_tokens or self.max_tokens)
+        prompt = sum(self.count_tokens(m["content"]) for m in messages)
+        with self.lock:
+            timer = GenerationTimer(self.name)
+            with timer.stage("prefill"):
+                time.sleep(prompt * self.prefill_delay)
+            for i in range(completion):
+                with timer.stage("decode"):
+                    time.sleep(self.token_delay)
+                yield {"type": "token", "text": f"word{i} "}
+            timer.add_tokens("prefill", prompt)
+            timer.add_tokens("decode", completion)
+            timer.finish()
+        yield {
+            "type": "done",
+            "finish_reason": "length",
+            "usage": {
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "total_tokens": prompt + completion,
+            },
+        }
+
+    def generate_response(
+        self,
+        messages: list[dict[str, str]],
+        state=None,
+        max_tokens: Optional[int] = None,
+        grammar=None,
+    ) -> str:
+        events = self.generate_stream(messages, state, max_tokens)
+        return "".join(e["text"] for e in events if e["type"] == "token").strip()
+
+    def compile_grammar(self, grammar=None, json_schema=None):
+        # Answers are fixed words, so there is nothing to constrain
+        return None
+
+    def prefill(self, messages: list[dict[str, str]], state):
+        pass
+
+    def llama_timings(self) -> dict:
+        return {}
+
+    def kv_cache_usage(self) -> dict:
+        return {}
+
+    def release_state(self, state):
+        state.snapshot = None
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,141 @@
+"""
+Measure what grammar-constrained decoding costs: compiling a JSON schema
+the first time and from the grammar cache, and the decode time per token
+with and without the grammar, in the main llama context (llama.cpp's
+sampler chain) and in the batch scheduler's context (masked logits).
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.grammar --model models/mistral.gguf --max-tokens 128
+"""
+
+import argparse
+import json
+import time
+from typing import Optional
+
+from llama_cpp import LogitsProcessorList
+
+from app.types import ModelConfig
+from app.models.grammar import CompiledGrammar
+from app.models.model_definition import ModelDefinition
+
+# The shape the extension parses code edits from
+EDITS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "edits": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "path": {"type": "string"},
+                    "start_line": {"type": "integer"},
+                    "end_line": {"type": "integer"},
+                    "replacement": {"type": "string"},
+                },
+                "required": ["path", "start_line", "end_line", "replacement"],
+            },
+        },
+        "files": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["edits", "files"],
+}
+
+_PROMPT = "Rename the variable total to count in app/stats.py and list the files."
+
+
+def per_token_ms(marks: list[float], tokens: int) -> dict:
+    """
+    Decode milliseconds per token from the times tokens were sampled or text
+    arrived, counted from the first one on so the prefill is left out.
+    """
+    decoded = max(tokens - 1, 1)
+    elapsed = marks[-1] - marks[0] if marks else 0.0
+    return {"tokens": tokens, "ms_per_token": round(elapsed / decoded * 1000, 3)}
+
+
+def main_context(
+    model: ModelDefinition, grammar: Optional[CompiledGrammar], max_tokens: int
+) -> dict:
+    marks = []
+
+    def sampled(input_ids, scores):
+        marks.append(time.perf_counter())
+        return scores
+
+    with model.lock:
+        model.model.create_chat_completion(
+            messages=[{"role": "user", "content": _PROMPT}],
+            max_tokens=max_tokens,
+            temperature=0,
+            stop=[],
+            logits_processor=LogitsProcessorList([sampled]),
+            grammar=grammar.llama_grammar if grammar is not None else None,
+        )
+    return per_token_ms(marks, len(marks))
+
+
+def batched_context(
+    model: ModelDefinition, grammar: Optional[CompiledGrammar], max_tokens: int
+) -> dict:
+    scheduler = model._ensure_batch_scheduler()
+    tokens = model._chat_prompt_tokens([{"role": "user", "content": _PROMPT}])
+    marks, completion = [], 0
+    for event in scheduler.submit(tokens, max_tokens, 0, grammar=grammar):
+        if event["type"] == "token":
+            marks.append(time.perf_counter())
+        else:
+            # Pieces that end mid-character arrive with a later token
+            completion = event["usage"]["completion_tokens"]
+    return per_token_ms(marks, completion)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = ModelConfig.model_validate(json.load(f))
+    if args.model:
+        config = config.model_copy(update={"model_path": args.model})
+    model = ModelDefinition(config)
+    try:
+        started = time.perf_counter()
+        grammar = model.compile_grammar(json_schema=EDITS_SCHEMA)
+        cold = time.perf_counter() - started
+        started = time.perf_counter()
+        model.compile_grammar(json_schema=EDITS_SCHEMA)
+        cached = time.perf_counter() - started
+
+        report = {
+            "compile_ms": round(cold * 1000, 3),
+            "cached_compile_ms": round(cached * 1000, 4),
+        }
+        for name, run in (("main", main_context), ("batched", batched_context)):
+            free = run(model, None, args.max_tokens)
+            constrained = run(model, grammar, args.max_tokens)
+            report[name] = {
+                "unconstrained": free,
+                "json_schema": constrained,
+                "overhead_ms_per_token": round(
+                    constrained["ms_per_token"] - free["ms_per_token"], 3
+                ),
+            }
+    finally:
+        model.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Load-test the backend with concurrent conversations and report latency
+percentiles, time-to-first-token, throughput, queue wait and memory as JSON.
+
+By default the app is served in-process by uvicorn with a fake model that
+sleeps per token, so the numbers are server overhead only. Use --backend real
+with --model to load a GGUF, or --url to drive an already running server.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.load_test --conversations 1 4 16 --turns 3 --output load.json
+    python -m benchmarks.load_test --backend real --model models/tinyllama.gguf
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from typing import Callable, Optional
+
+import httpx
+
+from app.types import ModelConfig
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentiles(samples: list[float]) -> dict[str, Optional[float]]:
+    """
+    p50/p95/p99 and max of samples in milliseconds, by nearest rank.
+    """
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def current_rss_bytes() -> Optional[int]:
+    """
+    Resident memory right now, unlike the peak, which never goes down and so
+    cannot show what one workload added after a bigger one ran. Linux only.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+async def _queue_stats(client: httpx.AsyncClient) -> dict[tuple, dict]:
+    models = (await client.get("/api/chat/queue_stats")).json()["models"]
+    return {(q["model_path"], q["n_ctx"]): q["queue"] for q in models}
+
+
+def queue_delta(before: Optional[dict], after: dict) -> dict:
+    """
+    Queue waits and rejections during one workload, from the executor's
+    counters, which are cumulative since the model was loaded.
+    """
+    if before is None or after["started"] < before["started"]:
+        # Loaded (or reloaded) during the workload: its counters start at zero
+        before = {"started": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+        before["rejected"] = 0
+    started = after["started"] - before["started"]
+    total = after["total_wait_ms"] - before["total_wait_ms"]
+    return {
+        "started": started,
+        "avg_wait_ms": round(total / started, 3) if started else 0.0,
+        # The peak is only known to come from this workload if it rose
+        "max_wait_ms": (
+            round(after["max_wait_ms"], 3)
+            if after["max_wait_ms"] > before["max_wait_ms"]
+            else None
+        ),
+        "rejected": after["rejected"] - before["rejected"],
+    }
+
+
+class _Metrics:
+    def __init__(self):
+        self.start: list[float] = []
+        self.turn: list[float] = []
+        self.end: list[float] = []
+        self.ttft: list[float] = []
+        self.completion_tokens = 0
+        self.errors: dict[str, int] = {}
+
+    def error(self, what: str, status: int):
+        key = f"{what}:{status}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+async def _stream_turn(client: httpx.AsyncClient, cid: str, prompt: str, m: _Metrics):
+    started = time.perf_counter()
+    first = None
+    event = None
+    async with client.stream(
+        "POST",
+        "/api/chat/continue_conversation/stream",
+        json={"conversation_id": cid, "prompt": prompt},
+    ) as r:
+        if r.status_code != 200:
+            m.error("turn", r.status_code)
+            return
+        async for line in r.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: ") :]
+                if event == "token" and first is None:
+                    first = time.perf_counter() - started
+                elif event == "error":
+                    m.error("turn", 500)
+            elif line.startswith("data: ") and event == "done":
+                usage = json.loads(line[len("data: ") :]).get("usage", {})
+                m.completion_tokens += usage.get("completion_tokens", 0)
+    m.turn.append(time.perf_counter() - started)
+    if first is not None:
+        m.ttft.append(first)
+
+
+async def _conversation(
+    client: httpx.AsyncClient, turns: int, stream: bool, m: _Metrics
+):
+    started = time.perf_counter()
+    r = await client.post("/api/chat/start_conversation")
+    if r.status_code != 200:
+        m.error("start", r.status_code)
+        return
+    m.start.append(time.perf_counter() - started)
+    cid = r.json()["conversation_id"]
+
+    for i in range(turns):
+        prompt = f"Turn {i}: explain what this function does and how to test it."
+        if stream:
+            await _stream_turn(client, cid, prompt, m)
+            continue
+        started = time.perf_counter()
+        r = await client.post(
+            "/api/chat/continue_conversation",
+            json={"conversation_id": cid, "prompt": prompt},
+        )
+        if r.status_code != 200:
+            m.error("turn", r.status_code)
+            continue
+        m.turn.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    r = await client.post("/api/chat/end_conversation", json={"conversation_id": cid})
+    if r.status_code != 200:
+        m.error("end", r.status_code)
+    m.end.append(time.perf_counter() - started)
+
+
+async def run_workload(
+    base_url: str, conversations: int, turns: int, stream: bool, local: bool
+) -> dict:
+    """
+    Run `conversations` concurrent start / N turns / end sequences.
+    """
+    m = _Metrics()
+    rss_before = current_rss_bytes() if local else None
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        queues_before = await _queue_stats(client)
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(_conversation(client, turns, stream, m) for _ in range(conversations))
+        )
+        wall = time.perf_counter() - started
+        queues = await _queue_stats(client)
+
+    report = {
+        "conversations": conversations,
+        "turns": turns,
+        "stream": stream,
+        "wall_seconds": round(wall, 3),
+        "start": percentiles(m.start),
+        "turn": percentiles(m.turn),
+        "end": percentiles(m.end),
+        "errors": m.errors,
+        "queue": [
+            {"model_path": key[0], **queue_delta(queues_before.get(key), queue)}
+            for key, queue in queues.items()
+        ],
+    }
+    if stream:
+        # Only streamed turns report token usage
+        report["time_to_first_token"] = percentiles(m.ttft)
+        report["completion_tokens"] = m.completion_tokens
+        report["tokens_per_second"] = round(m.completion_tokens / wall, 2)
+    if local:
+        report["peak_rss_bytes"] = peak_rss_bytes()
+        rss_after = current_rss_bytes()
+        report["rss_bytes"] = rss_after
+        if rss_before is not None and rss_after is not None:
+            report["rss_growth_per_session_bytes"] = (
+                rss_after - rss_before
+            ) // conversations
+    return report
+
+
+def _serve(config: ModelConfig, backend: str, args) -> tuple[str, Callable[[], None]]:
+    """
+    Serve main:app in a background thread and return its URL and a stop function.
+    """
+    import uvicorn
+    from app.config import set_config
+    from app.models.model_registry import model_registry
+
+    set_config(config)
+    if backend == "fake":
+        from benchmarks.fake_model import FakeModelDefinition
+
+        model_registry.factory = functools.partial(
+            FakeModelDefinition,
+            token_delay=args.token_delay,
+            prefill_delay=args.prefill_delay,
+            completion_tokens=args.completion_tokens,
+        )
+    import main
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+
+    return f"http://127.0.0.1:{port}", stop
+
+
+async def _wait_ready(base_url: str, timeout: float = 600):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                r = await client.get("/api/chat/health/ready")
+                if r.status_code == 200:
+                    return
+                if r.json().get("stage") == "failed":
+                    raise RuntimeError(f"Model failed to load: {r.json()['error']}")
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.05)
+    raise TimeoutError("Backend did not become ready")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--backend", choices=["fake", "real"], default="fake")
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="GGUF to load with --backend real")
+    parser.add_argument("--url", help="Drive a running server instead of serving one")
+    parser.add_argument("--conversations", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument(
+        "--mode", choices=["stream", "blocking", "both"], default="both"
+    )
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--prefill-delay", type=float, default=0.0002)
+    parser.add_argument("--completion-tokens", type=int, default=32)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    modes = {"stream": [True], "blocking": [False], "both": [False, True]}[args.mode]
+    stop = None
+    placeholder = None
+    if args.url:
+        base_url = args.url
+    else:
+        with open(args.config) as f:
+            config = ModelConfig.model_validate(json.load(f))
+        updates = {"max_tokens": args.max_tokens, "max_queue_size": 1024}
+        if args.backend == "real":
+            if not args.model:
+                parser.error("--backend real needs --model")
+            updates["model_path"] = args.model
+        else:
+            # The registry resolves model paths, so the fake needs a real file
+            placeholder = tempfile.NamedTemporaryFile(suffix=".gguf", delete=False)
+            placeholder.close()
+            updates["model_path"] = placeholder.name
+        base_url, stop = _serve(config.model_copy(update=updates), args.backend, args)
+
+    try:
+        asyncio.run(_wait_ready(base_url))
+        results = [
+            asyncio.run(run_workload(base_url, n, args.turns, stream, stop is not None))
+            for stream in modes
+            for n in args.conversations
+        ]
+    finally:
+        if stop is not None:
+            stop()
+        if placeholder is not None:
+            os.unlink(placeholder.name)
+
+    report = {
+        "backend": "remote" if args.url else args.backend,
+        "model": args.model,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Measure serving LoRA adapters on one resident base model: what loading an
+adapter costs next to loading the model, what alternating turns between
+conversations with different adapters costs in the main llama context, and
+how the batch scheduler handles a mix of adapter sets (sequences with the
+same set are admitted together, so the set changes only a few times).
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.lora --model models/mistral.gguf \\
+        --adapter lora/code-style.gguf --adapter lora/sql.gguf
+"""
+
+import argparse
+import json
+import os
+import time
+
+from app.types import LoraAdapter, ModelConfig
+from app.models.model_definition import ModelDefinition, SequenceState
+
+_SYSTEM = {"role": "system", "content": "You are a helpful coding assistant."}
+_PROMPT = "Write a query that counts orders per customer."
+
+
+def alternating_turns(
+    model: ModelDefinition, adapter_sets: list, turns: int, max_tokens: int
+) -> dict:
+    """
+    One conversation per adapter set, answering in turn, so every turn lands
+    on a context that last decoded with other adapters.
+    """
+    states = [SequenceState(adapters) for adapters in adapter_sets]
+    history = [[_SYSTEM] for _ in states]
+    switches = model.lora.stats()["switches"]
+    started = time.perf_counter()
+    for turn in range(turns):
+        i = turn % len(states)
+        history[i].append({"role": "user", "content": _PROMPT})
+        answer = model.generate_response(history[i], states[i], max_tokens)
+        history[i].append({"role": "assistant", "content": answer})
+    elapsed = time.perf_counter() - started
+    return {
+        "conversations": len(states),
+        "turns": turns,
+        "mean_turn_seconds": round(elapsed / turns, 4),
+        "adapter_switches": model.lora.stats()["switches"] - switches,
+    }
+
+
+def batched_mix(
+    model: ModelDefinition, adapter_sets: list, requests: int, max_tokens: int
+) -> dict:
+    """
+    Requests submitted round-robin over the adapter sets, all at once.
+    """
+    scheduler = model._ensure_batch_scheduler()
+    tokens = model._chat_prompt_tokens(
+        [_SYSTEM, {"role": "user", "content": _PROMPT}]
+    )
+    switches = scheduler.adapter_switches
+    started = time.perf_counter()
+    streams = [
+        scheduler.submit(
+            tokens, max_tokens, 0, adapters=adapter_sets[i % len(adapter_sets)]
+        )
+        for i in range(requests)
+    ]
+    for stream in streams:
+        for _ in stream:
+            pass
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "seconds": round(elapsed, 3),
+        "adapter_switches": scheduler.adapter_switches - switches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--adapter", action="append", required=True)
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = ModelConfig.model_validate(json.load(f))
+    if args.model:
+        config = config.model_copy(update={"model_path": args.model})
+    model = ModelDefinition(config)
+    try:
+        started = time.perf_counter()
+        adapter_sets = [
+            model.resolve_adapters([LoraAdapter(path=path)]) for path in args.adapter
+        ]
+        load = time.perf_counter() - started
+        started = time.perf_counter()
+        for path in args.adapter:
+            model.resolve_adapters([LoraAdapter(path=path)])
+        cached = time.perf_counter() - started
+
+        report = {
+            "model_load_seconds": round(model.load_seconds, 3),
+            "model_bytes": os.path.getsize(model.model_path),
+            "adapter_load_seconds": round(load / len(args.adapter), 4),
+            "cached_adapter_seconds": round(cached / len(args.adapter), 6),
+            "adapter_bytes": [
+                os.path.getsize(adapters[0][0]) for adapters in adapter_sets
+            ],
+        }
+        sets = [()] + adapter_sets
+        report["main_base_only"] = alternating_turns(
+            model, [()] * len(sets), args.turns, args.max_tokens
+        )
+        report["main_alternating"] = alternating_turns(
+            model, sets, args.turns, args.max_tokens
+        )
+        report["batched_mix"] = batched_mix(
+            model, sets, args.requests, args.max_tokens
+        )
+    finally:
+        model.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
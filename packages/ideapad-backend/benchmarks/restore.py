@@ -0,0 +1,135 @@
+"""
+Measure what the durable conversation store costs per turn, and how long the
+first turn of a conversation restored after a restart takes: from a saved KV
+snapshot, and by replaying the stored transcript through the model.
+
+Builds one long conversation by pasting chunks of a source file, suspends it
+as an eviction or shutdown would, then restores it both ways from copies of
+the same store.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.restore --model models/mistral.gguf --turns 6
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from app.types import ModelConfig
+from app.models.conversation_store import close_conversation_store
+from app.models.model_instance import ModelInstance
+from app.models.model_registry import model_registry
+
+
+def first_turn(config: ModelConfig, conversation_id: str, model) -> float:
+    """
+    Seconds to restore the conversation and answer one more prompt, starting
+    from an empty llama context.
+    """
+    with model.lock:
+        model.model.reset()
+    started = time.perf_counter()
+    instance = ModelInstance.restore(config, conversation_id)
+    instance.get_response("Summarize the code above in one line.")
+    elapsed = time.perf_counter() - started
+    instance.shutdown()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--chunk-chars", type=int, default=1200)
+    parser.add_argument(
+        "--source",
+        default=Path(__file__).resolve().parents[1] / "app/models/model_definition.py",
+        help="Code file pasted into the conversation",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = ModelConfig.model_validate(json.load(f))
+    if args.model:
+        config = config.model_copy(update={"model_path": args.model})
+    source = Path(args.source).read_text()
+    directory = Path(tempfile.mkdtemp(prefix="ideapad-restore-"))
+    stored = config.model_copy(
+        update={
+            "conversation_store_dir": str(directory / "snapshot"),
+            "conversation_kv_snapshots": True,
+        }
+    )
+
+    # Held throughout, so restores never include loading the weights
+    model = model_registry.acquire(stored)
+    try:
+        instance = ModelInstance(stored)
+        store = instance._store
+        queued = []
+        save_turns = store.save_turns
+
+        def timed_save_turns(*args, **kwargs):
+            started = time.perf_counter()
+            save_turns(*args, **kwargs)
+            queued.append(time.perf_counter() - started)
+
+        store.save_turns = timed_save_turns
+        turn_seconds = []
+        for i in range(args.turns):
+            chunk = source[i * args.chunk_chars : (i + 1) * args.chunk_chars]
+            started = time.perf_counter()
+            instance.get_response(f"Review this code:\n{chunk}")
+            turn_seconds.append(time.perf_counter() - started)
+        conversation_id = instance.conversation_id
+        prompt_tokens = model.model.n_tokens
+
+        started = time.perf_counter()
+        instance.suspend()
+        suspend_seconds = time.perf_counter() - started
+        snapshot_bytes = store.stats()["snapshot_bytes"]
+        close_conversation_store()
+        shutil.copytree(directory / "snapshot", directory / "replay")
+
+        report = {
+            "turns": args.turns,
+            "context_tokens": prompt_tokens,
+            "mean_turn_seconds": round(sum(turn_seconds) / len(turn_seconds), 3),
+            "persist_us_per_turn": round(sum(queued) / len(queued) * 1e6, 1),
+            "suspend_seconds": round(suspend_seconds, 3),
+            "snapshot_bytes": snapshot_bytes,
+            "restore_from_snapshot_seconds": round(
+                first_turn(stored, conversation_id, model), 3
+            ),
+        }
+        close_conversation_store()
+        replay = stored.model_copy(
+            update={
+                "conversation_store_dir": str(directory / "replay"),
+                "conversation_kv_snapshots": False,
+            }
+        )
+        report["restore_by_replay_seconds"] = round(
+            first_turn(replay, conversation_id, model), 3
+        )
+        close_conversation_store()
+    finally:
+        model_registry.release(model)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Compare decode speed of speculative decoding (prompt lookup, and a draft model
+when --draft is given) against normal decoding on edit-style prompts, and
+check that every mode produces the same output.
+
+Completions run without the chat endpoints' newline stop, so whole edited
+functions are generated. Use temperature 0 or a fixed --seed, otherwise
+outputs differ between runs regardless of the mode.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.speculative --model models/mistral.gguf --draft models/tinyllama.gguf
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+from app.types import ModelConfig
+from app.models.model_definition import ModelDefinition
+
+# Edit-style requests: the answer repeats most of the pasted code
+_EDITS = (
+    "Rename the class ContextWindow to TokenWindow. Reply with the full file.",
+    "Add type annotations where they are missing. Reply with the full file.",
+    "Rewrite every docstring to start with a verb. Reply with the full file.",
+)
+
+
+def edit_prompts(source: str) -> list[list[dict[str, str]]]:
+    return [
+        [{"role": "user", "content": f"{edit}\n\n```python\n{source}```"}]
+        for edit in _EDITS
+    ]
+
+
+def run_mode(config: ModelConfig, prompts: list, max_tokens: int) -> dict:
+    """
+    Generate every prompt with one model load and report decode throughput.
+    """
+    model = ModelDefinition(config)
+    try:
+        outputs = []
+        tokens = 0
+        started = time.perf_counter()
+        for messages in prompts:
+            with model.lock:
+                result = model.model.create_chat_completion(
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=model.temperature,
+                    seed=model.seed,
+                )
+            outputs.append(result["choices"][0]["message"]["content"])
+            tokens += result["usage"]["completion_tokens"]
+        elapsed = time.perf_counter() - started
+        return {
+            "completion_tokens": tokens,
+            "wall_seconds": round(elapsed, 3),
+            "tokens_per_second": round(tokens / elapsed, 2) if elapsed else 0.0,
+            "speculative": model.speculative.stats() if model.speculative else None,
+            "outputs": outputs,
+        }
+    finally:
+        model.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--draft", help="Draft GGUF for the draft_model mode")
+    parser.add_argument("--draft-tokens", type=int, default=10)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--source",
+        default=Path(__file__).resolve().parents[1] / "app/models/context_window.py",
+        help="Code file pasted into the prompts",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        base = ModelConfig.model_validate(json.load(f))
+    overrides = {
+        "temperature": args.temperature,
+        "seed": args.seed,
+        "speculative_draft_tokens": args.draft_tokens,
+        "draft_model_path": args.draft,
+        "warm_up": "minimal",
+    }
+    if args.model:
+        overrides["model_path"] = args.model
+    prompts = edit_prompts(Path(args.source).read_text())
+
+    modes = ["off", "prompt_lookup"] + (["draft_model"] if args.draft else [])
+    report = {}
+    for mode in modes:
+        config = base.model_copy(update={**overrides, "speculative": mode})
+        report[mode] = run_mode(config, prompts, args.max_tokens)
+
+    baseline = report["off"]
+    for mode in modes[1:]:
+        result = report[mode]
+        result["speedup"] = round(
+            result["tokens_per_second"] / baseline["tokens_per_second"], 3
+        )
+        result["identical_output"] = result["outputs"] == baseline["outputs"]
+    for result in report.values():
+        del result["outputs"]
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
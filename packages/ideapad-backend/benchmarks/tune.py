@@ -0,0 +1,45 @@
+"""
+Find the fastest llama.cpp thread, batch and KV-cache settings for a model on
+this machine and save them as its tuning profile.
+
+Run from packages/ideapad-backend:
+    python -m benchmarks.tune --model models/tinyllama.gguf --threads 2 4 8
+"""
+
+import argparse
+import json
+
+from app.types import ModelConfig
+from app.models.autotune import tune
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="model_config.json")
+    parser.add_argument("--model", help="Override model_path from the config")
+    parser.add_argument("--threads", type=int, nargs="+", help="Thread counts to try")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--no-save", action="store_true", help="Only print the result")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = ModelConfig.model_validate(json.load(f))
+    if args.model:
+        config = config.model_copy(update={"model_path": args.model})
+
+    profile = tune(
+        config,
+        threads=args.threads,
+        batch_sizes=args.batch_sizes,
+        save=not args.no_save,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(profile, f, indent=2)
+    else:
+        print(json.dumps(profile, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,86 @@
 # FastAPI Backend Entry
 
 
-from fastapi import FastAPI
-from app.api import chat
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from app import workers
+from app.api import chat, complete, retrieval
+from app.api.session_manager import session_store
+from app.config import get_config
+from app.metrics import current_endpoint
+from app.models.preloader import model_preloader
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start loading the configured model in the background, so the server
+    accepts requests (and answers /api/chat/health/live) right away.
+    """
+    config = get_config()
+    if config.inference_workers > 0 and workers.worker_index is None:
+        # This process only routes; the workers run this same lifespan
+        workers.worker_pool.start(config)
+        yield
+        workers.worker_pool.stop()
+        return
+    session_store.configure(
+        config.session_ttl_seconds, config.session_memory_budget_bytes
+    )
+    if config.preload_model:
+        model_preloader.start(config)
+    yield
+    model_preloader.stop()
+    if config.conversation_store_dir:
+        from app.models.conversation_store import close_conversation_store
+
+        # Stored conversations keep their latest turns and KV snapshots
+        await run_in_threadpool(session_store.stop_all)
+        await run_in_threadpool(close_conversation_store)
 
 
 app = FastAPI(
     title="Ideapad Backend",
     description="Backend for the Ideapad application",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 
 # _Register routes
 app.include_router(chat.router, prefix="/api/chat", tags=["chat"])
+app.include_router(retrieval.router, prefix="/api/retrieval", tags=["retrieval"])
+app.include_router(complete.router, prefix="/api", tags=["complete"])
+
+
+@app.middleware("http")
+async def label_metrics(request: Request, call_next):
+    """
+    Label inference metrics recorded while serving a request with its route.
+    Unknown paths share one label so scanners cannot blow up cardinality.
+    """
+    known = any(
+        route.matches(request.scope)[0] == Match.FULL for route in app.router.routes
+    )
+    current_endpoint.set(request.url.path if known else "other")
+    return await call_next(request)
+
+
+# Outermost, so the worker pool sees requests before the app does
+app.add_middleware(workers.WorkerRouter)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus metrics: per-stage inference timings, token throughput,
+    sessions, resident models, KV-cache occupancy and llama.cpp counters.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/")